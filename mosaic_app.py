@@ -1,15 +1,14 @@
-import cv2
-import numpy as np
-from PIL import Image
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import os
+from mosaic_core import (
+    FolderIndex, decode_image_reduced, image_size, share_image, writable_image,
+)
 from mosaic_processor import MosaicProcessor
 from mosaic_ui import MosaicUI
 from mosaic_file_handler import MosaicFileHandler
-import re
-from natsort import natsorted
-import threading
+from mosaic_history import ImageHistory, take_snapshot, union_rect
+from mosaic_prefetch import DecodedImageCache, ImagePrefetcher
 
 class MosaicApp:
     def __init__(self, root):
@@ -34,6 +33,7 @@ class MosaicApp:
         self.drag_end = None
         self.drag_rect = None
         self.is_dragging = False
+        self._live_preview_job = None  # ドラッグ中のプレビューの描画予約
         
         # モザイク処理クラスの初期化
         self.processor = MosaicProcessor()
@@ -45,29 +45,39 @@ class MosaicApp:
         self.ui = MosaicUI(root, self)
         
         # 画像関連の変数
+        # 元画像・現在の画像・プレビュー画像は、書き換えるまで同じ配列を共有する
+        # （share_image で読み取り専用にし、書き換える直前に writable_image でコピー）
         self.current_image = None
         self.processed_image = None
         self.original_image = None  # 元の画像を保持
         self.current_image_path = None  # 現在の画像のパス
+        self.image_shape = None  # 元の解像度での画像の形状 (高さ, 幅, 3)
+        self.is_reduced = False  # プレビュー用の縮小画像を表示中か
         
         # プレビューモード用の変数
         self.preview_images = []  # プレビュー用の画像リスト
         self.current_preview_index = 0  # 現在のプレビュー画像のインデックス
-        self.folder_images = []  # フォルダ内の画像ファイルリスト
+        self.folder_index = None  # フォルダ内の画像の一覧と位置（更新があった場合のみ読み込み直す）
+        self.folder_images = []  # フォルダ内の画像ファイルリスト（folder_index の一覧）
         self.current_folder_index = 0  # 現在のフォルダ内インデックス
         
-        # 履歴管理
-        self.history = []  # 画像の履歴を保存
-        self.history_index = -1  # 現在の履歴位置
-        self.max_history = 200  # 最大履歴数
+        # 前後の画像の先読み（デコード済み画像のキャッシュ）
+        self.image_cache = DecodedImageCache()
+        self.prefetcher = ImagePrefetcher(self.image_cache)
+        # プレビューモードでは縮小して読み込み、元の解像度は編集を始める時に読み込む
+        self.preview_cache = DecodedImageCache(256 * 1024 * 1024)
+        self.preview_prefetcher = ImagePrefetcher(self.preview_cache, decode=decode_image_reduced)
+        
+        # 履歴管理（操作ごとに変更範囲の差分を保存）
+        self.history_budget = 512 * 1024 * 1024  # メモリ上の履歴の上限（バイト、超えた分は圧縮・一時ファイルへ退避）
+        self.history = ImageHistory(self.history_budget)
+        self.strokes = []  # 現在の画像に適用したストローク（操作レシピ）
         
         # キーボードイベントの設定
         self.root.bind("<Left>", self.previous_image)
         self.root.bind("<Right>", self.next_image)
         self.root.bind("<Escape>", self.exit_preview_mode)
         
-        self.saving_in_progress = False  # 保存中フラグ
-        self._pending_close = False      # 終了待ちフラグ
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
         # モザイク処理モード
@@ -87,9 +97,60 @@ class MosaicApp:
             self.ui.mode_button.config(text="手動(FANZA)")
             self.ui.mosaic_size_entry.config(state='disabled')  # 入力フィールドを無効化
         if self.current_image is not None:
-            self.reset_image()
+            # これまでのストロークを新しいモザイクサイズで再描画
+            self.rerender_strokes()
         self.ui.update_parameter_display()
 
+    def get_mosaic_size(self):
+        """現在のモードと倍率から (基本モザイクサイズ, 倍率) を取得"""
+        if self.mode == "manual_fanza":
+            base_mosaic_size = self.processor.calculate_fanza_mosaic_size(self.current_image.shape)
+        else:
+            base_mosaic_size = int(self.ui.mosaic_size_var.get())
+        multiplier = int(self.ui.mosaic_multiplier_var.get())
+        return base_mosaic_size, multiplier
+
+    def rerender_strokes(self, event=None):
+        """モザイクサイズ・倍率の変更時に、これまでのストロークを描き直す"""
+        if self.current_image is None or self.preview_mode:
+            return
+        try:
+            base_mosaic_size, multiplier = self.get_mosaic_size()
+        except ValueError:
+            return  # 入力途中のモザイクサイズは無視
+        self.ui.update_parameter_display()
+        mosaic_size = base_mosaic_size * multiplier
+        if not self.strokes or mosaic_size == self.processor.current_mosaic_size:
+            return
+        
+        # 全ストロークのサイズを変更し、元画像から再描画
+        old_strokes = self.strokes
+        self.strokes = [
+            dict(stroke, mode=self.mode, base_size=base_mosaic_size, multiplier=multiplier)
+            for stroke in self.strokes
+        ]
+        # 変更前・変更後のストロークが書き換える範囲を履歴に保存
+        bounds = None
+        for stroke in old_strokes + self.strokes:
+            bounds = union_rect(bounds, self.processor.stroke_bounds(self.current_image.shape, stroke))
+        snapshot = take_snapshot(self.current_image, bounds)
+        self.current_image, self.processor.coverage = self.processor.replay_recipe(
+            self.original_image,
+            self.build_recipe()
+        )
+        self.processor.current_mosaic_size = mosaic_size
+        self.processed_image = self.current_image
+        self.add_to_history(bounds, snapshot)
+        self.ui.display_image(self.current_image, bounds)
+
+    def build_recipe(self):
+        """現在の画像の操作レシピを作成"""
+        return self.processor.build_recipe(
+            self.strokes,
+            self.original_image.shape if self.original_image is not None else None,
+            self.current_image_path
+        )
+
     def toggle_mask_mode(self):
         """マスクモードの切り替え"""
         self.mask_mode = not self.mask_mode
@@ -124,6 +185,7 @@ class MosaicApp:
 
     def clear_mask(self):
         """処理範囲をクリア"""
+        had_mask = self.mask_coords is not None or self.mask_rect is not None
         self.mask_mode = False
         self.mask_coords = None
         self.mask_start = None
@@ -136,8 +198,8 @@ class MosaicApp:
         self.ui.mask_status_label.config(text="処理範囲: なし")
         # マスク削除ボタンを無効化（マスクがないため）
         self.ui.mask_clear_button.config(state='disabled')
-        # 画像を再表示
-        if self.current_image is not None:
+        # 画像を再表示（処理範囲が表示されていた場合のみ）
+        if had_mask and self.current_image is not None:
             self.ui.display_image(self.current_image)
 
     def toggle_mosaic_mode(self):
@@ -166,39 +228,50 @@ class MosaicApp:
             self.ui.mosaic_button.config(text="モザイク処理開始")
             self.ui.mosaic_status_label.config(text="モザイク処理: 無効")
 
-    def add_to_history(self, image):
-        """履歴に画像を追加"""
-        # 現在位置より後の履歴を削除
-        self.history = self.history[:self.history_index + 1]
-        # 新しい画像を追加
-        self.history.append(image.copy())
-        self.history_index = len(self.history) - 1
-        # 履歴が長すぎる場合は古いものを削除
-        if len(self.history) > self.max_history:
-            self.history.pop(0)
-            self.history_index -= 1
+    def reset_history(self):
+        """履歴をクリアし、現在の画像を起点にする"""
+        self.strokes = []
+        self.history.reset(([], self.processor.current_mosaic_size))
+        self.ui.update_history_buttons()
+
+    def add_to_history(self, rect, snapshot):
+        """履歴に操作を追加
+
+        rect は変更範囲、snapshot は操作前に take_snapshot で保存した画素。
+        """
+        self.history.push(
+            self.current_image, rect, snapshot,
+            (list(self.strokes), self.processor.current_mosaic_size)
+        )
         # ボタンの状態を更新
         self.ui.update_history_buttons()
 
+    def restore_history_state(self, rect):
+        """元に戻す・やり直し後に、ストロークとモザイクサイズを履歴の状態に合わせる
+
+        rect は書き戻した範囲（再描画する範囲、無い場合は None）。
+        """
+        strokes, self.processor.current_mosaic_size = self.history.state()
+        self.strokes = list(strokes)
+        self.processor.coverage.clear()
+        self.processed_image = self.current_image
+        self.ui.display_image(self.current_image, rect or (0, 0, 0, 0), interactive=True)
+        self.ui.update_parameter_display()
+        self.ui.update_history_buttons()
+
     def undo(self):
-        """1つ前の状態に戻す"""
-        if self.history_index > 0:
-            self.history_index -= 1
-            self.current_image = self.history[self.history_index].copy()
-            self.processed_image = self.current_image.copy()
-            self.ui.display_image(self.current_image)
-            self.ui.update_parameter_display()
-            self.ui.update_history_buttons()
+        """1つ前の状態に戻す（変更範囲だけを書き戻す）"""
+        if self.history.can_undo():
+            self.current_image = writable_image(self.current_image)
+            rect = self.history.undo(self.current_image)
+            self.restore_history_state(rect)
 
     def redo(self):
-        """1つ後の状態に進む"""
-        if self.history_index < len(self.history) - 1:
-            self.history_index += 1
-            self.current_image = self.history[self.history_index].copy()
-            self.processed_image = self.current_image.copy()
-            self.ui.display_image(self.current_image)
-            self.ui.update_parameter_display()
-            self.ui.update_history_buttons()
+        """1つ後の状態に進む（変更範囲だけを書き戻す）"""
+        if self.history.can_redo():
+            self.current_image = writable_image(self.current_image)
+            rect = self.history.redo(self.current_image)
+            self.restore_history_state(rect)
 
     def select_image(self):
         file_path = filedialog.askopenfilename(
@@ -208,30 +281,30 @@ class MosaicApp:
             try:
                 folder_path = os.path.dirname(file_path)
                 file_path_abs = os.path.abspath(file_path)
-                self.folder_images = [
-                    os.path.abspath(os.path.join(folder_path, f))
-                    for f in os.listdir(folder_path)
-                    if f.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.gif'))
-                ]
-                self.folder_images = natsorted(self.folder_images)
+                self.folder_index = FolderIndex(folder_path)
+                self.folder_images = self.folder_index.images
                 # パスを正規化して比較
-                norm_file_path = os.path.normcase(os.path.normpath(file_path_abs))
-                norm_folder_images = [os.path.normcase(os.path.normpath(p)) for p in self.folder_images]
-                self.current_folder_index = norm_folder_images.index(norm_file_path)
-                pil_img = Image.open(file_path_abs)
-                self.original_image = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+                index = self.folder_index.index(file_path_abs)
+                if index is None:
+                    raise ValueError(f"フォルダ内に画像が見つかりません: {file_path_abs}")
+                self.current_folder_index = index
+                self.original_image = self.prefetcher.load(file_path_abs)
             except Exception as e:
                 messagebox.showerror("エラー", f"画像の読み込みに失敗しました: {e}")
                 return
-            self.current_image = self.original_image.copy()
-            self.processed_image = self.current_image.copy()
+            self.current_image = self.original_image  # 最初の書き換え時にコピー
+            self.processed_image = self.current_image
             self.current_image_path = file_path_abs
+            self.image_shape = self.current_image.shape
+            self.is_reduced = False
+            # 基準点を読み込む（無ければ最初のクリック位置が基準点になる）
+            self.processor.load_reference_point(file_path_abs)
             # 処理範囲をクリア
             self.clear_mask()
-            # 履歴をクリアして新しい画像を追加
-            self.history = [self.current_image.copy()]
-            self.history_index = 0
-            self.ui.update_history_buttons()
+            # 履歴をクリア
+            self.reset_history()
+            # 新しい画像は全体表示から始める
+            self.ui.viewport.fit()
             self.ui.display_image(self.current_image)
             self.ui.update_parameter_display()
             # 画像選択後にプレビューモードへ移行
@@ -244,22 +317,36 @@ class MosaicApp:
         if 0 <= index < len(self.folder_images):
             try:
                 file_path = self.folder_images[index]
-                pil_img = Image.open(file_path)
-                self.original_image = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-                self.current_image = self.original_image.copy()
-                self.processed_image = self.current_image.copy()
+                if self.preview_mode:
+                    # プレビュー中は縮小して読み込む（元の解像度はプレビュー終了時に読み込む）
+                    self.original_image = self.preview_prefetcher.load(file_path)
+                    width, height = image_size(file_path)
+                    self.image_shape = (height, width, 3)
+                    # 小さい画像やPNGなど、元の解像度のまま読み込まれた場合は読み直さない
+                    self.is_reduced = self.original_image.shape[:2] != (height, width)
+                else:
+                    self.original_image = self.prefetcher.load(file_path)
+                    self.image_shape = self.original_image.shape
+                    self.is_reduced = False
+                self.current_image = self.original_image  # 最初の書き換え時にコピー
+                self.processed_image = self.current_image
                 self.current_image_path = file_path
                 self.current_folder_index = index
                 
+                # 基準点を読み込む（無ければ最初のクリック位置が基準点になる）
+                self.processor.load_reference_point(file_path)
+                
                 # 処理範囲をクリア
                 self.clear_mask()
                 
-                # 履歴をクリアして新しい画像を追加
-                self.history = [self.current_image.copy()]
-                self.history_index = 0
-                self.ui.update_history_buttons()
+                # 履歴をクリア
+                self.reset_history()
                 
-                self.ui.display_image(self.current_image)
+                # 新しい画像は全体表示から始める
+                self.ui.viewport.fit()
+                
+                # プレビュー中の画像送りは軽い表示を先に出し、止まった後に高画質で描き直す
+                self.ui.display_image(self.current_image, interactive=self.preview_mode)
                 self.ui.update_parameter_display()
                 
                 # フォルダ内容をリロード
@@ -270,15 +357,29 @@ class MosaicApp:
                 messagebox.showerror("エラー", f"画像の読み込みに失敗しました: {e}")
         return False
 
+    def ensure_full_image(self):
+        """縮小画像を表示中であれば、元の解像度で読み込み直す（失敗時は False）"""
+        if not self.is_reduced:
+            return True
+        try:
+            self.original_image = self.prefetcher.load(self.current_image_path)
+        except Exception as e:
+            messagebox.showerror("エラー", f"画像の読み込みに失敗しました: {e}")
+            return False
+        self.current_image = self.original_image  # 最初の書き換え時にコピー
+        self.processed_image = self.current_image
+        self.image_shape = self.current_image.shape
+        self.is_reduced = False
+        return True
+
     def reset_image(self):
         if self.original_image is not None:
-            self.current_image = self.original_image.copy()
-            self.processed_image = self.current_image.copy()
+            self.current_image = self.original_image  # 最初の書き換え時にコピー
+            self.processed_image = self.current_image
+            self.processor.coverage.clear()
             self.ui.display_image(self.current_image)
-            # 履歴をクリアして新しい画像を追加
-            self.history = [self.current_image.copy()]
-            self.history_index = 0
-            self.ui.update_history_buttons()
+            # 履歴をクリア
+            self.reset_history()
             # 処理範囲表示を更新
             if self.mask_coords is not None:
                 self.update_mask_display()
@@ -287,31 +388,9 @@ class MosaicApp:
         if self.current_image is None or self.preview_mode:
             return
             
-        # キャンバス上の座標を画像の座標に変換
-        canvas_width = self.ui.canvas.winfo_width()
-        canvas_height = self.ui.canvas.winfo_height()
-        
-        # 画像の表示サイズを取得
-        img_height, img_width = self.current_image.shape[:2]
-        img_ratio = img_width / img_height
-        canvas_ratio = canvas_width / canvas_height
-        
-        if img_ratio > canvas_ratio:
-            display_width = canvas_width
-            display_height = int(canvas_width / img_ratio)
-        else:
-            display_height = canvas_height
-            display_width = int(canvas_height * img_ratio)
-            
         # クリック位置を画像座標に変換
-        x_scale = img_width / display_width
-        y_scale = img_height / display_height
-        
-        x_offset = (canvas_width - display_width) // 2
-        y_offset = (canvas_height - display_height) // 2
-        
-        img_x = int((event.x - x_offset) * x_scale)
-        img_y = int((event.y - y_offset) * y_scale)
+        img_height, img_width = self.current_image.shape[:2]
+        img_x, img_y = self.ui.viewport.to_image(event.x, event.y)
         
         # クリック位置が画像の範囲内かチェック
         if not (0 <= img_x < img_width and 0 <= img_y < img_height):
@@ -331,6 +410,7 @@ class MosaicApp:
             # ドラッグ開始位置を記録（マスク範囲外でも記録）
             self.drag_start = (img_x, img_y)
             self.is_dragging = True
+            self.ui.begin_live_preview()
 
     def update_mask_display(self):
         """処理範囲表示を更新"""
@@ -341,36 +421,11 @@ class MosaicApp:
         if self.mask_rect:
             self.ui.canvas.delete(self.mask_rect)
             
-        # キャンバス上の座標を取得
-        canvas_width = self.ui.canvas.winfo_width()
-        canvas_height = self.ui.canvas.winfo_height()
-        
-        # 画像の表示サイズを取得
-        img_height, img_width = self.current_image.shape[:2]
-        img_ratio = img_width / img_height
-        canvas_ratio = canvas_width / canvas_height
-        
-        if img_ratio > canvas_ratio:
-            display_width = canvas_width
-            display_height = int(canvas_width / img_ratio)
-        else:
-            display_height = canvas_height
-            display_width = int(canvas_height * img_ratio)
-            
-        # 座標変換
-        x_scale = img_width / display_width
-        y_scale = img_height / display_height
-        
-        x_offset = (canvas_width - display_width) // 2
-        y_offset = (canvas_height - display_height) // 2
-        
         x1, y1, x2, y2 = self.mask_coords
         
         # キャンバス座標に変換
-        canvas_x1 = x1 / x_scale + x_offset
-        canvas_y1 = y1 / y_scale + y_offset
-        canvas_x2 = x2 / x_scale + x_offset
-        canvas_y2 = y2 / y_scale + y_offset
+        canvas_x1, canvas_y1 = self.ui.viewport.to_canvas(x1, y1)
+        canvas_x2, canvas_y2 = self.ui.viewport.to_canvas(x2, y2)
         
         # 処理範囲を青色の半透明矩形で表示
         self.mask_rect = self.ui.canvas.create_rectangle(
@@ -382,31 +437,8 @@ class MosaicApp:
         if self.current_image is None or self.preview_mode:
             return
             
-        # キャンバス上の座標を画像の座標に変換
-        canvas_width = self.ui.canvas.winfo_width()
-        canvas_height = self.ui.canvas.winfo_height()
-        
-        # 画像の表示サイズを取得
-        img_height, img_width = self.current_image.shape[:2]
-        img_ratio = img_width / img_height
-        canvas_ratio = canvas_width / canvas_height
-        
-        if img_ratio > canvas_ratio:
-            display_width = canvas_width
-            display_height = int(canvas_width / img_ratio)
-        else:
-            display_height = canvas_height
-            display_width = int(canvas_height * img_ratio)
-            
         # ドラッグ位置を画像座標に変換
-        x_scale = img_width / display_width
-        y_scale = img_height / display_height
-        
-        x_offset = (canvas_width - display_width) // 2
-        y_offset = (canvas_height - display_height) // 2
-        
-        img_x = int((event.x - x_offset) * x_scale)
-        img_y = int((event.y - y_offset) * y_scale)
+        img_x, img_y = self.ui.viewport.to_image(event.x, event.y)
         
         if self.mask_mode and self.is_creating_mask:
             # 範囲設定時のドラッグ処理
@@ -417,10 +449,8 @@ class MosaicApp:
                 self.ui.canvas.delete(self.mask_rect)
                 
             # キャンバス上の座標に変換して矩形を描画
-            start_x = self.mask_start[0] / x_scale + x_offset
-            start_y = self.mask_start[1] / y_scale + y_offset
-            end_x = img_x / x_scale + x_offset
-            end_y = img_y / y_scale + y_offset
+            start_x, start_y = self.ui.viewport.to_canvas(*self.mask_start)
+            end_x, end_y = self.ui.viewport.to_canvas(img_x, img_y)
             
             self.mask_rect = self.ui.canvas.create_rectangle(
                 start_x, start_y, end_x, end_y,
@@ -436,8 +466,7 @@ class MosaicApp:
                 self.ui.canvas.delete(self.drag_rect)
                 
             # キャンバス上の座標に変換して矩形を描画
-            start_x = self.drag_start[0] / x_scale + x_offset
-            start_y = self.drag_start[1] / y_scale + y_offset
+            start_x, start_y = self.ui.viewport.to_canvas(*self.drag_start)
             end_x = event.x
             end_y = event.y
             
@@ -445,6 +474,54 @@ class MosaicApp:
                 start_x, start_y, end_x, end_y,
                 outline='red', width=2
             )
+            
+            # 縮小画像上でモザイクの仕上がりを表示
+            self.schedule_live_preview()
+
+    def schedule_live_preview(self):
+        """ドラッグ中のプレビューを予約（連続するマウス移動はアイドル時の1回にまとめる）"""
+        if self._live_preview_job is None and self.ui.live_preview_var.get():
+            self._live_preview_job = self.root.after_idle(self.render_live_preview)
+
+    def render_live_preview(self):
+        """現在のドラッグ範囲で、表示用の縮小画像にモザイクを描画"""
+        self._live_preview_job = None
+        if not self.is_dragging or self.drag_start is None or self.drag_end is None:
+            return
+        x1 = min(self.drag_start[0], self.drag_end[0])
+        y1 = min(self.drag_start[1], self.drag_end[1])
+        x2 = max(self.drag_start[0], self.drag_end[0])
+        y2 = max(self.drag_start[1], self.drag_end[1])
+        rect = (x1, y1, x2, y2)
+        
+        # 処理範囲が設定されている場合は、ドラッグ終了時と同じく処理範囲内に制限
+        if self.mask_coords is not None:
+            mask_x1, mask_y1, mask_x2, mask_y2 = self.mask_coords
+            rect = (max(x1, mask_x1), max(y1, mask_y1), min(x2, mask_x2), min(y2, mask_y2))
+            if rect[0] >= rect[2] or rect[1] >= rect[3]:
+                rect = None
+        
+        base_mosaic_size, multiplier = self.get_mosaic_size()
+        # 基準点が未設定の場合は、ドラッグ終了時と同じくドラッグ開始位置を基準点とする
+        origin = self.processor.reference_point or self.drag_start
+        self.ui.show_live_preview(
+            self.current_image.shape, rect, base_mosaic_size * multiplier, origin, self.mask_coords
+        )
+
+    def cancel_live_preview(self):
+        """ドラッグ中のプレビューを終了し、プレビューを描画していたかどうかを返す
+
+        表示は戻さない。処理を行わずに終える場合は restore_display で元の表示に戻す。
+        """
+        if self._live_preview_job is not None:
+            self.root.after_cancel(self._live_preview_job)
+            self._live_preview_job = None
+        return self.ui.end_live_preview()
+
+    def restore_display(self, preview_shown):
+        """プレビューを描画していた場合、変更の無い現在の画像の表示に戻す"""
+        if preview_shown and self.current_image is not None:
+            self.ui.display_image(self.current_image, interactive=True)
 
     def on_canvas_release(self, event):
         """マウスボタンリリース時の処理"""
@@ -472,6 +549,9 @@ class MosaicApp:
             
         if not self.is_dragging or self.current_image is None or self.preview_mode:
             return
+        
+        # ドラッグ中のプレビューを終了（表示はこの後の処理結果で置き換える）
+        preview_shown = self.cancel_live_preview()
             
         # ドラッグ領域の座標を取得
         x1 = min(self.drag_start[0], self.drag_end[0])
@@ -479,48 +559,16 @@ class MosaicApp:
         x2 = max(self.drag_start[0], self.drag_end[0])
         y2 = max(self.drag_start[1], self.drag_end[1])
         
-        # ドラッグ終了位置を画像座標に変換
-        canvas_width = self.ui.canvas.winfo_width()
-        canvas_height = self.ui.canvas.winfo_height()
-        
-        # 画像の表示サイズを取得
-        img_height, img_width = self.current_image.shape[:2]
-        img_ratio = img_width / img_height
-        canvas_ratio = canvas_width / canvas_height
-        
-        if img_ratio > canvas_ratio:
-            display_width = canvas_width
-            display_height = int(canvas_width / img_ratio)
-        else:
-            display_height = canvas_height
-            display_width = int(canvas_height * img_ratio)
-            
-        # ドラッグ位置を画像座標に変換
-        x_scale = img_width / display_width
-        y_scale = img_height / display_height
-        
-        x_offset = (canvas_width - display_width) // 2
-        y_offset = (canvas_height - display_height) // 2
-        
-        img_x = int((event.x - x_offset) * x_scale)
-        img_y = int((event.y - y_offset) * y_scale)
-        
-        # ドラッグ終了位置を保存
-        self.drag_end = (img_x, img_y)
+        # ドラッグ終了位置を画像座標に変換して保存
+        self.drag_end = self.ui.viewport.to_image(event.x, event.y)
         
         # 仮のモザイク領域を削除
         if self.drag_rect:
             self.ui.canvas.delete(self.drag_rect)
             self.drag_rect = None
             
-        # モザイクサイズの決定
-        if self.mode == "manual_fanza":
-            base_mosaic_size = self.processor.calculate_fanza_mosaic_size(self.current_image.shape)
-        else:
-            base_mosaic_size = int(self.ui.mosaic_size_var.get())
-            
-        # 倍率を適用
-        multiplier = int(self.ui.mosaic_multiplier_var.get())
+        # モザイクサイズの決定（倍率を適用）
+        base_mosaic_size, multiplier = self.get_mosaic_size()
         mosaic_size = base_mosaic_size * multiplier
             
         # 処理範囲が設定されている場合、処理範囲内に制限
@@ -532,52 +580,72 @@ class MosaicApp:
             x2 = min(x2, mask_x2)
             y2 = min(y2, mask_y2)
             
-            # 重複がない場合は処理を終了
+            # 重複がない場合は処理を終了（画像は変わらないため表示だけ戻す）
             if x1 >= x2 or y1 >= y2:
                 self.is_dragging = False
                 self.drag_start = None
                 self.drag_end = None
+                self.restore_display(preview_shown)
                 return
         
-        # 最適なクリック間隔を計算（モザイクサイズの2倍）
-        click_interval = mosaic_size * 2
+        # 基準点を原点とするグリッドに整列（未設定の場合はドラッグ開始位置を基準点にする）
+        origin = self.processor.ensure_reference_point(*self.drag_start, mosaic_size)
         
-        # 処理範囲が設定されている場合は、処理範囲を切り出して処理
+        # 書き換えられる可能性のある範囲の画素を、履歴用に保存
+        bounds = self.processor.region_bounds(
+            self.current_image.shape, (x1, y1, x2, y2), mosaic_size, origin, self.mask_coords
+        )
+        if bounds is None:
+            # 範囲が空・画像の範囲外の場合は処理しない（画像は変わらないため表示だけ戻す）
+            self.is_dragging = False
+            self.drag_start = None
+            self.drag_end = None
+            self.restore_display(preview_shown)
+            return
+        snapshot = take_snapshot(self.current_image, bounds)
+        
+        # 共有中の画像（元画像・プレビュー画像）であれば、ここで初めてコピー
+        self.current_image = writable_image(self.current_image)
+        
+        # 処理範囲が設定されている場合は、処理範囲内に制限して処理
         if self.mask_coords is not None:
             # ドラッグ座標を準備
             drag_coords = (x1, y1, x2, y2)
             
-            # 処理範囲を切り出して処理し、元の画像に合成
-            self.current_image = self.processor.process_masked_area(
+            # 処理範囲内に制限して処理（倍率はプロセッサ側で適用）
+            self.current_image, dirty = self.processor.process_masked_area(
                 self.current_image,
                 self.mask_coords,
                 drag_coords,
                 self.mode,
-                mosaic_size,
-                multiplier
+                base_mosaic_size,
+                multiplier,
+                origin=origin,
+                coverage=self.processor.coverage
             )
         else:
-            # 従来の処理（処理範囲なし）
-            # ドラッグ領域内を最適化された間隔でクリックしたことにする
-            for y in range(y1, y2, click_interval):
-                for x in range(x1, x2, click_interval):
-                    # 画像の範囲内かチェック
-                    if 0 <= x < img_width and 0 <= y < img_height:
-                        # クリック位置にモザイクを適用
-                        self.current_image = self.processor.process_click(
-                            self.current_image,
-                            x, y,
-                            self.mode,
-                            mosaic_size
-                        )
-        
-        self.processed_image = self.current_image.copy()
-        
-        # 履歴に追加
-        self.add_to_history(self.current_image)
-        
-        # 画像を更新
-        self.ui.display_image(self.current_image)
+            # 処理範囲なし: ドラッグ領域全体を1回で処理
+            # （処理済みのブロックは飛ばす）
+            self.current_image, dirty = self.processor.process_region(
+                self.current_image,
+                (x1, y1, x2, y2),
+                mosaic_size,
+                origin=origin,
+                coverage=self.processor.coverage
+            )
+        
+        # 操作レシピとしてストロークを記録
+        self.strokes.append(self.processor.make_stroke(
+            self.mode, base_mosaic_size, multiplier, (x1, y1, x2, y2), self.mask_coords, origin
+        ))
+        
+        self.processed_image = self.current_image
+        
+        # 履歴に追加（変更範囲の差分のみ）
+        self.add_to_history(dirty, snapshot)
+        
+        # 画像を更新（変更範囲のみ。変更が無くてもコピーオンライトで配列が替わるため空の範囲を渡す）
+        self.ui.display_image(self.current_image, dirty or (0, 0, 0, 0), interactive=True)
         self.ui.update_parameter_display()
         
         # ドラッグ状態をリセット
@@ -594,7 +662,7 @@ class MosaicApp:
             
             # 現在の画像をプレビューリストに追加
             if self.current_image is not None:
-                self.preview_images = [self.current_image.copy()]
+                self.preview_images = [share_image(self.current_image)]
                 self.current_preview_index = 0
                 
                 # プレビュー用の画像を表示
@@ -612,6 +680,9 @@ class MosaicApp:
             self.preview_mode = False
             self.ui.preview_button.config(text="プレビュー")
             
+            # 編集に備えて元の解像度で読み込む
+            self.ensure_full_image()
+            
             # 元の画像を表示
             if self.current_image is not None:
                 self.ui.display_image(self.current_image)
@@ -637,11 +708,20 @@ class MosaicApp:
             if self.load_folder_image(self.current_folder_index + 1):
                 self.ui.update_preview_info()
 
+    def prefetch_neighbours(self):
+        """現在の画像の前後を先読み"""
+        if self.folder_images:
+            prefetcher = self.preview_prefetcher if self.preview_mode else self.prefetcher
+            prefetcher.prefetch(self.folder_images, self.current_folder_index)
+
     def on_closing(self):
-        if self.saving_in_progress:
-            self._pending_close = True
-            self.ui.quick_save_button.config(text="保存中... 終了待機", state="disabled")
+        # 保存待ちがあれば、すべて保存し終えてから終了する
+        if self.file_handler.save_queue.pending:
+            self.file_handler.close_when_saved()
             return
+        self.file_handler.save_queue.shutdown()
+        self.prefetcher.shutdown()
+        self.preview_prefetcher.shutdown()
         self.root.destroy()
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+"""
+モザイク処理のバッチ実行（コマンドライン）
+
+フォルダ内の画像に操作レシピを適用し、クイック保存と同じ _Completed / _Original の
+構成で出力する。画像ごとの処理はプロセスプールに分配する。
+
+レシピの決定順:
+1. --recipe で指定したレシピ（全画像に共通で適用）
+2. 画像ごとのレシピ（サイドカーファイル、またはPNGのテキストチャンク）
+3. --region で指定した範囲（基準点・モザイクサイズは画像のメタデータ、
+   無い場合は --size / FANZA仕様 と範囲の左上を使用）
+
+--tile-threshold（メガピクセル）を超える画像は、Pillow のデコーダから直接ディスク上の
+一時ファイルに展開して処理し、少しずつ書き出す（メモリ使用量が画像サイズに依存しない）。
+Pillow の展開爆弾の検査の上限（約1.8億画素）を超える画像もこの方法で処理する。
+
+--retag を指定すると、モザイク処理は行わずにフォルダ内の処理済み画像（PNG/JPEG）の
+メタデータ（配布条件の文言など）だけを書き換える。画素データは再エンコードしない。
+
+使用例:
+    python mosaic_batch.py 画像フォルダ --region 100,200,400,500 --format png
+    python mosaic_batch.py 画像フォルダ --recipe recipe.json --workers 32
+    python mosaic_batch.py 処理済みフォルダ --retag
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from mosaic_core import (
+    allow_large_images, decode_image, decoded_memmap, encode_image, encode_image_streaming,
+    image_size, list_folder_images, output_base_name, output_folders,
+)
+from mosaic_processor import MosaicProcessor
+
+# ディスク上に展開して処理する画像の大きさ（メガピクセル）
+DEFAULT_TILE_THRESHOLD = 50
+
+
+def _init_worker():
+    """ワーカープロセスの初期化（OpenCV内部のスレッドとプロセスプールの競合を防ぐ）"""
+    import cv2
+    cv2.setNumThreads(1)
+
+
+def build_region_recipe(processor, image_path, image_shape, regions, size=None, multiplier=1):
+    """指定範囲とメタデータから操作レシピを作成"""
+    processor.load_reference_point(image_path)
+    if processor.current_mosaic_size:
+        mode, base_size, multiplier = "manual_custom", processor.current_mosaic_size, 1
+    elif size:
+        mode, base_size = "manual_custom", size
+    else:
+        mode, base_size = "manual_fanza", processor.calculate_fanza_mosaic_size(image_shape)
+
+    strokes = []
+    for rect in regions:
+        anchor = processor.ensure_reference_point(rect[0], rect[1], base_size * multiplier)
+        strokes.append(processor.make_stroke(mode, base_size, multiplier, rect, None, anchor))
+    return processor.build_recipe(strokes, image_shape, image_path)
+
+
+def process_image(job):
+    """1枚分の処理（ワーカープロセスで実行）
+
+    (元画像パス, 出力パス, 処理時間, エラー) を返す。
+    """
+    image_path = job["image_path"]
+    start = time.perf_counter()
+    try:
+        with _open_image(image_path, job["tile_threshold"]) as (image, tiled):
+            output_path, error = _apply_and_save(job, image, tiled)
+        if error:
+            return image_path, None, time.perf_counter() - start, error
+
+        # オリジナル画像の移動
+        original_dest = os.path.join(job["original_folder"], os.path.basename(image_path))
+        if not os.path.exists(original_dest):
+            os.rename(image_path, original_dest)
+
+        return image_path, output_path, time.perf_counter() - start, None
+    except Exception as e:
+        return image_path, None, time.perf_counter() - start, str(e)
+
+
+@contextmanager
+def _open_image(image_path, tile_threshold):
+    """画像を開く（閾値を超える大きな画像はディスク上に展開）
+
+    (画像, ディスク上に展開したかどうか) を返す。ディスク上に展開する場合は
+    メモリ使用量が画像サイズに依存しないため、Pillow の展開爆弾の検査の上限を超える
+    画像も処理する（ワーカープロセスは画像を1枚ずつ扱うため、上限の変更は他に影響しない）。
+    """
+    with allow_large_images():
+        width, height = image_size(image_path)
+    if tile_threshold and width * height > tile_threshold * 1_000_000:
+        with decoded_memmap(image_path, os.path.dirname(image_path)) as image:
+            yield image, True
+    else:
+        yield decode_image(image_path), False
+
+
+def _claim_output_path(folder, base, ext):
+    """folder 内で未使用の {base}_{番号}.{ext} を空のファイルとして作成し、そのパスを返す
+
+    新規作成として開くため、複数のワーカーが同時に呼んでも同じ名前を返さない。
+    """
+    idx = 1
+    while True:
+        path = os.path.join(folder, f"{base}_{idx}.{ext}")
+        try:
+            with open(path, "xb"):
+                return path
+        except FileExistsError:
+            idx += 1
+
+
+def _apply_and_save(job, image, tiled):
+    """レシピを適用して出力を保存
+
+    (出力パス, エラー) を返す。出力ファイル名は書き出す直前に決めるため、
+    レシピが無い画像や読み込めなかった画像の分の番号は空かない。
+    """
+    image_path = job["image_path"]
+    processor = MosaicProcessor()
+
+    recipe = job["recipe"]
+    if recipe is None:
+        recipe = processor.load_recipe(image_path)
+    if recipe is None and job["regions"]:
+        recipe = build_region_recipe(
+            processor, image_path, image.shape, job["regions"], job["size"], job["multiplier"]
+        )
+    if recipe is None:
+        return None, "レシピがありません"
+
+    # 読み込んだ画像（またはディスク上の展開先）は作業用なので直接書き換える
+    result, _ = processor.replay_recipe(image, recipe, in_place=True)
+
+    # 出力（操作レシピはPNGならチャンク、それ以外はサイドカー）
+    ext = job["format"]
+    pnginfo = processor.recipe_pnginfo(recipe) if ext == "png" else None
+    output_path = _claim_output_path(job["completed_folder"], output_base_name(image_path), ext)
+    try:
+        if tiled:
+            encode_image_streaming(result, output_path, ext, pnginfo)
+        else:
+            encode_image(result, output_path, ext, pnginfo)
+        if ext != "png":
+            processor.save_recipe(recipe, output_path)
+    except Exception:
+        # 書き出しに失敗した場合は番号を空けないよう作成したファイルを削除する
+        os.remove(output_path)
+        raise
+    return output_path, None
+
+
+def plan_jobs(folder, ext, recipe=None, regions=None, size=None, multiplier=1,
+              tile_threshold=DEFAULT_TILE_THRESHOLD):
+    """フォルダ内の画像ごとにジョブを作成（出力ファイル名は各ワーカーが書き出す直前に決定）"""
+    completed_folder, original_folder = output_folders(folder)
+    jobs = []
+    for image_path in list_folder_images(folder):
+        jobs.append({
+            "image_path": image_path,
+            "completed_folder": completed_folder,
+            "original_folder": original_folder,
+            "format": ext,
+            "recipe": recipe,
+            "regions": regions or [],
+            "size": size,
+            "multiplier": multiplier,
+            "tile_threshold": tile_threshold,
+        })
+    return jobs
+
+
+def run_batch(jobs, workers=None):
+    """ジョブをプロセスプールで実行し、結果の一覧と経過時間を返す"""
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        futures = [executor.submit(process_image, job) for job in jobs]
+        for future in as_completed(futures):
+            image_path, output_path, elapsed, error = future.result()
+            if error:
+                print(f"スキップ: {os.path.basename(image_path)} ({error})")
+            else:
+                print(f"完了: {os.path.basename(image_path)} -> {os.path.basename(output_path)} ({elapsed:.2f}秒)")
+            results.append((image_path, output_path, elapsed, error))
+    return results, time.perf_counter() - start
+
+
+def _parse_region(text):
+    """x1,y1,x2,y2 形式の範囲を解析"""
+    values = [int(v) for v in text.split(",")]
+    if len(values) != 4:
+        raise argparse.ArgumentTypeError("範囲は x1,y1,x2,y2 の形式で指定してください")
+    x1, y1, x2, y2 = values
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def retag_folder(folder):
+    """フォルダ内の画像のメタデータを書き換え（基準点・モザイクサイズは各画像のものを引き継ぐ）"""
+    processor = MosaicProcessor()
+    paths = [p for p in list_folder_images(folder) if p.lower().endswith((".png", ".jpg", ".jpeg"))]
+    start = time.perf_counter()
+    done = 0
+    for path in paths:
+        processor.load_reference_point(path)
+        if processor.retag_metadata(path):
+            done += 1
+            print(f"書き換え: {os.path.basename(path)}")
+    elapsed = time.perf_counter() - start
+    print(f"書き換え枚数: {done}/{len(paths)}  経過時間: {elapsed:.2f}秒")
+    return done, len(paths)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="フォルダ内の画像に操作レシピを一括適用")
+    parser.add_argument("folder", help="処理する画像フォルダ")
+    parser.add_argument("--recipe", help="全画像に適用する操作レシピ（JSON）")
+    parser.add_argument("--region", type=_parse_region, action="append",
+                        help="モザイクを適用する範囲 x1,y1,x2,y2（複数指定可）")
+    parser.add_argument("--size", type=int, help="基本モザイクサイズ（省略時はメタデータまたはFANZA仕様）")
+    parser.add_argument("--multiplier", type=int, default=1, choices=[1, 2, 3, 4], help="モザイク倍率")
+    parser.add_argument("--format", default="png", choices=["png", "jpg"], help="出力形式")
+    parser.add_argument("--workers", type=int, default=None, help="プロセス数（省略時はCPUコア数）")
+    parser.add_argument("--tile-threshold", type=float, default=DEFAULT_TILE_THRESHOLD,
+                        help="これを超える画像（メガピクセル）はディスク上に展開して処理（0で無効）")
+    parser.add_argument("--retag", action="store_true",
+                        help="モザイク処理は行わず、処理済み画像のメタデータだけを書き換える")
+    args = parser.parse_args(argv)
+
+    if args.retag:
+        done, total = retag_folder(args.folder)
+        return 0 if done == total else 1
+
+    recipe = None
+    if args.recipe:
+        with open(args.recipe, encoding="utf-8") as f:
+            recipe = json.load(f)
+
+    jobs = plan_jobs(args.folder, args.format, recipe, args.region, args.size, args.multiplier,
+                     args.tile_threshold)
+    if not jobs:
+        print("処理する画像がありません")
+        return 0
+
+    results, elapsed = run_batch(jobs, args.workers)
+    done = sum(1 for r in results if r[3] is None)
+    print(f"処理枚数: {done}/{len(jobs)}  経過時間: {elapsed:.2f}秒  "
+          f"スループット: {done / elapsed:.2f}枚/秒")
+    return 0 if done == len(jobs) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
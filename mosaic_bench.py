@@ -0,0 +1,265 @@
+"""
+モザイク処理のベンチマーク（コマンドライン）
+
+合成画像（1〜50メガピクセル）に対して、モザイク処理の各操作と保存処理の時間を計測し、
+結果をJSONで出力する。compare で2つの結果を比較し、変更前後で速くなったか
+遅くなったかを確認できる。
+
+計測する操作:
+- apply_mosaic        : 指定範囲へのモザイク適用
+- process_click       : クリック位置へのモザイク適用
+- process_masked_area : 処理範囲を設定した状態でのドラッグ
+- drag_release        : on_canvas_release と同じ処理（基準点の設定、処理済みブロックの
+                        記録付きの一括処理、ストローク記録、変更範囲の履歴保存）
+- save_with_metadata  : 名前を付けて保存（PNG、メタデータ・操作レシピ付き）
+- quick_save_<保存形式> : クイック保存のエンコード（保存形式ごと）
+
+使用例:
+    python mosaic_bench.py run --output before.json
+    python mosaic_bench.py run --megapixels 1 4 --output after.json
+    python mosaic_bench.py compare before.json after.json --threshold 10
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from mosaic_core import SAVE_PROFILES, encode_image, encode_options
+from mosaic_history import ImageHistory, take_snapshot
+from mosaic_processor import BlockCoverage, MosaicProcessor
+
+DEFAULT_MEGAPIXELS = [1, 4, 12, 24, 50]
+DEFAULT_SIZES = [8, 16, 32]
+# ドラッグ範囲（画像の面積に対する割合）
+DEFAULT_AREAS = [0.05, 0.25, 1.0]
+
+
+def make_image(megapixels, seed=0):
+    """3:2 の合成画像（グラデーション＋ノイズ、BGR）を作成"""
+    height = int((megapixels * 1_000_000 / 1.5) ** 0.5)
+    width = int(height * 1.5)
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 239, height, dtype=np.float32)[:, None]
+    x = np.linspace(0, 239, width, dtype=np.float32)[None, :]
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:, :, 0] = (x * 0.7 + y * 0.3).astype(np.uint8)
+    image[:, :, 1] = (x * 0.2 + y * 0.8).astype(np.uint8)
+    image[:, :, 2] = ((x + y) * 0.5).astype(np.uint8)
+    image += rng.integers(0, 16, image.shape, dtype=np.uint8)
+    return image
+
+
+def centre_rect(image, area):
+    """画像中央の、面積が area（割合）の範囲を返す"""
+    height, width = image.shape[:2]
+    scale = area ** 0.5
+    w, h = max(1, int(width * scale)), max(1, int(height * scale))
+    x1, y1 = (width - w) // 2, (height - h) // 2
+    return x1, y1, x1 + w, y1 + h
+
+
+def measure(func, repeat):
+    """func を repeat 回実行し、各回の時間（ミリ秒）を返す
+
+    func は計測ごとの準備処理を行い、計測対象の処理を返す。
+    """
+    times = []
+    for _ in range(repeat):
+        target = func()
+        start = time.perf_counter()
+        target()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def drag_release(processor, image, rect, mosaic_size, history):
+    """on_canvas_release（処理範囲なし）と同じ処理"""
+    origin = processor.ensure_reference_point(rect[0], rect[1], mosaic_size)
+    snapshot = take_snapshot(image, processor.region_bounds(image.shape, rect, mosaic_size, origin))
+    image, dirty = processor.process_region(image, rect, mosaic_size, origin=origin, coverage=processor.coverage)
+    stroke = processor.make_stroke("manual_custom", mosaic_size, 1, rect, None, origin)
+    history.push(image, dirty, snapshot, ([stroke], mosaic_size))
+    return image
+
+
+def operator_cases(image, sizes, areas):
+    """モザイク処理の計測項目を (名前, パラメータ, 準備処理) で返す"""
+    processor = MosaicProcessor()
+    height, width = image.shape[:2]
+    for size in sizes:
+        yield "process_click", {"size": size}, lambda size=size: (
+            lambda: processor.process_click(image, width // 2, height // 2, "manual_custom", size)
+        )
+        for area in areas:
+            rect = centre_rect(image, area)
+            yield "apply_mosaic", {"size": size, "area": area}, lambda rect=rect, size=size: (
+                lambda: processor.apply_mosaic(image, *rect, size)
+            )
+
+            # 処理範囲はドラッグ範囲の左上4分の3
+            x1, y1, x2, y2 = rect
+            mask = (x1, y1, x1 + (x2 - x1) * 3 // 4, y1 + (y2 - y1) * 3 // 4)
+            yield "process_masked_area", {"size": size, "area": area}, lambda rect=rect, mask=mask, size=size: (
+                lambda: processor.process_masked_area(
+                    image, mask, rect, "manual_custom", size, origin=rect[:2], coverage=BlockCoverage()
+                )
+            )
+
+            def prepare_drag(rect=rect, size=size):
+                # 基準点と処理済みブロックの記録は毎回リセットする（新しい画像へのドラッグ）
+                processor.reference_point = None
+                processor.coverage.clear()
+                return lambda: drag_release(processor, image, rect, size, ImageHistory())
+
+            yield "drag_release", {"size": size, "area": area}, prepare_drag
+
+
+def encode_cases(image, folder):
+    """保存処理の計測項目を (名前, パラメータ, 準備処理) で返す"""
+    processor = MosaicProcessor()
+    processor.reference_point = (0, 0)
+    processor.current_mosaic_size = 16
+    rect = centre_rect(image, 0.25)
+    recipe = processor.build_recipe(
+        [processor.make_stroke("manual_custom", 16, 1, rect, None, (0, 0))], image.shape
+    )
+    png_path = os.path.join(folder, "bench.png")
+
+    yield "save_with_metadata", {}, lambda: (
+        lambda: processor.save_with_metadata(image, png_path, recipe)
+    )
+    for name, profile in SAVE_PROFILES.items():
+        ext = profile["ext"]
+        path = os.path.join(folder, f"bench_{name}.{ext}")
+        pnginfo = processor.recipe_pnginfo(recipe) if ext == "png" else None
+        yield f"quick_save_{name}", {}, lambda path=path, ext=ext, pnginfo=pnginfo, profile=profile: (
+            lambda: encode_image(image, path, ext, pnginfo, **encode_options(profile))
+        )
+
+
+def case_key(result):
+    """比較用の項目名（例: apply_mosaic/24MP/size16/area25%）"""
+    parts = [result["name"], f"{result['megapixels']}MP"]
+    if "size" in result:
+        parts.append(f"size{result['size']}")
+    if "area" in result:
+        parts.append(f"area{result['area'] * 100:g}%")
+    return "/".join(parts)
+
+
+def run(megapixels, sizes, areas, repeat, encode_repeat, skip_encode=False):
+    """全項目を計測し、結果（JSONに変換できる辞書）を返す"""
+    import cv2
+    import PIL
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for mp in megapixels:
+            image = make_image(mp)
+            # モザイク処理は画像を書き換えるため、保存処理とは別の画像で計測する
+            cases = [(case, repeat) for case in operator_cases(image.copy(), sizes, areas)]
+            if not skip_encode:
+                cases += [(case, encode_repeat) for case in encode_cases(image, folder)]
+            for (name, params, prepare), n in cases:
+                times = measure(prepare, n)
+                result = {
+                    "name": name,
+                    "megapixels": mp,
+                    **params,
+                    "shape": list(image.shape),
+                    "repeat": n,
+                    "min_ms": min(times),
+                    "median_ms": statistics.median(times),
+                    "mean_ms": statistics.fmean(times),
+                }
+                result["key"] = case_key(result)
+                results.append(result)
+                print(f"{result['key']:<45} 最小 {result['min_ms']:10.2f} ms  中央値 {result['median_ms']:10.2f} ms")
+
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "pillow": PIL.__version__,
+        },
+        "results": results,
+    }
+
+
+def compare(base, new, threshold):
+    """2つの結果を最小値で比較し、threshold（%）を超えて遅くなった項目の数を返す
+
+    最小値は他の処理の割り込みの影響を受けにくいため、比較にはこれを使う。
+    """
+    base_results = {r["key"]: r for r in base["results"]}
+    regressions = 0
+    print(f"{'項目':<45} {'変更前(ms)':>12} {'変更後(ms)':>12} {'比率':>8}")
+    for result in new["results"]:
+        before = base_results.get(result["key"])
+        if before is None:
+            continue
+        ratio = result["min_ms"] / before["min_ms"] if before["min_ms"] else float("inf")
+        change = (ratio - 1) * 100
+        if change > threshold:
+            mark = "遅くなった"
+            regressions += 1
+        elif change < -threshold:
+            mark = "速くなった"
+        else:
+            mark = ""
+        print(f"{result['key']:<45} {before['min_ms']:12.2f} {result['min_ms']:12.2f} {ratio:7.2f}x  {mark}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="モザイク処理と保存処理のベンチマーク")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="計測してJSONに出力")
+    run_parser.add_argument("--megapixels", type=float, nargs="+", default=DEFAULT_MEGAPIXELS,
+                            help="合成画像の大きさ（メガピクセル、複数指定可）")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="モザイクサイズ")
+    run_parser.add_argument("--areas", type=float, nargs="+", default=DEFAULT_AREAS,
+                            help="ドラッグ範囲（画像の面積に対する割合）")
+    run_parser.add_argument("--repeat", type=int, default=5, help="モザイク処理の計測回数")
+    run_parser.add_argument("--encode-repeat", type=int, default=2, help="保存処理の計測回数")
+    run_parser.add_argument("--skip-encode", action="store_true", help="保存処理を計測しない")
+    run_parser.add_argument("--output", default="bench.json", help="結果の出力先（JSON）")
+
+    compare_parser = subparsers.add_parser("compare", help="2つの計測結果を比較")
+    compare_parser.add_argument("base", help="変更前の結果（JSON）")
+    compare_parser.add_argument("new", help="変更後の結果（JSON）")
+    compare_parser.add_argument("--threshold", type=float, default=10.0,
+                                help="遅くなったと判定する変化率（%%）")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        megapixels = [int(mp) if float(mp).is_integer() else mp for mp in args.megapixels]
+        report = run(megapixels, args.sizes, args.areas, args.repeat, args.encode_repeat, args.skip_encode)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+        return 0
+
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    regressions = compare(base, new, args.threshold)
+    print(f"遅くなった項目: {regressions}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,949 @@
+"""
+モザイク処理ツールのコア機能（Tk非依存）
+
+画像の読み込み・書き出し、出力ファイル名の決定、フォルダ内の画像一覧を扱う。
+GUIを持たないバッチ処理やテストからも利用できるよう tkinter には依存せず、
+cv2 / PIL / natsort などの重いモジュールは使用時に読み込む。
+
+非常に大きな画像は、Pillow のデコーダから直接ディスク上の一時ファイル（np.memmap）に
+展開し、PNGはストリップごとに圧縮して書き出す。読み書きの途中で一時ファイルのページを
+手放すことで、メモリ使用量を画像サイズではなくストリップの大きさとストロークの範囲に抑える。
+"""
+
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+
+# 対応する画像形式
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+# クイック保存・モザイク不要時の出力先フォルダ名
+COMPLETED_FOLDER = "_Completed"
+ORIGINAL_FOLDER = "_Original"
+
+# Linux の FICLONE（ファイルのデータブロックを共有する複製、btrfs / XFS など）
+_FICLONE = 0x40049409
+
+# 大きな画像をストリップ単位で扱う際の1ストリップの行数
+STRIP_ROWS = 256
+
+# ディスク上に展開した画像を読み書きする際、圧縮データがこの量に達するごとにプロセスのページを手放す
+RELEASE_BYTES = 1024 * 1024
+
+# PNGをストリップごとに書き出す際、1回にフィルタを適用する行データの量の目安
+PNG_FILTER_BYTES = 1024 * 1024
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_TEXT_CHUNKS = (b"tEXt", b"zTXt", b"iTXt")
+
+# JPEGのコメント（COM）に書き込むメタデータの識別子
+JPEG_METADATA_PREFIX = b"MosaicMetadata\0"
+
+# TIFFの画像の説明（ImageDescription）タグ。メタデータをUTF-8のJSONで書き込む
+TIFF_DESCRIPTION_TAG = 270
+TIFF_SIGNATURES = (b"II*\0", b"MM\0*")
+
+# プレビュー用に縮小して読み込む際の長辺の目安（キャンバスより十分大きく）
+PREVIEW_MAX_SIZE = 1600
+
+# 保存形式ごとの設定（PNGは圧縮レベル、JPEGは品質）
+# 圧縮レベルが低いほど保存は速く、ファイルは大きくなる
+SAVE_PROFILES = {
+    "png_fast": {"label": "PNG(高速)", "ext": "png", "compress_level": 1},
+    "png": {"label": "PNG", "ext": "png", "compress_level": 6},
+    "png_archive": {"label": "PNG(最小)", "ext": "png", "compress_level": 9},
+    "jpg": {"label": "JPEG", "ext": "jpg", "quality": 95},
+}
+DEFAULT_SAVE_PROFILE = "png"
+
+
+def is_image_file(name):
+    """対応する画像形式のファイル名かどうか"""
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def normalize_path(path):
+    """パスの比較用に正規化"""
+    return os.path.normcase(os.path.normpath(path))
+
+
+def list_folder_images(folder_path):
+    """フォルダ内の画像ファイルを自然順に並べた絶対パスのリストを返す"""
+    from natsort import natsorted
+
+    return natsorted([
+        os.path.abspath(os.path.join(folder_path, f))
+        for f in os.listdir(folder_path)
+        if is_image_file(f)
+    ])
+
+
+def find_image_index(images, path):
+    """画像リスト内のパスの位置を返す（無い場合は None）"""
+    norm_path = normalize_path(path)
+    for i, image_path in enumerate(images):
+        if normalize_path(image_path) == norm_path:
+            return i
+    return None
+
+
+def _folder_stamp(folder):
+    """フォルダの更新を検出するための更新時刻（フォルダが無い場合は None）"""
+    try:
+        return os.stat(folder).st_mtime_ns
+    except OSError:
+        return None
+
+
+class FolderIndex:
+    """フォルダ内の画像の一覧（自然順）と、パスから位置への辞書
+
+    一覧はフォルダの更新時刻が変わった場合（または notify が呼ばれた場合）だけ
+    読み込み直す。クイック保存などで自分で移動した画像は remove で一覧から直接外し、
+    フォルダ全体を読み込み直さない。
+    """
+
+    def __init__(self, folder):
+        self.folder = os.path.abspath(folder)
+        self.images = []
+        self.positions = {}  # 正規化したパス -> 一覧内の位置
+        self.stamp = None
+        self.changed = True
+        self.refresh()
+
+    def matches(self, folder):
+        """同じフォルダの一覧かどうか"""
+        return normalize_path(folder) == normalize_path(self.folder)
+
+    def notify(self):
+        """フォルダの変更を通知（次の refresh で必ず読み込み直す。監視からの通知用）"""
+        self.changed = True
+
+    def refresh(self):
+        """フォルダが更新されていれば一覧を読み込み直す（読み込み直した場合は True）"""
+        stamp = _folder_stamp(self.folder)
+        if not self.changed and stamp == self.stamp:
+            return False
+        # 一覧は同じリストを書き換える（参照している側にも反映される）
+        self.images[:] = list_folder_images(self.folder) if stamp is not None else []
+        self.positions = {normalize_path(path): i for i, path in enumerate(self.images)}
+        self.stamp = stamp
+        self.changed = False
+        return True
+
+    def index(self, path):
+        """画像の位置（一覧に無い場合は None）"""
+        return self.positions.get(normalize_path(path))
+
+    def remove(self, path):
+        """移動した画像を一覧から外す
+
+        一覧にあった場合は、フォルダの更新時刻を移動後のものとして記録し直し、
+        自分で行った移動では読み込み直さないようにする（別のフォルダの画像など、
+        一覧に無い場合は何もしない）。
+        """
+        i = self.positions.pop(normalize_path(path), None)
+        if i is None:
+            return None
+        del self.images[i]
+        for image_path in self.images[i:]:
+            self.positions[normalize_path(image_path)] -= 1
+        if not self.changed:
+            self.stamp = _folder_stamp(self.folder)
+        return i
+
+
+def output_folders(base_folder):
+    """出力先フォルダ (_Completed, _Original) を作成してパスを返す"""
+    completed_folder = os.path.join(base_folder, COMPLETED_FOLDER)
+    original_folder = os.path.join(base_folder, ORIGINAL_FOLDER)
+    os.makedirs(completed_folder, exist_ok=True)
+    os.makedirs(original_folder, exist_ok=True)
+    return completed_folder, original_folder
+
+
+def output_base_name(image_path):
+    """出力ファイル名のベース（元画像の拡張子を除いた名前）"""
+    if image_path:
+        return os.path.splitext(os.path.basename(image_path))[0]
+    return "output"
+
+
+def next_output_path(folder, base, ext):
+    """folder 内で未使用の {base}_{番号}.{ext} のパスを返す"""
+    idx = 1
+    while True:
+        candidate_path = os.path.join(folder, f"{base}_{idx}.{ext}")
+        if not os.path.exists(candidate_path):
+            return candidate_path
+        idx += 1
+
+
+def _reflink(src, dst):
+    """src のデータブロックを共有する複製（リフリンク）を dst に作成（非対応の場合は OSError）"""
+    import fcntl
+
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src, dst):
+    """src を dst に複製（データをコピーしない方法を優先）
+
+    同じファイルシステム上であれば、リフリンク（Linux、対応するファイルシステムのみ）、
+    ハードリンクの順に試し、どちらもできない場合だけデータをコピーする。
+    使用した方法（"reflink" / "hardlink" / "copy"）を返す。
+    dst が既に存在する場合はどの方法でも上書きせず、FileExistsError を送出する。
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            _reflink(src, dst)
+            return "reflink"
+        except FileExistsError:
+            raise
+        except OSError:
+            pass
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except FileExistsError:
+        raise
+    except OSError:
+        pass
+    # コピーも dst を新規作成として開き、リンクを試した後に作られたファイルも上書きしない
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return "copy"
+
+
+def _split_output_name(name):
+    """{base}_{番号}.{ext} 形式のファイル名を (base, ext, 番号) に分解（形式が違う場合は None）"""
+    stem, dot, ext = name.rpartition(".")
+    base, sep, idx = stem.rpartition("_")
+    if not dot or not sep or not idx.isdigit():
+        return None
+    return base, ext, int(idx)
+
+
+class _NameIndex:
+    """1つの (base, ext) について使用済みの番号と、未使用の最小の番号"""
+
+    __slots__ = ("used", "next")
+
+    def __init__(self):
+        self.used = set()
+        self.next = 1
+
+    def allocate(self):
+        while self.next in self.used:
+            self.next += 1
+        return self.next
+
+
+class OutputNameAllocator:
+    """出力先フォルダごとの {base}_{番号}.{ext} の割り当て
+
+    フォルダ内のファイル名は最初に1回だけ os.scandir で読み込み、以後は
+    割り当てた名前を記録して更新する。番号ごとに存在を確認するループは行わず、
+    割り当て時に候補の1ファイルだけを確認する（他のプログラムが作成した場合に備える）。
+    割り当てはロックで保護し、同時に保存しても同じ名前を返さない。
+    """
+
+    def __init__(self):
+        self.folders = {}  # 正規化したフォルダ -> {(base, ext): _NameIndex}
+        self.lock = threading.Lock()
+
+    def _folder(self, folder):
+        key = normalize_path(folder)
+        names = self.folders.get(key)
+        if names is None:
+            names = {}
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        parts = _split_output_name(entry.name)
+                        if parts is not None:
+                            base, ext, idx = parts
+                            names.setdefault(self._key(base, ext), _NameIndex()).used.add(idx)
+            except FileNotFoundError:
+                pass
+            self.folders[key] = names
+        return names
+
+    @staticmethod
+    def _key(base, ext):
+        return os.path.normcase(base), os.path.normcase(ext)
+
+    def _allocate(self, folder, base, ext):
+        index = self._folder(folder).setdefault(self._key(base, ext), _NameIndex())
+        while True:
+            idx = index.allocate()
+            path = os.path.join(folder, f"{base}_{idx}.{ext}")
+            if not os.path.exists(path):
+                return index, idx, path
+            index.used.add(idx)
+
+    def peek(self, folder, base, ext):
+        """次に割り当てる名前のパス（予約はしない）"""
+        with self.lock:
+            return self._allocate(folder, base, ext)[2]
+
+    def reserve(self, folder, base, ext):
+        """未使用の名前を予約してパスを返す"""
+        with self.lock:
+            index, idx, path = self._allocate(folder, base, ext)
+            index.used.add(idx)
+            return path
+
+    def release(self, path):
+        """保存に失敗した場合などに、予約した名前を解放"""
+        folder, name = os.path.split(path)
+        parts = _split_output_name(name)
+        if parts is None:
+            return
+        base, ext, idx = parts
+        with self.lock:
+            index = self.folders.get(normalize_path(folder), {}).get(self._key(base, ext))
+            if index is not None and not os.path.exists(path):
+                index.used.discard(idx)
+                index.next = min(index.next, idx)
+
+    def invalidate(self, folder=None):
+        """フォルダの記録を破棄（次の割り当て時に読み込み直す）"""
+        with self.lock:
+            if folder is None:
+                self.folders.clear()
+            else:
+                self.folders.pop(normalize_path(folder), None)
+
+
+def _decode_into(pil_img, out, strip_rows=STRIP_ROWS):
+    """デコードした画像をストリップごとにBGRへ変換しながら out に書き込む"""
+    import cv2
+    import numpy as np
+
+    width, height = pil_img.size
+    for y in range(0, height, strip_rows):
+        strip = pil_img.crop((0, y, width, min(height, y + strip_rows)))
+        if strip.mode != "RGB":
+            strip = strip.convert("RGB")
+        cv2.cvtColor(np.asarray(strip), cv2.COLOR_RGB2BGR, dst=out[y:y + strip.height])
+
+
+def decode_image(path):
+    """画像ファイルを読み込み、OpenCV形式（BGR）の配列で返す
+
+    結果の配列は1回だけ確保し、変換用の一時コピーはストリップ単位に抑える。
+    """
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(path) as pil_img:
+        width, height = pil_img.size
+        image = np.empty((height, width, 3), dtype=np.uint8)
+        _decode_into(pil_img, image)
+    return image
+
+
+def image_size(path):
+    """画像ファイルのヘッダから (幅, 高さ) を取得（デコードしない）"""
+    from PIL import Image
+
+    with Image.open(path) as pil_img:
+        return pil_img.size
+
+
+def decode_image_reduced(path, max_size=PREVIEW_MAX_SIZE):
+    """プレビュー用に、長辺が max_size 以上の範囲でなるべく小さく読み込む（BGR）
+
+    JPEGはデコード時のDCTスケーリング（draft）で 1/2・1/4・1/8 に縮小し、
+    それ以外の形式（や、まだ大きすぎる場合）は Image.reduce で整数分の1に縮小する。
+    """
+    import math
+
+    import numpy as np
+    from PIL import Image
+
+    with Image.open(path) as pil_img:
+        width, height = pil_img.size
+        scale = min(1.0, max_size / max(width, height))
+        target = (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale)))
+        if pil_img.format == "JPEG":
+            pil_img.draft("RGB", target)
+        if pil_img.mode not in ("L", "RGB", "RGBA"):
+            pil_img = pil_img.convert("RGB")
+        factor = min(pil_img.width // target[0], pil_img.height // target[1])
+        if factor >= 2:
+            pil_img = pil_img.reduce(factor)
+        image = np.empty((pil_img.height, pil_img.width, 3), dtype=np.uint8)
+        _decode_into(pil_img, image)
+    return image
+
+
+def share_image(image):
+    """画像を共有用に読み取り専用にして返す（コピーしない）
+
+    共有した画像を書き換える側は、writable_image で初めてコピーを作る（コピーオンライト）。
+    読み取り専用のため、共有中の画像を誤って直接書き換えると例外になる。
+    """
+    if image is not None:
+        image.flags.writeable = False
+    return image
+
+
+def writable_image(image):
+    """書き換え可能な画像を返す（共有中の読み取り専用画像ならここでコピー）"""
+    if image is None or image.flags.writeable:
+        return image
+    return image.copy()
+
+
+def to_bgr_uint8(img):
+    """保存用に3チャンネル・8bitのBGR画像に変換"""
+    import cv2
+    import numpy as np
+
+    if len(img.shape) == 3 and img.shape[2] == 4:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    if img.dtype != np.uint8:
+        img = img.astype(np.uint8)
+    if len(img.shape) == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    return img
+
+
+def save_profile(name):
+    """保存形式の設定を取得（未知の名前は拡張子として扱う）"""
+    return SAVE_PROFILES.get(name, {"label": name, "ext": name})
+
+
+def encode_options(profile):
+    """保存形式の設定から encode_image に渡す引数を取り出す"""
+    return {key: profile[key] for key in ("compress_level", "quality") if key in profile}
+
+
+def _insert_png_chunks(data, pnginfo):
+    """エンコード済みのPNGに pnginfo（PngInfo）のテキストチャンクを挿入"""
+    chunks = pnginfo.chunks if pnginfo is not None else []
+    if not chunks:
+        return data
+    before = b"".join(_png_chunk(tag, chunk) for tag, chunk, *after_idat in chunks if not any(after_idat))
+    after = b"".join(_png_chunk(tag, chunk) for tag, chunk, *after_idat in chunks if any(after_idat))
+    # IHDR（シグネチャの直後、25バイト）の後と、IEND（末尾12バイト）の前に挿入
+    ihdr_end = len(PNG_SIGNATURE) + 25
+    return data[:ihdr_end] + before + data[ihdr_end:-12] + after + data[-12:]
+
+
+def encode_image(img, path, ext, pnginfo=None, compress_level=6, quality=95):
+    """BGR画像を指定形式で保存
+
+    PNG/JPEGはOpenCVでBGRのまま（RGBへ変換したコピーを作らずに）エンコードし、
+    PNGには pnginfo のテキストチャンクを挿入する。書き込みはPythonで行うため、
+    日本語を含むパスにも保存できる。
+    """
+    import cv2
+
+    img = to_bgr_uint8(img)
+    if ext == "png":
+        ok, buf = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, int(compress_level)])
+        data = _insert_png_chunks(buf.tobytes(), pnginfo) if ok else None
+    elif ext in ["jpg", "jpeg"]:
+        ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+        data = buf if ok else None
+    else:
+        cv2.imwrite(path, img)
+        return
+    if data is None:
+        raise ValueError(f"画像のエンコードに失敗しました: {path}")
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@contextmanager
+def allow_large_images():
+    """Pillow の展開爆弾の検査（Image.MAX_IMAGE_PIXELS）を一時的に無効にする
+
+    画像をディスク上に展開して扱う（メモリ使用量が画像サイズに依存しない）場合に使う。
+    設定はプロセス全体に効くため、他のスレッドが画像を読み込んでいない状況でのみ使うこと。
+    """
+    from PIL import Image
+
+    limit = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        yield
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+
+def release_pages(img):
+    """np.memmap 上の画像について、プロセスが保持しているページを手放す
+
+    共有マッピングのため、書き込んだ内容はファイル（ページキャッシュ）に残り、
+    次に参照したときに読み直される。np.memmap 以外の配列では何もしない。
+    """
+    import mmap
+
+    mm = getattr(img, "_mmap", None)
+    if mm is not None and hasattr(mmap, "MADV_DONTNEED"):
+        mm.madvise(mmap.MADV_DONTNEED)
+
+
+def _decode_to_buffer(pil_img, out, release_bytes=RELEASE_BYTES):
+    """Pillow のデコーダの出力先を out（RGBX/RGBA の np.memmap）にして画像を展開
+
+    ImageFile.load と同じ手順でファイルを少しずつデコーダに渡すが、画像全体の
+    領域を確保する代わりに out に直接書き込む。読み込んだデータが release_bytes に
+    達するごとに out のページを手放すため、メモリ使用量は画像サイズに依存しない
+    （プログレッシブJPEGは libjpeg が係数を画像全体ぶん保持するため除く）。
+    """
+    from PIL import Image
+
+    width, height = pil_img.size
+    rawmode = "RGBX" if pil_img.mode == "RGB" else pil_img.mode
+    target = Image.frombuffer(pil_img.mode, (width, height), out, "raw", rawmode, 0, 1)
+    pil_img.im = target.im
+    pil_img.load_prepare()
+    read = getattr(pil_img, "load_read", pil_img.fp.read)
+    for tile in pil_img.tile:
+        decoder = Image._getdecoder(pil_img.mode, tile[0], tile[3], pil_img.decoderconfig)
+        try:
+            decoder.setimage(target.im, tile[1])
+            pil_img.fp.seek(tile[2])
+            data = b""
+            pending = 0
+            while True:
+                block = read(pil_img.decodermaxblock)
+                if not block:
+                    raise ValueError("画像データが途中で終わっています")
+                data += block
+                consumed, err = decoder.decode(data)
+                if consumed < 0:
+                    break
+                data = data[consumed:]
+                pending += len(block)
+                if pending >= release_bytes:
+                    release_pages(out)
+                    pending = 0
+        finally:
+            decoder.cleanup()
+        if err < 0:
+            raise ValueError(f"画像のデコードに失敗しました（エラーコード {err}）")
+    pil_img.im = None
+    release_pages(out)
+
+
+def _copy_to_buffer(pil_img, out, strip_rows=STRIP_ROWS):
+    """デコーダを直接使えない形式を、ストリップごとにRGBAへ変換して out に書き込む
+
+    Pillow は先頭のストリップを切り出す時点で画像全体を展開するため、この経路の
+    メモリ使用量は画像サイズに比例する。
+    """
+    import numpy as np
+
+    width, height = pil_img.size
+    for y in range(0, height, strip_rows):
+        strip = pil_img.crop((0, y, width, min(height, y + strip_rows))).convert("RGBA")
+        out[y:y + strip.height] = np.asarray(strip)
+        release_pages(out)
+
+
+@contextmanager
+def decoded_memmap(path, directory=None):
+    """画像をディスク上の一時ファイル（np.memmap）に展開し、BGRのビューとして返す
+
+    一時ファイルは1画素4バイト（Pillow の RGBX/RGBA と同じ並び）で、8bitのRGB/RGBAの
+    PNG・JPEGは Pillow のデコーダから直接書き込む。画像全体をメモリに展開しないため、
+    Pillow の展開爆弾の検査（MAX_IMAGE_PIXELS）を超える大きさでも読み込める。
+    返す配列は先頭3チャンネルを逆順にしたビュー（BGR）で、書き込みは一時ファイルに反映される。
+    終了時に一時ファイルを削除する。
+    """
+    import numpy as np
+    from PIL import Image
+
+    fd, memmap_path = tempfile.mkstemp(suffix=".rgbx", dir=directory)
+    os.close(fd)
+    buffer = None
+    try:
+        with allow_large_images(), Image.open(path) as pil_img:
+            width, height = pil_img.size
+            buffer = np.memmap(memmap_path, dtype=np.uint8, mode="w+", shape=(height, width, 4))
+            if (pil_img.format in ("PNG", "JPEG") and pil_img.mode in ("RGB", "RGBA")
+                    and not getattr(pil_img, "is_animated", False)):
+                _decode_to_buffer(pil_img, buffer)
+            else:
+                _copy_to_buffer(pil_img, buffer)
+        yield buffer[:, :, 2::-1]
+    finally:
+        if buffer is not None:
+            buffer._mmap.close()
+            del buffer
+        os.remove(memmap_path)
+
+
+def _rgbx_buffer(img):
+    """decoded_memmap が返すBGRのビューであれば、元の4チャンネルの np.memmap を返す"""
+    import numpy as np
+
+    base = img.base
+    if (isinstance(base, np.memmap) and base.ndim == 3 and base.shape[2] == 4
+            and img.shape == base.shape[:2] + (3,) and img.strides == base.strides[:2] + (-1,)
+            and img.__array_interface__["data"][0] == base.__array_interface__["data"][0] + 2):
+        return base
+    return None
+
+
+class _ReleasingWriter:
+    """書き込んだ量が一定に達するごとに、エンコード元の np.memmap のページを手放すファイル
+
+    fileno を持たないため、Pillow はエンコード結果を少しずつ write に渡す。
+    """
+
+    def __init__(self, f, source, release_bytes=RELEASE_BYTES):
+        self.f = f
+        self.source = source
+        self.release_bytes = release_bytes
+        self.pending = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.pending += len(data)
+        if self.pending >= self.release_bytes:
+            release_pages(self.source)
+            self.pending = 0
+        return len(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, *args):
+        return self.f.seek(*args)
+
+
+def _png_chunk(tag, data):
+    """PNGのチャンクを作成"""
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+
+def _paeth_filter(rows, prev_row):
+    """RGBの行データ（行数 x 幅*3）にPNGのPaethフィルタを適用
+
+    予測値はすべてフィルタ前の値から求まるため、ストリップ全体をまとめて計算できる。
+    """
+    import numpy as np
+
+    raw = rows.astype(np.int16)
+    up = np.vstack([prev_row[None, :].astype(np.int16), raw[:-1]])
+    left = np.zeros_like(raw)
+    left[:, 3:] = raw[:, :-3]
+    up_left = np.zeros_like(raw)
+    up_left[:, 3:] = up[:, :-3]
+
+    p = left + up - up_left
+    pa = np.abs(p - left)
+    pb = np.abs(p - up)
+    pc = np.abs(p - up_left)
+    pred = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+    return ((raw - pred) & 0xFF).astype(np.uint8)
+
+
+def encode_png_streaming(img, path, pnginfo=None, strip_rows=STRIP_ROWS, compress_level=6):
+    """BGR画像をストリップごとに圧縮しながらPNGとして書き出す
+
+    np.memmap 上の画像でも全体をメモリに読み込まずに保存できる。
+    フィルタの作業領域は1ストリップの数十倍になるため、幅の広い画像では
+    1ストリップが PNG_FILTER_BYTES 程度になるよう行数を減らす。
+    pnginfo（PngInfo）のテキストチャンクもそのまま書き込む。
+    """
+    import numpy as np
+
+    img = to_bgr_uint8(img)
+    height, width = img.shape[:2]
+    strip_rows = max(1, min(strip_rows, PNG_FILTER_BYTES // (width * 3)))
+    compressor = zlib.compressobj(compress_level)
+    prev_row = np.zeros(width * 3, dtype=np.uint8)
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        f.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        chunks = pnginfo.chunks if pnginfo is not None else []
+        for tag, data, *after_idat in chunks:
+            if not any(after_idat):
+                f.write(_png_chunk(tag, data))
+        for y in range(0, height, strip_rows):
+            rows = np.ascontiguousarray(img[y:y + strip_rows, :, ::-1]).reshape(-1, width * 3)
+            filtered = np.empty((rows.shape[0], width * 3 + 1), dtype=np.uint8)
+            filtered[:, 0] = 4  # Paeth
+            filtered[:, 1:] = _paeth_filter(rows, prev_row)
+            prev_row = rows[-1]
+            release_pages(img)
+            data = compressor.compress(filtered.tobytes())
+            if data:
+                f.write(_png_chunk(b"IDAT", data))
+        f.write(_png_chunk(b"IDAT", compressor.flush()))
+        for tag, data, *after_idat in chunks:
+            if any(after_idat):
+                f.write(_png_chunk(tag, data))
+        f.write(_png_chunk(b"IEND", b""))
+
+
+def encode_image_streaming(img, path, ext, pnginfo=None):
+    """大きな画像を全体のコピーを作らずに保存（PNGはストリップ圧縮、それ以外はOpenCV）
+
+    decoded_memmap で展開した画像のJPEGは、Pillow のエンコーダで一時ファイルから直接
+    書き出し、書き込みの途中でページを手放す。
+    """
+    import cv2
+
+    buffer = _rgbx_buffer(img) if ext in ["jpg", "jpeg"] else None
+    if ext == "png":
+        encode_png_streaming(img, path, pnginfo)
+    elif buffer is not None:
+        from PIL import Image
+
+        height, width = buffer.shape[:2]
+        pil_img = Image.frombuffer("RGB", (width, height), buffer, "raw", "RGBX", 0, 1)
+        with open(path, "wb") as f:
+            pil_img.save(_ReleasingWriter(f, buffer), "JPEG", quality=95)
+        release_pages(buffer)
+    elif ext in ["jpg", "jpeg"]:
+        cv2.imwrite(path, to_bgr_uint8(img), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    else:
+        cv2.imwrite(path, to_bgr_uint8(img))
+
+
+def _copy_bytes(src, dst, length, block=1024 * 1024):
+    """src から length バイトを dst にそのままコピー"""
+    while length > 0:
+        data = src.read(min(block, length))
+        if not data:
+            raise ValueError("ファイルが途中で終わっています")
+        dst.write(data)
+        length -= len(data)
+
+
+def _png_text_chunk(key, value):
+    """テキストチャンクを作成（Latin-1で表せない場合はUTF-8のiTXt）"""
+    try:
+        return _png_chunk(b"tEXt", key.encode("latin-1") + b"\0" + value.encode("latin-1"))
+    except UnicodeEncodeError:
+        # キーワード, 圧縮フラグ・方式, 言語タグ, 翻訳キーワード, 本文
+        return _png_chunk(b"iTXt", key.encode("latin-1") + b"\0\0\0" + b"\0" + b"\0" + value.encode("utf-8"))
+
+
+def _retag_png(src, dst, texts):
+    """PNGのテキストチャンクを置き換えて書き出す（画素データのチャンクはそのままコピー）"""
+    if src.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise ValueError("PNGファイルではありません")
+    dst.write(PNG_SIGNATURE)
+    new_chunks = b"".join(_png_text_chunk(key, value) for key, value in texts.items() if value is not None)
+    inserted = False
+    while True:
+        header = src.read(8)
+        if len(header) < 8:
+            raise ValueError("ファイルが途中で終わっています")
+        length, tag = struct.unpack(">I4s", header)
+        if tag in PNG_TEXT_CHUNKS:
+            data = src.read(length + 4)
+            # 置き換えるキーワードのチャンクは削除
+            if data.split(b"\0", 1)[0].decode("latin-1") in texts:
+                continue
+            dst.write(header + data)
+            continue
+        # IHDR の直後に新しいテキストチャンクを挿入
+        if not inserted and tag != b"IHDR":
+            dst.write(new_chunks)
+            inserted = True
+        dst.write(header)
+        _copy_bytes(src, dst, length + 4)
+        if tag == b"IEND":
+            return
+
+
+def _jpeg_header_segments(src):
+    """JPEGのスキャン開始までのセグメント (マーカー, 長さ, データ) を順に返す
+
+    最後にスキャン開始（またはデータを持たない）マーカーを (マーカー, None, None) として返す。
+    """
+    while True:
+        marker = src.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("JPEGのマーカーが不正です")
+        if marker[1] in (0x01, 0xD9, 0xDA) or 0xD0 <= marker[1] <= 0xD7:
+            yield marker, None, None
+            return
+        size = src.read(2)
+        yield marker, size, src.read(struct.unpack(">H", size)[0] - 2)
+
+
+def _jpeg_metadata(data):
+    """メタデータ用コメントの内容（辞書）、該当しない場合は None"""
+    if data.startswith(JPEG_METADATA_PREFIX):
+        return json.loads(data[len(JPEG_METADATA_PREFIX):].decode("utf-8"))
+    return None
+
+
+def read_image_metadata(path):
+    """retag_image でJPEG・TIFFに書き込んだメタデータを読み込む（ない場合は空の辞書）"""
+    with open(path, "rb") as src:
+        head = src.read(4)
+        src.seek(0)
+        if head in TIFF_SIGNATURES:
+            order, entries, _ = _read_tiff_ifd(src)
+            return _tiff_metadata(src, entries, order) or {}
+        if head[:2] != b"\xff\xd8":
+            return {}
+        src.seek(2)
+        for marker, _, data in _jpeg_header_segments(src):
+            if marker[1] == 0xFE and _jpeg_metadata(data) is not None:
+                return _jpeg_metadata(data)
+    return {}
+
+
+def _read_tiff_ifd(src):
+    """TIFFの先頭のIFDを読み込み、(バイト順, [(タグ, 型, 個数, 値の4バイト)], 次のIFDの位置) を返す"""
+    header = src.read(8)
+    order = "<" if header[:2] == b"II" else ">"
+    magic, offset = struct.unpack(order + "HI", header[2:8])
+    if magic != 42:
+        raise ValueError("BigTIFFには対応していません")
+    src.seek(offset)
+    (count,) = struct.unpack(order + "H", src.read(2))
+    entries = [struct.unpack(order + "HHI4s", src.read(12)) for _ in range(count)]
+    (next_ifd,) = struct.unpack(order + "I", src.read(4))
+    return order, entries, next_ifd
+
+
+def _tiff_metadata(src, entries, order):
+    """画像の説明タグに書き込んだメタデータ（辞書）、該当しない場合は None"""
+    for tag, type_, count, value in entries:
+        if tag != TIFF_DESCRIPTION_TAG or type_ != 2:
+            continue
+        if count <= 4:
+            data = value[:count]
+        else:
+            src.seek(struct.unpack(order + "I", value)[0])
+            data = src.read(count)
+        try:
+            values = json.loads(data.rstrip(b"\0").decode("utf-8"))
+        except ValueError:
+            return None
+        return values if isinstance(values, dict) else None
+    return None
+
+
+def _retag_tiff(src, dst, texts):
+    """TIFFの画像の説明タグを置き換えて書き出す（画素データはそのままコピー）
+
+    ファイル全体をコピーした後、説明を置き換えた先頭のIFDを末尾に追加し、
+    ヘッダの指す位置を書き換える（元のIFDは参照されなくなるだけで残る）。
+    """
+    order, entries, next_ifd = _read_tiff_ifd(src)
+    values = _tiff_metadata(src, entries, order) or {}
+    values.update(texts)
+    values = {key: value for key, value in values.items() if value is not None}
+    src.seek(0)
+    shutil.copyfileobj(src, dst)
+
+    entries = [entry for entry in entries if entry[0] != TIFF_DESCRIPTION_TAG]
+    if values:
+        payload = json.dumps(values, ensure_ascii=False).encode("utf-8") + b"\0"
+        # TIFFの値・IFDはワード境界（偶数の位置）から始める
+        if dst.tell() % 2:
+            dst.write(b"\0")
+        offset = dst.tell()
+        dst.write(payload)
+        entries.append((TIFF_DESCRIPTION_TAG, 2, len(payload), struct.pack(order + "I", offset)))
+        entries.sort(key=lambda entry: entry[0])
+    if dst.tell() % 2:
+        dst.write(b"\0")
+    ifd_offset = dst.tell()
+    dst.write(struct.pack(order + "H", len(entries)))
+    for entry in entries:
+        dst.write(struct.pack(order + "HHI4s", *entry))
+    dst.write(struct.pack(order + "I", next_ifd))
+    dst.seek(4)
+    dst.write(struct.pack(order + "I", ifd_offset))
+
+
+def _retag_jpeg(src, dst, texts):
+    """JPEGのメタデータ用コメント（COM）を置き換えて書き出す（圧縮データはそのままコピー）"""
+    if src.read(2) != b"\xff\xd8":
+        raise ValueError("JPEGファイルではありません")
+    dst.write(b"\xff\xd8")
+    # 既存のメタデータ用コメントを引き継ぎ、指定したキーを置き換える
+    values = {}
+    segments = []
+    for marker, size, data in _jpeg_header_segments(src):
+        if size is None:
+            # スキャン開始以降は最後にそのままコピー
+            break
+        if marker[1] == 0xFE and _jpeg_metadata(data) is not None:
+            values.update(_jpeg_metadata(data))
+            continue
+        segments.append(marker + size + data)
+
+    values.update(texts)
+    values = {key: value for key, value in values.items() if value is not None}
+    comment = None
+    if values:
+        payload = JPEG_METADATA_PREFIX + json.dumps(values, ensure_ascii=False).encode("utf-8")
+        if len(payload) > 0xFFFF - 2:
+            raise ValueError("メタデータが大きすぎます")
+        comment = b"\xff\xfe" + struct.pack(">H", len(payload) + 2) + payload
+
+    # APPn セグメント（JFIF・EXIFなど）の直後にコメントを挿入
+    for segment in segments:
+        if comment is not None and not 0xE0 <= segment[1] <= 0xEF:
+            dst.write(comment)
+            comment = None
+        dst.write(segment)
+    if comment is not None:
+        dst.write(comment)
+    dst.write(marker)
+    shutil.copyfileobj(src, dst)
+
+
+def retag_image(path, texts):
+    """画素データを再エンコードせずに、画像のメタデータだけを書き換える
+
+    texts はキーワードと値の辞書（値が None のキーは削除する）。PNGはテキストチャンクを、
+    JPEGはメタデータ用のコメント（COM、JSON）を、TIFFは先頭の画像の説明タグ（UTF-8のJSON）を
+    置き換える。EXIFなど他のチャンク・セグメント・タグと圧縮データはそのままコピーする。一時ファイルに書き出してから置き換えるため、
+    途中で失敗しても元のファイルは壊れない。
+    """
+    with open(path, "rb") as src:
+        head = src.read(len(PNG_SIGNATURE))
+        src.seek(0)
+        if head == PNG_SIGNATURE:
+            retag = _retag_png
+        elif head[:2] == b"\xff\xd8":
+            retag = _retag_jpeg
+        elif head[:4] in TIFF_SIGNATURES:
+            retag = _retag_tiff
+        else:
+            raise ValueError(f"メタデータを書き換えられない形式です: {path}")
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                retag(src, dst, texts)
+            shutil.copymode(path, tmp_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
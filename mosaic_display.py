@@ -0,0 +1,140 @@
+"""
+表示用の縮小画像のキャッシュ（Tk非依存）
+
+元の解像度の画像を1/2ずつ縮小したピラミッドと、キャンバスの大きさに合わせた
+表示用のRGB画像を画像ごとに保持する。編集後は変更範囲だけをピラミッドに
+縮小し直し、表示用の画像はキャンバスに近い大きさの段から作り直すため、
+再描画の処理時間は元画像の解像度に依存しない。
+
+表示用の画像は、操作中は軽い面積平均（OpenCV の INTER_AREA）で、
+操作が止まった後は高画質な LANCZOS（PIL）で作成する。
+拡大表示では画像のうち表示される範囲だけを、必要な解像度の段から切り出して作成する。
+"""
+
+import cv2
+import numpy as np
+
+
+def _halve(block):
+    """画像を縦横1/2に縮小（2x2画素の平均、奇数の端は端の画素を複製して補う）
+
+    各出力画素は対応する2x2画素だけから決まるため、範囲ごとに計算しても
+    全体を一度に計算した場合と同じ結果になる。
+    """
+    h, w = block.shape[:2]
+    if h % 2 or w % 2:
+        block = cv2.copyMakeBorder(block, 0, h % 2, 0, w % 2, cv2.BORDER_REPLICATE)
+    return cv2.resize(block, ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA)
+
+
+class DisplayPyramid:
+    """表示用の縮小画像のピラミッド
+
+    levels[0] は元画像（コピーしない）、levels[k] は 1/2**k に縮小した画像（BGR）。
+    最も小さい段は、表示サイズ以上の大きさになるまで作成する。
+    """
+
+    def __init__(self):
+        self.levels = []
+        self.display = None  # 表示用のRGB画像
+        self.display_size = None
+        self.display_rect = None  # 表示用の画像に含まれる画像の範囲
+        self.fast = None
+
+    @property
+    def source(self):
+        return self.levels[0] if self.levels else None
+
+    def clear(self):
+        self.levels = []
+        self.display = None
+        self.display_size = None
+        self.display_rect = None
+        self.fast = None
+
+    def render(self, image, size, dirty=None, fast=False, rect=None):
+        """image を size (幅, 高さ) に縮小した表示用のRGB画像を返す
+
+        rect (x1, y1, x2, y2) を指定すると、画像のその範囲だけを size に合わせて
+        表示用の画像を作成する（拡大表示）。
+
+        dirty (x1, y1, x2, y2) を指定すると、前回表示した画像からの変更が
+        その範囲に限られるものとして、変更範囲だけを縮小し直す
+        （コピーオンライトで配列が替わった場合も含む）。
+        dirty を省略した場合、前回と同じ配列であればキャッシュをそのまま使う。
+        fast=True の場合は軽いリサンプリングで作成する。
+        """
+        height, width = image.shape[:2]
+        rect = tuple(rect) if rect is not None else (0, 0, width, height)
+        # 画像全体を表示した場合に相当する大きさ（使用する段の選択に使う）
+        full_size = (size[0] * width / max(1, rect[2] - rect[0]), size[1] * height / max(1, rect[3] - rect[1]))
+        
+        source = self.source
+        if source is None or image.shape != source.shape or (image is not source and dirty is None):
+            self._build(image)
+        elif image is not source or dirty is not None:
+            self.levels[0] = image
+            if dirty is not None:
+                self._update(dirty)
+            self.display = None
+        self._extend(full_size)
+
+        if self.display is None or self.display_size != size or self.display_rect != rect or self.fast != fast:
+            self.display = self._resize(size, fast, rect, self.level_for(full_size))
+            self.display_size = size
+            self.display_rect = rect
+            self.fast = fast
+        return self.display
+
+    def level_for(self, size):
+        """size 以上の大きさを持つ最も小さい段の番号"""
+        width, height = size
+        for k in range(len(self.levels) - 1, -1, -1):
+            level_h, level_w = self.levels[k].shape[:2]
+            if level_w >= width and level_h >= height:
+                return k
+        return 0
+
+    def _build(self, image):
+        self.levels = [image]
+        self.display = None
+
+    def _extend(self, size):
+        """最も小さい段が表示サイズの2倍未満になるまで段を追加"""
+        width, height = size
+        while True:
+            level_h, level_w = self.levels[-1].shape[:2]
+            if level_w < width * 2 or level_h < height * 2 or min(level_w, level_h) < 2:
+                return
+            self.levels.append(_halve(self.levels[-1]))
+            self.display = None
+
+    def _update(self, rect):
+        """変更範囲を各段に縮小し直す"""
+        x1, y1, x2, y2 = map(int, rect)
+        for k in range(1, len(self.levels)):
+            prev, level = self.levels[k - 1], self.levels[k]
+            level_h, level_w = level.shape[:2]
+            x1, y1 = x1 // 2, y1 // 2
+            x2, y2 = min(level_w, (x2 + 1) // 2), min(level_h, (y2 + 1) // 2)
+            if x1 >= x2 or y1 >= y2:
+                return
+            level[y1:y2, x1:x2] = _halve(prev[y1 * 2:y2 * 2, x1 * 2:x2 * 2])
+
+    def _resize(self, size, fast, rect, k):
+        """k 段目から rect の範囲を切り出し、表示用のRGB画像を作成"""
+        from PIL import Image
+
+        level = self.levels[k]
+        height, width = self.levels[0].shape[:2]
+        level_h, level_w = level.shape[:2]
+        x1, y1, x2, y2 = rect
+        level = level[y1 * level_h // height:-(-y2 * level_h // height),
+                      x1 * level_w // width:-(-x2 * level_w // width)]
+        if size[0] > level.shape[1] or size[1] > level.shape[0]:
+            # 元の解像度より拡大する場合は、画素の境界がわかるよう最近傍で拡大
+            return cv2.cvtColor(cv2.resize(level, size, interpolation=cv2.INTER_NEAREST), cv2.COLOR_BGR2RGB)
+        if fast:
+            return cv2.cvtColor(cv2.resize(level, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB)
+        rgb = cv2.cvtColor(level, cv2.COLOR_BGR2RGB)
+        return np.asarray(Image.fromarray(rgb).resize(size, Image.Resampling.LANCZOS))
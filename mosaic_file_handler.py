@@ -1,41 +1,36 @@
 import os
-import shutil
-import cv2
-import numpy as np
-from PIL import Image
-import threading
 from tkinter import filedialog, messagebox
-from natsort import natsorted
+from mosaic_core import (
+    FolderIndex, OutputNameAllocator, encode_options, output_base_name, output_folders,
+)
+from mosaic_save_queue import DONE, SaveJob, SaveQueue
 
 class MosaicFileHandler:
     def __init__(self, app):
         self.app = app
-        self.saving_in_progress = False
-        self._pending_close = False
+        self._pending_close = False  # 終了待ちフラグ
+        # 出力ファイル名の割り当て（フォルダごとに使用済みの番号を記録）
+        self.output_names = OutputNameAllocator()
+        # クイック保存・モザイク不要の保存キュー（1つのスレッドで要求順に保存）
+        self.save_queue = SaveQueue(on_finished=self._on_save_finished)
 
     def save_image(self):
         """画像を保存"""
-        if self.app.current_image is None:
+        if self.app.current_image is None or not self.app.ensure_full_image():
             return
         
-        # デフォルトファイル名の生成
-        initialfile = "output_1.png"
+        # デフォルトファイル名の生成（選択中の保存形式の拡張子）
+        profile = self.app.ui.save_profile()
+        ext = profile["ext"]
+        initialfile = f"output_1.{ext}"
         if self.app.current_image_path:
-            base = os.path.splitext(os.path.basename(self.app.current_image_path))[0]
-            ext = ".png"
+            base = output_base_name(self.app.current_image_path)
             folder = os.path.dirname(self.app.current_image_path)
-            idx = 1
-            while True:
-                candidate = f"{base}_{idx}{ext}"
-                candidate_path = os.path.join(folder, candidate)
-                if not os.path.exists(candidate_path):
-                    initialfile = candidate
-                    break
-                idx += 1
+            initialfile = os.path.basename(self.output_names.peek(folder, base, ext))
         
         # 保存ダイアログを表示
         file_path = filedialog.asksaveasfilename(
-            defaultextension=".png",
+            defaultextension=f".{ext}",
             filetypes=[
                 ("PNG files", "*.png"),
                 ("JPEG files", "*.jpg"),
@@ -46,9 +41,13 @@ class MosaicFileHandler:
         
         if file_path:
             # 画像を保存
+            # 選択中の保存形式と同じ拡張子であれば、その圧縮レベル・品質で保存
+            options = encode_options(profile) if file_path.lower().endswith(f".{ext}") else None
             success = self.app.processor.save_with_metadata(
                 self.app.current_image,
-                file_path
+                file_path,
+                self.app.build_recipe() if self.app.strokes else None,
+                options
             )
             
             if success:
@@ -62,199 +61,167 @@ class MosaicFileHandler:
         if self.app.current_image is None:
             print("Debug: No current image")
             return
+        # プレビュー用の縮小画像であれば元の解像度で読み込む
+        if not self.app.ensure_full_image():
+            return
+        if not self._can_submit():
+            return
 
         print("Debug: Starting quick save process")
         # 保存先フォルダの設定
         base_folder = os.path.dirname(self.app.current_image_path) if self.app.current_image_path else os.getcwd()
-        completed_folder = os.path.join(base_folder, "_Completed")
-        original_folder = os.path.join(base_folder, "_Original")
+
+        # フォルダが存在しない場合は作成
+        completed_folder, original_folder = output_folders(base_folder)
 
         print(f"Debug: Base folder: {base_folder}")
         print(f"Debug: Completed folder: {completed_folder}")
         print(f"Debug: Original folder: {original_folder}")
 
-        # フォルダが存在しない場合は作成
-        os.makedirs(completed_folder, exist_ok=True)
-        os.makedirs(original_folder, exist_ok=True)
-
-        # 保存ファイル名の生成
-        ext = self.app.ui.save_format_var.get()
-        if self.app.current_image_path:
-            base = os.path.splitext(os.path.basename(self.app.current_image_path))[0]
-        else:
-            base = "output"
-        idx = 1
-        while True:
-            candidate = f"{base}_{idx}.{ext}"
-            candidate_path = os.path.join(completed_folder, candidate)
-            if not os.path.exists(candidate_path):
-                break
-            idx += 1
-
-        print(f"Debug: Saving to: {candidate_path}")
-
-        original_text = self.app.ui.quick_save_button.cget("text")
-        self.app.ui.quick_save_button.config(text="保存中...", state="disabled")
-        self.app.ui.quick_save_button.update_idletasks()
-        self.saving_in_progress = True
+        # 保存ファイル名の生成（保存待ちの間も他の保存と重ならないよう予約する）
+        profile = self.app.ui.save_profile()
+        ext = profile["ext"]
+        base = output_base_name(self.app.current_image_path)
+        candidate_path = self.output_names.reserve(completed_folder, base, ext)
 
-        def save_task():
-            try:
-                print("Debug: Starting save task")
-                # モザイク処理済み画像の保存
-                if ext in ["png", "jpg", "jpeg"]:
-                    img = self.app.current_image
-                    if len(img.shape) == 3 and img.shape[2] == 4:
-                        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
-                    if img.dtype != np.uint8:
-                        img = img.astype(np.uint8)
-                    if len(img.shape) == 2:
-                        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-                    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                    pil_img = Image.fromarray(img)
-                    if ext == "png":
-                        pil_img.save(candidate_path)
-                    else:
-                        pil_img.save(candidate_path, format="JPEG", quality=95)
-                else:
-                    img = self.app.current_image
-                    if len(img.shape) == 3 and img.shape[2] == 4:
-                        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
-                    if img.dtype != np.uint8:
-                        img = img.astype(np.uint8)
-                    if len(img.shape) == 2:
-                        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-                    cv2.imwrite(candidate_path, img)
+        print(f"Debug: Saving to: {candidate_path} ({profile['label']})")
 
-                print("Debug: Image saved successfully")
+        # 操作レシピ（保存要求時点のストローク、PNGならチャンク、それ以外はサイドカー）
+        recipe = self.app.build_recipe() if self.app.strokes else None
+        pnginfo = None
+        if recipe is not None and ext == "png":
+            pnginfo = self.app.processor.recipe_pnginfo(recipe)
 
-                # オリジナル画像の移動
-                if self.app.current_image_path:
-                    original_filename = os.path.basename(self.app.current_image_path)
-                    original_dest = os.path.join(original_folder, original_filename)
-                    print(f"Debug: Moving original to: {original_dest}")
-                    if not os.path.exists(original_dest):
-                        os.rename(self.app.current_image_path, original_dest)
-                        print("Debug: Original moved successfully")
-
-                # フォルダ内容をリロード
-                self.app.root.after(0, self.reload_folder_contents)
+        # 保存要求時点の画像とパスをまとめてキューに入れる（画像はコピーせずに共有）
+        self._submit(SaveJob(
+            "encode", self.app.current_image_path, candidate_path, ext, original_folder,
+            image=self.app.current_image, pnginfo=pnginfo, options=encode_options(profile), recipe=recipe,
+            save_recipe=self.app.processor.save_recipe,
+        ))
 
-                # プレビューモードでなければ切り替え
-                if not self.app.preview_mode:
-                    self.app.root.after(0, self.app.toggle_preview_mode)
+        # プレビューモードでなければ切り替え
+        if not self.app.preview_mode:
+            self.app.toggle_preview_mode()
 
-                # 次の画像があれば自動で送る
-                if self.app.current_folder_index < len(self.app.folder_images) - 1:
-                    self.app.root.after(0, lambda: self.app.load_folder_image(self.app.current_folder_index + 1))
-
-            except Exception as e:
-                print(f"Debug: Error in save task: {str(e)}")
-                pass  # エラー時もポップアップ無し
-            finally:
-                def finish():
-                    self.saving_in_progress = False
-                    self.app.ui.quick_save_button.config(text=original_text, state="normal")
-                    if self._pending_close:
-                        self.app.root.destroy()
-                self.app.root.after(0, finish)
-
-        print("Debug: Starting save thread")
-        threading.Thread(target=save_task, daemon=True).start()
+        # 保存の完了を待たずに次の画像へ送る
+        self._advance()
 
     def skip_mosaic(self):
         """モザイク不要の画像をオリジナルフォルダに移動し、コンプリートフォルダにコピー"""
-        if self.app.current_image is None:
+        if self.app.current_image is None or not self.app.current_image_path:
+            return
+        if not self._can_submit():
             return
 
         print("Debug: Starting skip mosaic process")
         # 保存先フォルダの設定
-        base_folder = os.path.dirname(self.app.current_image_path) if self.app.current_image_path else os.getcwd()
-        completed_folder = os.path.join(base_folder, "_Completed")
-        original_folder = os.path.join(base_folder, "_Original")
+        base_folder = os.path.dirname(self.app.current_image_path)
+
+        # フォルダが存在しない場合は作成
+        completed_folder, original_folder = output_folders(base_folder)
 
         print(f"Debug: Base folder: {base_folder}")
         print(f"Debug: Completed folder: {completed_folder}")
         print(f"Debug: Original folder: {original_folder}")
 
-        # フォルダが存在しない場合は作成
-        os.makedirs(completed_folder, exist_ok=True)
-        os.makedirs(original_folder, exist_ok=True)
-
-        # 保存ファイル名の生成
-        ext = self.app.ui.save_format_var.get()
-        if self.app.current_image_path:
-            base = os.path.splitext(os.path.basename(self.app.current_image_path))[0]
-        else:
-            base = "output"
-        idx = 1
-        while True:
-            candidate = f"{base}_{idx}.{ext}"
-            candidate_path = os.path.join(completed_folder, candidate)
-            if not os.path.exists(candidate_path):
-                break
-            idx += 1
+        # 保存ファイル名の生成（保存待ちの間も他の保存と重ならないよう予約する）
+        ext = self.app.ui.save_profile()["ext"]
+        base = output_base_name(self.app.current_image_path)
+        candidate_path = self.output_names.reserve(completed_folder, base, ext)
 
         print(f"Debug: Saving to: {candidate_path}")
 
-        original_text = self.app.ui.skip_button.cget("text")
-        self.app.ui.skip_button.config(text="処理中...", state="disabled")
-        self.app.ui.skip_button.update_idletasks()
-        self.saving_in_progress = True
-
-        def skip_task():
-            try:
-                print("Debug: Starting skip task")
-                # オリジナル画像をコンプリートフォルダにコピー
-                if self.app.current_image_path:
-                    shutil.copy2(self.app.current_image_path, candidate_path)
-                    print("Debug: Image copied to completed folder")
-
-                    # オリジナル画像の移動
-                    original_filename = os.path.basename(self.app.current_image_path)
-                    original_dest = os.path.join(original_folder, original_filename)
-                    print(f"Debug: Moving original to: {original_dest}")
-                    if not os.path.exists(original_dest):
-                        os.rename(self.app.current_image_path, original_dest)
-                        print("Debug: Original moved successfully")
-
-                # フォルダ内容をリロード
-                self.app.root.after(0, self.reload_folder_contents)
-
-                # 次の画像に移動
-                if self.app.current_folder_index < len(self.app.folder_images) - 1:
-                    print("Debug: Moving to next image")
-                    self.app.root.after(0, lambda: self.app.load_folder_image(self.app.current_folder_index + 1))
-
-            except Exception as e:
-                print(f"Debug: Error in skip task: {str(e)}")
-                pass  # エラー時もポップアップ無し
-            finally:
-                def finish():
-                    self.saving_in_progress = False
-                    self.app.ui.skip_button.config(text=original_text, state="normal")
-                    if self._pending_close:
-                        self.app.root.destroy()
-                self.app.root.after(0, finish)
-
-        print("Debug: Starting skip thread")
-        threading.Thread(target=skip_task, daemon=True).start()
+        self._submit(SaveJob("copy", self.app.current_image_path, candidate_path, ext, original_folder))
+
+        # 保存の完了を待たずに次の画像へ送る
+        self._advance()
+
+    def _can_submit(self):
+        """保存要求を受け付けられるか（保存待ちが上限の場合や、同じ画像が保存待ちの場合は不可）"""
+        if self._pending_close:
+            return False
+        if self.save_queue.full():
+            self.app.ui.update_save_status("保存: 保存待ちが上限です")
+            return False
+        path = self.app.current_image_path
+        if path and any(job.source_path == path for job in self.save_queue.outstanding()):
+            self.app.ui.update_save_status("保存: この画像は保存待ちです")
+            return False
+        return True
+
+    def _submit(self, job):
+        """保存要求をキューに入れる"""
+        if not self.save_queue.submit(job):
+            self.app.ui.update_save_status("保存: 保存待ちが上限です")
+            return False
+        self.app.ui.update_save_status()
+        self.update_save_buttons()
+        return True
+
+    def _advance(self):
+        """次の画像があれば読み込む"""
+        if self.app.current_folder_index < len(self.app.folder_images) - 1:
+            self.app.load_folder_image(self.app.current_folder_index + 1)
+
+    def _on_save_finished(self, job):
+        """保存の完了（ワーカースレッドから呼ばれるため、画面の更新はメインスレッドで行う）"""
+        self.app.root.after(0, lambda: self._finish_save(job))
+
+    def _finish_save(self, job):
+        remaining = self.save_queue.pending
+        if job.status == DONE:
+            # 移動した元画像をフォルダの一覧から直接外す（移動しなかった場合は一覧に残す）
+            if job.moved and self.app.folder_index is not None:
+                self.app.folder_index.remove(job.source_path)
+            if job.encode_time is not None:
+                detail = f"エンコード {job.encode_time:.2f}秒"
+            else:
+                detail = {"reflink": "リフリンク", "hardlink": "ハードリンク"}.get(job.method, "コピー")
+            text = f"保存: 完了 {job.name} ({job.elapsed:.1f}秒、{detail})"
+        else:
+            # エラー時もポップアップは出さず、状態表示に残す
+            self.output_names.release(job.target_path)
+            text = f"保存: 失敗 {job.name}"
+        if remaining:
+            text += f"（残り{remaining}件）"
+        self.app.ui.update_save_status(text)
+
+        # 現在の画像の位置を更新
+        self.reload_folder_contents()
+        self.update_save_buttons()
+
+        if self._pending_close and not remaining:
+            self.app.on_closing()
+
+    def update_save_buttons(self):
+        """保存待ちが上限の間、または終了待ちの間はクイック保存・モザイク不要を無効化"""
+        state = "disabled" if self._pending_close or self.save_queue.full() else "normal"
+        self.app.ui.quick_save_button.config(state=state)
+        self.app.ui.skip_button.config(state=state)
+
+    def close_when_saved(self):
+        """保存待ちがすべて保存されてから終了する"""
+        self._pending_close = True
+        self.update_save_buttons()
+        self.app.ui.quick_save_button.config(text="保存中... 終了待機")
 
     def reload_folder_contents(self):
-        """フォルダ内のファイル構成をリロード"""
+        """フォルダ内のファイル構成を更新（フォルダが更新された場合のみ読み込み直す）"""
         if self.app.current_image_path:
             folder_path = os.path.dirname(self.app.current_image_path)
-            self.app.folder_images = [
-                os.path.abspath(os.path.join(folder_path, f))
-                for f in os.listdir(folder_path)
-                if f.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.gif'))
-            ]
-            self.app.folder_images = natsorted(self.app.folder_images)
-            # 現在の画像のインデックスを更新
-            norm_current_path = os.path.normcase(os.path.normpath(self.app.current_image_path))
-            norm_folder_images = [os.path.normcase(os.path.normpath(p)) for p in self.app.folder_images]
-            if norm_current_path in norm_folder_images:
-                self.app.current_folder_index = norm_folder_images.index(norm_current_path)
+            if self.app.folder_index is None or not self.app.folder_index.matches(folder_path):
+                self.app.folder_index = FolderIndex(folder_path)
+            else:
+                self.app.folder_index.refresh()
+            self.app.folder_images = self.app.folder_index.images
+            # 現在の画像のインデックスを更新（移動済みの場合は範囲内に収める）
+            index = self.app.folder_index.index(self.app.current_image_path)
+            if index is not None:
+                self.app.current_folder_index = index
+            elif self.app.folder_images:
+                self.app.current_folder_index = min(self.app.current_folder_index, len(self.app.folder_images) - 1)
+            # 前後の画像を先読み
+            self.app.prefetch_neighbours()
             # プレビュー情報を更新
             if self.app.preview_mode:
-                self.app.ui.update_preview_info() 
\ No newline at end of file
+                self.app.ui.update_preview_info()
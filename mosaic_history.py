@@ -0,0 +1,319 @@
+"""
+編集履歴（元に戻す・やり直し）
+
+操作ごとに画像全体を保存せず、変更範囲（矩形）の変更前・変更後の画素だけを保存する。
+元に戻す・やり直しは、その範囲を現在の画像に直接書き戻す。
+メモリ使用量と処理時間は、画像の大きさではなくストロークの大きさに比例する。
+
+履歴の上限は操作数ではなくバイト数で指定する。メモリ上の履歴が上限を超えると、
+古い操作から順に圧縮し、それでも超える場合は一時ファイルに退避する。
+現在位置に近い操作は常にメモリ上にそのまま保持するため、元に戻す・やり直しは即座に行える。
+一時ファイルの上限も超えた場合は、最も古い操作から破棄する。
+破棄した操作が一時ファイルに残した領域は、一定量たまるとファイルを詰めて解放する。
+"""
+
+import tempfile
+import zlib
+
+import numpy as np
+
+# メモリ上の履歴の上限（バイト）
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+# 一時ファイルに退避する履歴の上限（バイト）
+DEFAULT_DISK_BUDGET = 4 * 1024 * 1024 * 1024
+# 現在位置の前後で、圧縮せずに保持する操作数
+DEFAULT_KEEP_RECENT = 4
+# 一時ファイルの不要な領域がこの量と使用中の量の両方を超えたらファイルを詰める
+COMPACT_MIN_BYTES = 16 * 1024 * 1024
+
+
+class SpillStore:
+    """履歴の退避先の一時ファイル（閉じると自動で削除される）
+
+    size はファイルの大きさ、dead はそのうち破棄した履歴が占めている（不要な）バイト数。
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.file = None
+        self.size = 0
+        self.dead = 0
+
+    def write(self, data):
+        """データを追記し、(位置, 長さ) を返す"""
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix="mosaic_history_", dir=self.directory)
+        offset = self.size
+        self.file.seek(offset)
+        self.file.write(data)
+        self.size += len(data)
+        return offset, len(data)
+
+    def read(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def free(self, length):
+        """破棄した履歴の領域を不要として記録"""
+        self.dead += length
+
+    def compact(self, pixels):
+        """不要な領域を詰めてファイルを切り詰める
+
+        pixels は一時ファイルに退避中の StoredPixels の一覧で、位置を書き換える。
+        位置の小さい順に前へ詰めるため、未移動のデータを上書きすることはない。
+        """
+        position = 0
+        for stored in sorted(pixels, key=lambda p: p.offset):
+            if stored.offset != position:
+                data = self.read(stored.offset, stored.length)
+                self.file.seek(position)
+                self.file.write(data)
+                stored.offset = position
+            position += stored.length
+        if self.file is not None:
+            self.file.truncate(position)
+        self.size = position
+        self.dead = 0
+
+    def clear(self):
+        """一時ファイルを削除"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.size = 0
+        self.dead = 0
+
+
+class StoredPixels:
+    """履歴に保存した画素（メモリ上の配列 → 圧縮データ → 一時ファイルの順に移す）"""
+
+    __slots__ = ("shape", "dtype", "array", "data", "offset", "length")
+
+    def __init__(self, array):
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.array = array
+        self.data = None  # 圧縮データ
+        self.offset = None  # 一時ファイル上の位置
+        self.length = 0
+
+    @property
+    def memory_bytes(self):
+        if self.array is not None:
+            return self.array.nbytes
+        if self.data is not None:
+            return len(self.data)
+        return 0
+
+    @property
+    def disk_bytes(self):
+        return self.length if self.offset is not None else 0
+
+    def compress(self, level):
+        """メモリ上の配列を圧縮（圧縮済みなら何もしない）"""
+        if self.array is not None:
+            self.data = zlib.compress(self.array.tobytes(), level)
+            self.array = None
+
+    def spill(self, store):
+        """圧縮データを一時ファイルに退避"""
+        if self.data is not None:
+            self.offset, self.length = store.write(self.data)
+            self.data = None
+
+    def discard(self, store):
+        """破棄する際に、一時ファイル上の領域を不要として記録"""
+        if self.offset is not None:
+            store.free(self.length)
+            self.offset = None
+            self.length = 0
+
+    def load(self, store):
+        """画素を配列として取得"""
+        if self.array is not None:
+            return self.array
+        data = self.data if self.data is not None else store.read(self.offset, self.length)
+        return np.frombuffer(zlib.decompress(data), dtype=self.dtype).reshape(self.shape)
+
+
+class HistoryEntry:
+    """1操作分の履歴（変更範囲、変更前・変更後の画素、操作後の状態）"""
+
+    __slots__ = ("rect", "before", "after", "state")
+
+    def __init__(self, rect, before, after, state):
+        self.rect = rect
+        self.before = before
+        self.after = after
+        self.state = state
+
+    def pixels(self):
+        return [p for p in (self.before, self.after) if p is not None]
+
+    @property
+    def memory_bytes(self):
+        return sum(p.memory_bytes for p in self.pixels())
+
+    @property
+    def disk_bytes(self):
+        return sum(p.disk_bytes for p in self.pixels())
+
+
+class ImageHistory:
+    """変更範囲の差分による編集履歴
+
+    state には操作後のアプリ側の状態（ストロークの一覧など）を保存し、
+    元に戻す・やり直しの際に返す。
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, disk_budget=DEFAULT_DISK_BUDGET,
+                 keep_recent=DEFAULT_KEEP_RECENT, compress_level=1, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.keep_recent = keep_recent
+        self.compress_level = compress_level
+        self.store = SpillStore(spill_dir)
+        self.entries = []
+        self.index = 0  # 適用済みの操作数
+        self.base_state = None  # 最も古い操作より前の状態
+
+    def reset(self, state):
+        """履歴をすべて破棄し、現在の状態を起点にする（画像の読み込み・リセット時）"""
+        self.entries = []
+        self.index = 0
+        self.base_state = state
+        self.store.clear()
+
+    def push(self, image, rect, snapshot, state):
+        """操作を履歴に追加
+
+        rect は変更範囲 (x1, y1, x2, y2)（変更が無い場合は None）、snapshot は
+        操作前に take_snapshot で保存した、rect を含む範囲の画素。
+        変更後の画素は image から取得する。
+        """
+        # 現在位置より後の履歴を削除
+        self._discard(self.entries[self.index:])
+        del self.entries[self.index:]
+        before = after = None
+        if rect is not None:
+            x1, y1, x2, y2 = rect
+            (sx1, sy1, _, _), pixels = snapshot
+            before = StoredPixels(pixels[y1 - sy1:y2 - sy1, x1 - sx1:x2 - sx1].copy())
+            after = StoredPixels(image[y1:y2, x1:x2].copy())
+        self.entries.append(HistoryEntry(rect, before, after, state))
+        self.index = len(self.entries)
+        self._enforce_budget()
+
+    def _enforce_budget(self):
+        """上限を超えた分を、古い操作から圧縮・退避・破棄"""
+        memory = sum(entry.memory_bytes for entry in self.entries)
+        if memory > self.memory_budget:
+            # 現在位置の前後 keep_recent 件以外を、古い順に対象とする
+            recent = range(self.index - self.keep_recent, self.index + self.keep_recent)
+            candidates = [entry for i, entry in enumerate(self.entries) if i not in recent]
+            for tier in ("compress", "spill"):
+                for entry in candidates:
+                    if memory <= self.memory_budget:
+                        break
+                    for pixels in entry.pixels():
+                        memory -= pixels.memory_bytes
+                        if tier == "compress":
+                            pixels.compress(self.compress_level)
+                        else:
+                            pixels.spill(self.store)
+                        memory += pixels.memory_bytes
+
+        # 一時ファイルの上限を超えた場合は最も古い操作から破棄
+        disk = sum(entry.disk_bytes for entry in self.entries)
+        while disk > self.disk_budget and self.index > 0:
+            entry = self.entries.pop(0)
+            disk -= entry.disk_bytes
+            self._discard([entry])
+            self.base_state = entry.state
+            self.index -= 1
+
+        # 破棄した操作の領域がたまった場合（またはファイルが上限を超えた場合）は詰める
+        store = self.store
+        if store.dead and (store.size > self.disk_budget or store.dead >= max(disk, COMPACT_MIN_BYTES)):
+            store.compact([p for entry in self.entries for p in entry.pixels() if p.offset is not None])
+
+    def _discard(self, entries):
+        """破棄する操作が一時ファイルに退避していた領域を不要として記録"""
+        for entry in entries:
+            for pixels in entry.pixels():
+                pixels.discard(self.store)
+
+    def can_undo(self):
+        return self.index > 0
+
+    def can_redo(self):
+        return self.index < len(self.entries)
+
+    def state(self):
+        """現在位置の状態"""
+        return self.entries[self.index - 1].state if self.index else self.base_state
+
+    def undo(self, image):
+        """1つ前の状態に戻す（image を直接書き換え、変更範囲を返す）"""
+        if not self.can_undo():
+            return None
+        self.index -= 1
+        entry = self.entries[self.index]
+        self._patch(image, entry.rect, entry.before)
+        return entry.rect
+
+    def redo(self, image):
+        """1つ後の状態に進む（image を直接書き換え、変更範囲を返す）"""
+        if not self.can_redo():
+            return None
+        entry = self.entries[self.index]
+        self.index += 1
+        self._patch(image, entry.rect, entry.after)
+        return entry.rect
+
+    def _patch(self, image, rect, pixels):
+        """変更範囲に保存した画素を書き戻す"""
+        if rect is None:
+            return
+        x1, y1, x2, y2 = rect
+        image[y1:y2, x1:x2] = pixels.load(self.store)
+
+    def footprint(self):
+        """履歴の使用量（操作数と、メモリ上・圧縮済み・一時ファイルのバイト数）
+
+        disk は保持している操作が一時ファイル上で使用している量、file は
+        破棄した操作の未解放の領域を含む一時ファイルの大きさ。
+        """
+        usage = {"entries": len(self.entries), "memory": 0, "compressed": 0, "disk": 0,
+                 "file": self.store.size}
+        for entry in self.entries:
+            for pixels in entry.pixels():
+                if pixels.array is not None:
+                    usage["memory"] += pixels.memory_bytes
+                else:
+                    usage["compressed"] += pixels.memory_bytes
+                usage["disk"] += pixels.disk_bytes
+        return usage
+
+    @property
+    def nbytes(self):
+        """履歴がメモリ上で使用している合計バイト数"""
+        return sum(entry.memory_bytes for entry in self.entries)
+
+
+def take_snapshot(image, rect):
+    """操作前に、変更される可能性のある範囲の画素を保存（範囲が無い場合は None）"""
+    if rect is None:
+        return None
+    x1, y1, x2, y2 = rect
+    return rect, image[y1:y2, x1:x2].copy()
+
+
+def union_rect(a, b):
+    """2つの範囲を含む最小の範囲（どちらかが None の場合はもう一方）"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
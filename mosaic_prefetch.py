@@ -0,0 +1,180 @@
+"""
+フォルダ内の画像の先読みと、デコード済み画像のキャッシュ（Tk非依存）
+
+プレビューモードで前後の画像へ移動する際に、表示中の画像の前後数枚を
+バックグラウンドのスレッドで先にデコードしておき、バイト数で上限を設けた
+LRUキャッシュに保持する。キャッシュにある画像はデコードせずに即座に表示できる。
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from mosaic_core import decode_image, normalize_path, share_image
+
+# デコード済み画像のキャッシュの上限（バイト）
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+# 先読みする枚数（後ろ / 前）
+DEFAULT_AHEAD = 2
+DEFAULT_BEHIND = 1
+
+
+def _file_stamp(path):
+    """ファイルの更新を検出するための (更新時刻, サイズ)（ファイルが無い場合は None）"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class DecodedImageCache:
+    """デコード済み画像のLRUキャッシュ（合計バイト数で上限を設ける）
+
+    画像は share_image で読み取り専用にして保持するため、取り出した側が
+    書き換える際はコピーが作られ、キャッシュの内容は変わらない。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # 正規化したパス -> (画像, ファイルの更新情報)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        key = normalize_path(path)
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry is not None and entry[1] == _file_stamp(path)
+
+    def get(self, path):
+        """キャッシュから画像を取得（無い場合や、ファイルが更新されている場合は None）"""
+        key = normalize_path(path)
+        stamp = _file_stamp(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == stamp:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, path, image, stamp=None):
+        """画像をキャッシュに追加し、上限を超えた分を古いものから削除"""
+        key = normalize_path(path)
+        image = share_image(image)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if image.nbytes > self.max_bytes:
+                return image
+            self.entries[key] = (image, stamp if stamp is not None else _file_stamp(path))
+            self.nbytes += image.nbytes
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+        return image
+
+    def discard(self, path):
+        """指定した画像をキャッシュから削除"""
+        with self.lock:
+            self._remove(normalize_path(path))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[0].nbytes
+
+    def stats(self):
+        """キャッシュの状態（命中数・失敗数・枚数・バイト数）"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+            }
+
+
+class ImagePrefetcher:
+    """表示中の画像の前後をバックグラウンドでデコードしてキャッシュに入れる
+
+    先読みの対象は prefetch を呼ぶたびに置き換わり、古い要求は破棄される。
+    load は先読み中の画像であればデコードの完了を待ち、同じ画像を二重にデコードしない。
+    """
+
+    def __init__(self, cache, ahead=DEFAULT_AHEAD, behind=DEFAULT_BEHIND, decode=decode_image):
+        self.cache = cache
+        self.ahead = ahead
+        self.behind = behind
+        self.decode = decode
+        self.pending = []  # 先読みするパス（優先順）
+        self.loading = None  # デコード中のパス
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def prefetch(self, paths, index):
+        """paths[index] の後ろ ahead 枚・前 behind 枚を、近い順に先読み"""
+        targets = []
+        for step in range(1, max(self.ahead, self.behind) + 1):
+            if step <= self.ahead and index + step < len(paths):
+                targets.append(paths[index + step])
+            if step <= self.behind and index - step >= 0:
+                targets.append(paths[index - step])
+        with self.condition:
+            self.pending = targets
+            self.condition.notify_all()
+
+    def load(self, path):
+        """画像を取得（キャッシュに無ければ、先読みの完了を待つかその場でデコード）"""
+        key = normalize_path(path)
+        with self.condition:
+            # 先読み中であれば完了を待つ
+            while self.loading == key:
+                self.condition.wait()
+            self.pending = [p for p in self.pending if normalize_path(p) != key]
+        image = self.cache.get(path)
+        if image is None:
+            stamp = _file_stamp(path)
+            image = self.cache.put(path, self.decode(path), stamp)
+        return image
+
+    def shutdown(self):
+        """先読みを停止"""
+        with self.condition:
+            self.closed = True
+            self.pending = []
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                path = self.pending.pop(0)
+                if path in self.cache:
+                    continue
+                self.loading = normalize_path(path)
+            try:
+                stamp = _file_stamp(path)
+                self.cache.put(path, self.decode(path), stamp)
+            except Exception:
+                # 先読みの失敗はエラーではない（load がその場でデコードし直し、読めなければそこでエラーになる）
+                pass
+            finally:
+                with self.condition:
+                    self.loading = None
+                    self.condition.notify_all()
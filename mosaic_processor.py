@@ -10,6 +10,7 @@
 2. モザイク処理
    - 最初のクリック位置を基準点として保存
    - 2回目以降のクリックでは、基準点からの相対位置に基づいてモザイクを整列
+   - 処理済みのブロックは画像ごとに記録し、重なったストロークでは再計算しない
    - モザイクサイズは画像の長辺に応じて自動計算（FANZA仕様）
    - モザイクサイズは最小4ピクセル、画像長辺の1/100（400ピクセル以上の場合）
 
@@ -21,21 +22,249 @@
 4. 画像保存
    - メタデータ対応フォーマット: メタデータを含めて保存
    - 非対応フォーマット: 通常の画像として保存（警告表示）
+
+5. 操作レシピ
+   - ストロークごとにモード・基本サイズ・倍率・処理範囲・ドラッグ範囲・基準点を記録
+   - PNGはテキストチャンク、それ以外はサイドカーファイル（画像パス + .mosaic.json）に保存
+   - 元画像とレシピから、操作を繰り返さずに出力を再生成できる
 """
 
-import cv2
 import numpy as np
 import json
-from PIL import Image
-from PIL.PngImagePlugin import PngInfo
 import os
-import tkinter as tk
-from tkinter import messagebox
+
+from mosaic_core import encode_image, read_image_metadata, retag_image
+
+# GUIを持たないバッチ処理でも使えるよう tkinter には依存しない。
+# cv2 / PIL はメタデータの読み書き時にのみ読み込む。
+
+# 操作レシピの形式
+RECIPE_VERSION = 1
+RECIPE_CHUNK = "MosaicRecipe"        # PNGに埋め込む場合のテキストチャンク名
+RECIPE_SIDECAR_SUFFIX = ".mosaic.json"  # サイドカーファイルの拡張子
+
+
+def _centre_index(starts, lengths):
+    """各ブロックのサンプリング位置（中央画素、偶数長は中央2画素）を算出"""
+    idx0 = starts + (lengths - 1) // 2
+    idx1 = idx0 + (lengths % 2 == 0)
+    return idx0, idx1
+
+
+def _block_samples(roi, y_index, x_index):
+    """各ブロックの代表色を算出
+
+    cv2.resize(INTER_LINEAR) の整数倍縮小と同じく、ブロック中央の画素
+    （長さが偶数の軸は中央2画素）の平均を四捨五入した値を返す。
+    """
+    y0, y1 = y_index
+    x0, x1 = x_index
+    acc = roi[np.ix_(y0, x0)].astype(np.uint16)
+    acc += roi[np.ix_(y0, x1)]
+    acc += roi[np.ix_(y1, x0)]
+    acc += roi[np.ix_(y1, x1)]
+    return ((acc + 2) >> 2).astype(roi.dtype)
+
+
+def _fill_blocks(roi, y_layout, x_layout):
+    """ブロックの代表色でROI（ビュー）を直接塗りつぶす
+
+    レイアウトは軸ごとの (サンプリング位置, ブロックごとの画素数)。
+    """
+    y_index, row_counts = y_layout
+    x_index, col_counts = x_layout
+    cells = _block_samples(roi, y_index, x_index)
+    
+    # ブロック行ごとに書き戻す
+    y = 0
+    for cell_row, count in zip(cells, row_counts):
+        roi[y:y + count] = np.repeat(cell_row, col_counts, axis=0)
+        y += count
+
+
+def _stretch_counts(length, cells, size):
+    """ブロックごとの出力画素数を算出
+
+    cells * size への最近傍拡大と、端数がある場合の length への引き伸ばしを
+    続けて行ったときと同じ割り当てになるよう、cv2.resize(INTER_NEAREST) の
+    座標計算（浮動小数点の丸めを含む）をそのまま再現する。
+    """
+    covered = cells * size
+    src = np.arange(length)
+    if covered != length:
+        src = np.minimum(np.floor(src * (1.0 / (length / covered))).astype(np.intp), covered - 1)
+    cell = np.minimum(np.floor(src * (1.0 / (covered / cells))).astype(np.intp), cells - 1)
+    return np.bincount(cell, minlength=cells)
+
+
+def _single_layout(length):
+    """軸全体を1ブロックとするレイアウト"""
+    lengths = np.array([length], dtype=np.intp)
+    return _centre_index(np.zeros(1, dtype=np.intp), lengths), lengths
+
+
+def _stretch_layout(length, size):
+    """左上基準で区切り、端数をブロックの引き伸ばしで覆う1軸分のレイアウト"""
+    if length <= size:
+        # モザイクサイズ以下の場合は軸全体を1ブロックとする
+        return _single_layout(length)
+    cells = length // size
+    starts = np.arange(cells, dtype=np.intp) * size
+    index = _centre_index(starts, np.full(cells, size, dtype=np.intp))
+    return index, _stretch_counts(length, cells, size)
+
+
+def _pixelate(roi, size):
+    """ROI（ビュー）をモザイクサイズのブロックで直接塗りつぶす
+
+    端数がある軸はブロックを引き伸ばして覆う（従来の最近傍拡大と同じ割り当て）。
+    """
+    h, w = roi.shape[:2]
+    if h == 0 or w == 0:
+        return
+    _fill_blocks(roi, _stretch_layout(h, size), _stretch_layout(w, size))
+
+
+def _click_span(lo, hi, limit, size):
+    """ドラッグ範囲を2倍間隔でクリックした場合の処理範囲を1軸分算出
+
+    (開始, 端数ブロック開始, 終了) を返す。画像端に端数がある場合、
+    最後のクリック領域（端数開始〜終了）は従来どおり引き伸ばして処理する。
+    クリック位置が画像内に無い場合は None を返す。
+    """
+    interval = size * 2
+    first = lo if lo >= 0 else lo + ((interval - 1 - lo) // interval) * interval
+    stop = min(hi, limit)
+    if first >= stop:
+        return None
+    last = first + ((stop - 1 - first) // interval) * interval
+    
+    # クリック位置をモザイクサイズで割り切れるように調整し、前後2ブロック分を処理
+    start = max(0, (first // size) * size - interval)
+    end = min(limit, (last // size) * size + interval)
+    edge = end
+    if end == limit and limit % size:
+        edge = max(start, (last // size) * size - interval)
+    return start, edge, end
+
+
+def _grid_base(anchor, size):
+    """基準点から、画像原点を含むグリッドのブロック開始位置（0以下）を算出"""
+    base = int(anchor) % size
+    return base - size if base else 0
+
+
+def _grid_cells(lo, hi, limit_lo, limit_hi, size, base):
+    """ドラッグ範囲を2倍間隔でクリックした場合の処理ブロック範囲を1軸分算出
+
+    グリッドは base + k * size でブロックを区切る。クリック位置を含むブロックの
+    前後2ブロック分を処理対象とし、処理可能範囲 [limit_lo, limit_hi) と重なる
+    ブロック番号の範囲 (k_first, k_end) を返す。クリック位置が無い場合は None。
+    """
+    interval = size * 2
+    first = lo if lo >= limit_lo else lo + ((limit_lo - lo + interval - 1) // interval) * interval
+    stop = min(hi, limit_hi)
+    if first >= stop:
+        return None
+    last = first + ((stop - 1 - first) // interval) * interval
+    
+    k_first = max((first - base) // size - 2, (limit_lo - base) // size)
+    k_end = min((last - base) // size + 2, (limit_hi - 1 - base) // size + 1)
+    return k_first, k_end
+
+
+def _grid_plan(img_height, img_width, rect, size, origin, limit):
+    """基準点グリッドで処理するブロック範囲を算出
+
+    (base_x, base_y, (kx0, kx1), (ky0, ky1), 処理可能範囲) を返す。処理対象が無い場合は None。
+    """
+    x1, y1, x2, y2 = map(int, rect)
+    
+    # 処理可能範囲（画像範囲内に制限）
+    lx1, ly1, lx2, ly2 = map(int, limit) if limit is not None else (0, 0, img_width, img_height)
+    lx1, lx2 = max(0, lx1), min(img_width, lx2)
+    ly1, ly2 = max(0, ly1), min(img_height, ly2)
+    if lx1 >= lx2 or ly1 >= ly2:
+        return None
+    
+    # 画像原点を含むグリッドのブロック開始位置
+    base_x = _grid_base(origin[0], size)
+    base_y = _grid_base(origin[1], size)
+    
+    # 処理対象のブロック範囲を計算
+    x_cells = _grid_cells(x1, x2, lx1, lx2, size, base_x)
+    y_cells = _grid_cells(y1, y2, ly1, ly2, size, base_y)
+    if x_cells is None or y_cells is None:
+        return None
+    return base_x, base_y, x_cells, y_cells, (lx1, ly1, lx2, ly2)
+
+
+def _grid_bounds(k_first, k_end, size, base, limit_lo, limit_hi):
+    """ブロック番号の範囲から、処理可能範囲で切り取った各ブロックの画素範囲を算出"""
+    starts = base + np.arange(k_first, k_end, dtype=np.intp) * size
+    return np.maximum(starts, limit_lo), np.minimum(starts + size, limit_hi)
+
+
+def _grid_layout(starts, ends):
+    """連続するブロックの画素範囲から、先頭ブロック基準の1軸分のレイアウトを作成"""
+    lengths = ends - starts
+    return _centre_index(starts - starts[0], lengths), lengths
+
+
+def _scale_edges(edges, start, scale, limit):
+    """ブロックの境界を表示上の位置（start を0とし、scale 倍）に変換し、(開始, 終了) の配列で返す
+
+    縮小後に1画素未満になったブロックは隣のブロックと結合する。
+    """
+    scaled = np.unique(np.clip(np.rint((edges - start) * scale).astype(np.intp), 0, limit))
+    return scaled[:-1], scaled[1:]
+
+
+def _true_runs(flags):
+    """真の値が連続する区間を (開始, 終了) のリストで返す"""
+    padded = np.concatenate(([False], flags, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[::2], edges[1::2]))
+
+
+class BlockCoverage:
+    """モザイク処理済みのブロックを画像ごとに記録するビットマップ
+
+    グリッド（モザイクサイズと基準点）ごとに1ブロック1要素の配列を保持し、
+    重なったストロークでは処理済みのブロックを再計算せずに済ませる。
+    """
+
+    def __init__(self):
+        self.maps = {}
+        
+    def clear(self):
+        """記録をすべて破棄（画像の読み込み・リセット・元に戻す時に呼ぶ）"""
+        self.maps.clear()
+        
+    def bitmap(self, key, shape):
+        """指定グリッドのビットマップを取得（無ければ作成）"""
+        bitmap = self.maps.get(key)
+        if bitmap is None or bitmap.shape != shape:
+            bitmap = np.zeros(shape, dtype=bool)
+            self.maps[key] = bitmap
+        return bitmap
+        
+    def invalidate(self, rect, keep_key):
+        """他のグリッドの記録のうち、変更範囲に重なるブロックを未処理に戻す"""
+        x1, y1, x2, y2 = rect
+        for key, bitmap in self.maps.items():
+            if key == keep_key:
+                continue
+            size, base_x, base_y = key
+            bitmap[(y1 - base_y) // size:(y2 - 1 - base_y) // size + 1,
+                   (x1 - base_x) // size:(x2 - 1 - base_x) // size + 1] = False
+
 
 class MosaicProcessor:
     def __init__(self):
         self.reference_point = None
         self.current_mosaic_size = None
+        self.coverage = BlockCoverage()  # 処理済みブロックの記録（画像ごと）
         self.metadata_formats = {'png', 'jpg', 'jpeg', 'tiff', 'tif'}
         
         # メタデータの内容を定義
@@ -58,55 +287,26 @@ Contact: alexia.douglas789@vellod-ec.com"""
         return 4
 
     def apply_mosaic(self, image, x1, y1, x2, y2, size):
-        """指定された領域にモザイクを適用"""
+        """指定された領域にモザイクを適用（画像を直接書き換える）
+
+        ブロックの代表色の算出と書き戻しを1パスで行い、一時的な全面コピーを
+        作らない。出力は従来の cv2.resize による縮小・拡大と同一になる。
+        """
         # 座標を整数に変換
         x1, y1, x2, y2 = map(int, [x1, y1, x2, y2])
         size = int(size)
         
-        # 対象領域を切り出し
+        # 対象領域（ビュー）を取得
         roi = image[y1:y2, x1:x2]
-        
-        # モザイク処理
         h, w = roi.shape[:2]
+        if h == 0 or w == 0:
+            return image
         
-        # 領域がモザイクサイズより小さい場合は、そのままモザイク処理を適用
         if w <= size or h <= size:
-            # 最小サイズでモザイク処理
-            roi = cv2.resize(roi, (1, 1))
-            roi = cv2.resize(roi, (w, h), interpolation=cv2.INTER_NEAREST)
+            # 領域がモザイクサイズ以下の場合は領域全体を1ブロックとして処理
+            _fill_blocks(roi, _single_layout(h), _single_layout(w))
         else:
-            # モザイクサイズで割り切れるように領域を調整
-            new_w = (w // size) * size
-            new_h = (h // size) * size
-            
-            # 調整後の領域を切り出し
-            roi = roi[:new_h, :new_w]
-            
-            # モザイク処理
-            roi = cv2.resize(roi, (new_w//size, new_h//size))
-            roi = cv2.resize(roi, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
-            
-            # 残りの部分もモザイク処理
-            if new_w < w and new_h > 0:
-                remaining_w = roi[:, new_w:]
-                if remaining_w.size > 0:  # 空でないことを確認
-                    remaining_w = cv2.resize(remaining_w, (1, remaining_w.shape[0]))
-                    remaining_w = cv2.resize(remaining_w, (w - new_w, remaining_w.shape[0]), interpolation=cv2.INTER_NEAREST)
-                    roi = np.hstack([roi, remaining_w])
-            
-            if new_h < h and new_w > 0:
-                remaining_h = roi[new_h:, :]
-                if remaining_h.size > 0:  # 空でないことを確認
-                    remaining_h = cv2.resize(remaining_h, (remaining_h.shape[1], 1))
-                    remaining_h = cv2.resize(remaining_h, (remaining_h.shape[1], h - new_h), interpolation=cv2.INTER_NEAREST)
-                    roi = np.vstack([roi, remaining_h])
-            
-            # サイズが一致していることを確認
-            if roi.shape[:2] != (h, w):
-                roi = cv2.resize(roi, (w, h), interpolation=cv2.INTER_NEAREST)
-        
-        # 元の画像に戻す
-        image[y1:y2, x1:x2] = roi
+            _pixelate(roi, size)
             
         return image
 
@@ -146,19 +346,243 @@ Contact: alexia.douglas789@vellod-ec.com"""
         img = self.apply_mosaic(img, x1, y1, x2, y2, mosaic_size)
         return img
 
-    def process_masked_area(self, image, mask_coords, drag_coords, mode, custom_mosaic_size=None, multiplier=1):
-        """マスク範囲を切り出して処理し、元の画像に合成"""
+    def process_region(self, image, rect, mosaic_size, in_place=True, origin=None, limit=None, coverage=None):
+        """ドラッグ範囲全体に1回でモザイクを適用
+
+        範囲内をモザイクサイズの2倍間隔でクリックした場合と同じ範囲を処理する。
+        origin（基準点）を指定すると、基準点を原点とするグリッドにブロックを整列させ、
+        limit (x1, y1, x2, y2) の範囲外には書き込まない。さらに coverage を指定すると
+        処理済みブロックを飛ばす。origin を省略した場合は画像原点基準で、画像端の
+        端数を引き伸ばして処理する。
+        (画像, 変更範囲) を返す。変更範囲は (x1, y1, x2, y2)、変更が無い場合は None。
+        """
+        if image is None:
+            return image, None
+            
+        img = image if in_place else image.copy()
+        img_height, img_width = img.shape[:2]
+        mosaic_size = int(mosaic_size)
+        
+        if origin is not None:
+            return img, self._process_grid(img, rect, mosaic_size, origin, limit, coverage)
+        
+        x1, y1, x2, y2 = map(int, rect)
+        
+        # 各軸の処理範囲を計算
+        x_span = _click_span(x1, x2, img_width, mosaic_size)
+        y_span = _click_span(y1, y2, img_height, mosaic_size)
+        if x_span is None or y_span is None:
+            return img, None
+        
+        # 割り切れる部分と画像端の端数部分に分けて処理
+        x_parts = [(x_span[0], x_span[1]), (x_span[1], x_span[2])]
+        y_parts = [(y_span[0], y_span[1]), (y_span[1], y_span[2])]
+        for ya, yb in y_parts:
+            for xa, xb in x_parts:
+                _pixelate(img[ya:yb, xa:xb], mosaic_size)
+        
+        return img, (x_span[0], y_span[0], x_span[2], y_span[2])
+
+    def _process_grid(self, img, rect, size, origin, limit, coverage):
+        """基準点グリッドに整列させてモザイクを適用し、変更範囲を返す"""
+        img_height, img_width = img.shape[:2]
+        plan = _grid_plan(img_height, img_width, rect, size, origin, limit)
+        if plan is None:
+            return None
+        base_x, base_y, (kx0, kx1), (ky0, ky1), (lx1, ly1, lx2, ly2) = plan
+        
+        # 各ブロックの画素範囲（処理可能範囲で切り取り）
+        xs, xe = _grid_bounds(kx0, kx1, size, base_x, lx1, lx2)
+        ys, ye = _grid_bounds(ky0, ky1, size, base_y, ly1, ly2)
+        
+        # 処理が必要なブロック（処理済みのブロックは飛ばす）
+        todo = np.ones((ky1 - ky0, kx1 - kx0), dtype=bool)
+        bitmap = None
+        key = (size, base_x, base_y)
+        if coverage is not None:
+            shape = ((img_height - 1 - base_y) // size + 1, (img_width - 1 - base_x) // size + 1)
+            bitmap = coverage.bitmap(key, shape)
+            todo &= ~bitmap[ky0:ky1, kx0:kx1]
+        if not todo.any():
+            return None
+        
+        if todo.all():
+            # まとめて1回で処理
+            _fill_blocks(img[ys[0]:ye[-1], xs[0]:xe[-1]], _grid_layout(ys, ye), _grid_layout(xs, xe))
+        else:
+            # ブロック行ごとに、未処理ブロックの連続区間だけを処理
+            for row in np.flatnonzero(todo.any(axis=1)):
+                y_layout = _grid_layout(ys[row:row + 1], ye[row:row + 1])
+                for a, b in _true_runs(todo[row]):
+                    _fill_blocks(img[ys[row]:ye[row], xs[a]:xe[b - 1]], y_layout, _grid_layout(xs[a:b], xe[a:b]))
+        
+        # 変更範囲
+        rows = np.flatnonzero(todo.any(axis=1))
+        cols = np.flatnonzero(todo.any(axis=0))
+        dirty = (int(xs[cols[0]]), int(ys[rows[0]]), int(xe[cols[-1]]), int(ye[rows[-1]]))
+        
+        if bitmap is not None:
+            # 処理可能範囲で切り取られていないブロックのみ処理済みとして記録
+            full_x = (xs == np.maximum(base_x + np.arange(kx0, kx1) * size, 0)) & \
+                     (xe == np.minimum(base_x + np.arange(kx0 + 1, kx1 + 1) * size, img_width))
+            full_y = (ys == np.maximum(base_y + np.arange(ky0, ky1) * size, 0)) & \
+                     (ye == np.minimum(base_y + np.arange(ky0 + 1, ky1 + 1) * size, img_height))
+            bitmap[ky0:ky1, kx0:kx1] |= todo & full_y[:, None] & full_x[None, :]
+            coverage.invalidate(dirty, key)
+        
+        return dirty
+
+    def region_bounds(self, image_shape, rect, mosaic_size, origin=None, limit=None):
+        """process_region が書き換える可能性のある範囲を、処理前に算出
+
+        各ブロックの色はブロック内の画素から決まるため、書き換えは処理対象の
+        ブロック内に収まる。履歴に変更前の画素を保存する範囲として使う。
+        (x1, y1, x2, y2) を返す。処理対象が無い場合は None。
+        """
+        img_height, img_width = image_shape[:2]
+        mosaic_size = int(mosaic_size)
+        if origin is None:
+            x1, y1, x2, y2 = map(int, rect)
+            x_span = _click_span(x1, x2, img_width, mosaic_size)
+            y_span = _click_span(y1, y2, img_height, mosaic_size)
+            if x_span is None or y_span is None:
+                return None
+            return x_span[0], y_span[0], x_span[2], y_span[2]
+        
+        plan = _grid_plan(img_height, img_width, rect, mosaic_size, origin, limit)
+        if plan is None:
+            return None
+        base_x, base_y, (kx0, kx1), (ky0, ky1), (lx1, ly1, lx2, ly2) = plan
+        return (max(base_x + kx0 * mosaic_size, lx1), max(base_y + ky0 * mosaic_size, ly1),
+                min(base_x + kx1 * mosaic_size, lx2), min(base_y + ky1 * mosaic_size, ly2))
+
+    def preview_region(self, display, image_shape, rect, mosaic_size, origin, limit=None, view_rect=None):
+        """process_region の結果を、表示用の縮小画像の上で再現する（ドラッグ中のプレビュー）
+
+        元の解像度の image_shape で基準点グリッドのブロックを求め、その境界を
+        表示の縮尺に変換して、display（縮小画像）の画素から代表色を求めて直接塗りつぶす。
+        display が画像の一部だけを表示している場合は、その範囲を view_rect で指定する。
+        処理済みブロックの記録は使わず、更新もしない。
+        表示上の変更範囲 (x1, y1, x2, y2) を返す。変更が無い場合は None。
+        """
+        img_height, img_width = image_shape[:2]
+        mosaic_size = int(mosaic_size)
+        plan = _grid_plan(img_height, img_width, rect, mosaic_size, origin, limit)
+        if plan is None:
+            return None
+        base_x, base_y, (kx0, kx1), (ky0, ky1), (lx1, ly1, lx2, ly2) = plan
+        xs, xe = _grid_bounds(kx0, kx1, mosaic_size, base_x, lx1, lx2)
+        ys, ye = _grid_bounds(ky0, ky1, mosaic_size, base_y, ly1, ly2)
+        
+        # ブロックの境界を表示の縮尺に変換
+        vx1, vy1, vx2, vy2 = view_rect if view_rect is not None else (0, 0, img_width, img_height)
+        disp_height, disp_width = display.shape[:2]
+        xs, xe = _scale_edges(np.append(xs, xe[-1]), vx1, disp_width / (vx2 - vx1), disp_width)
+        ys, ye = _scale_edges(np.append(ys, ye[-1]), vy1, disp_height / (vy2 - vy1), disp_height)
+        if len(xs) == 0 or len(ys) == 0:
+            return None
+        
+        _fill_blocks(display[ys[0]:ye[-1], xs[0]:xe[-1]], _grid_layout(ys, ye), _grid_layout(xs, xe))
+        return int(xs[0]), int(ys[0]), int(xe[-1]), int(ye[-1])
+
+    def stroke_bounds(self, image_shape, stroke):
+        """操作レシピの1ストロークが書き換える可能性のある範囲を算出"""
+        return self.region_bounds(
+            image_shape, stroke["rect"], stroke["base_size"] * stroke["multiplier"],
+            origin=stroke["anchor"], limit=stroke["mask"]
+        )
+
+    def make_stroke(self, mode, base_size, multiplier, rect, mask, anchor):
+        """1ストローク分の操作レシピを作成"""
+        return {
+            "mode": mode,
+            "base_size": int(base_size),
+            "multiplier": int(multiplier),
+            "rect": [int(v) for v in rect],
+            "mask": [int(v) for v in mask] if mask is not None else None,
+            "anchor": [int(v) for v in anchor],
+        }
+
+    def build_recipe(self, strokes, image_shape=None, source=None):
+        """ストロークの一覧から操作レシピを作成"""
+        recipe = {
+            "version": RECIPE_VERSION,
+            "reference_point": list(self.reference_point) if self.reference_point else None,
+            "strokes": list(strokes),
+        }
+        if image_shape is not None:
+            recipe["image_size"] = [int(image_shape[1]), int(image_shape[0])]
+        if source:
+            recipe["source"] = os.path.basename(source)
+        return recipe
+
+    def replay_recipe(self, original, recipe, in_place=False):
+        """元画像から操作レシピを一括で再生し、出力を再生成
+
+        ストロークは記録順に適用する。処理済みブロックの記録を全ストロークで共有するため、
+        重なったストロークのブロックは一度だけ計算する。in_place=True の場合は
+        original（np.memmap 上の作業用画像など）を直接書き換える。
+        (画像, 処理済みブロックの記録) を返す。
+        """
+        if recipe.get("version") != RECIPE_VERSION:
+            raise ValueError(f"未対応のレシピ形式です: {recipe.get('version')}")
+        img = original if in_place else original.copy()
+        coverage = BlockCoverage()
+        for stroke in recipe["strokes"]:
+            mosaic_size = stroke["base_size"] * stroke["multiplier"]
+            self.process_region(
+                img, stroke["rect"], mosaic_size,
+                origin=stroke["anchor"], limit=stroke["mask"], coverage=coverage
+            )
+        return img, coverage
+
+    def recipe_pnginfo(self, recipe, metadata=None):
+        """操作レシピをPNGのテキストチャンクとして追加"""
+        from PIL.PngImagePlugin import PngInfo
+        if metadata is None:
+            metadata = PngInfo()
+        metadata.add_text(RECIPE_CHUNK, json.dumps(recipe, separators=(",", ":")))
+        return metadata
+
+    def save_recipe(self, recipe, image_path):
+        """操作レシピをサイドカーファイルに保存"""
+        with open(image_path + RECIPE_SIDECAR_SUFFIX, "w", encoding="utf-8") as f:
+            json.dump(recipe, f, separators=(",", ":"))
+
+    def load_recipe(self, image_path):
+        """サイドカーファイルまたはPNGのテキストチャンクから操作レシピを読み込む（無い場合は None）"""
+        sidecar = image_path + RECIPE_SIDECAR_SUFFIX
+        if os.path.exists(sidecar):
+            with open(sidecar, encoding="utf-8") as f:
+                return json.load(f)
+        if image_path.lower().endswith('.png'):
+            from PIL import Image
+            with Image.open(image_path) as img:
+                if RECIPE_CHUNK in img.info:
+                    return json.loads(img.info[RECIPE_CHUNK])
+        return None
+
+    def process_masked_area(self, image, mask_coords, drag_coords, mode, custom_mosaic_size=None, multiplier=1,
+                            in_place=True, origin=None, coverage=None):
+        """ドラッグ範囲を処理範囲（マスク）内に制限してモザイクを適用
+
+        処理対象のブロックを1回で求め、呼び出し元の画像を直接書き換える。
+        origin を指定すると基準点グリッドに整列させる（省略時はマスク原点基準）。
+        (画像, 変更範囲) を返す。変更範囲は画像座標の (x1, y1, x2, y2)、変更が無い場合は None。
+        """
         if image is None or mask_coords is None or drag_coords is None:
-            return image
+            return image, None
             
-        img = image.copy()
+        img = image if in_place else image.copy()
         img_height, img_width = img.shape[:2]
         
-        # マスク座標を取得
-        mask_x1, mask_y1, mask_x2, mask_y2 = mask_coords
+        # マスク座標を取得（画像範囲内に制限）
+        mask_x1, mask_y1, mask_x2, mask_y2 = map(int, mask_coords)
+        mask_x1, mask_x2 = max(0, mask_x1), min(img_width, mask_x2)
+        mask_y1, mask_y2 = max(0, mask_y1), min(img_height, mask_y2)
         
         # ドラッグ座標を取得
-        drag_x1, drag_y1, drag_x2, drag_y2 = drag_coords
+        drag_x1, drag_y1, drag_x2, drag_y2 = map(int, drag_coords)
         
         # 処理範囲をマスク範囲内に制限
         x1 = max(drag_x1, mask_x1)
@@ -166,9 +590,9 @@ Contact: alexia.douglas789@vellod-ec.com"""
         x2 = min(drag_x2, mask_x2)
         y2 = min(drag_y2, mask_y2)
         
-        # 重複がない場合は元の画像を返す
+        # 重複がない場合は何もしない
         if x1 >= x2 or y1 >= y2:
-            return img
+            return img, None
         
         # モザイクサイズの決定
         if mode == "manual_fanza":
@@ -179,30 +603,23 @@ Contact: alexia.douglas789@vellod-ec.com"""
         # 倍率を適用
         mosaic_size = mosaic_size * multiplier
         
-        # マスク範囲を切り出し
-        mask_roi = img[mask_y1:mask_y2, mask_x1:mask_x2].copy()
-        
-        # 処理範囲をマスク範囲内の相対座標に変換
-        rel_x1 = x1 - mask_x1
-        rel_y1 = y1 - mask_y1
-        rel_x2 = x2 - mask_x1
-        rel_y2 = y2 - mask_y1
-        
-        # 最適なクリック間隔を計算（モザイクサイズの2倍）
-        click_interval = mosaic_size * 2
+        if origin is not None:
+            # 基準点グリッドに整列させ、マスク範囲外には書き込まない
+            return self.process_region(
+                img, (x1, y1, x2, y2), mosaic_size,
+                origin=origin, limit=(mask_x1, mask_y1, mask_x2, mask_y2), coverage=coverage
+            )
         
-        # 処理範囲内を最適化された間隔でクリックしたことにする
-        for y in range(rel_y1, rel_y2, click_interval):
-            for x in range(rel_x1, rel_x2, click_interval):
-                # マスク範囲内かチェック
-                if 0 <= x < mask_roi.shape[1] and 0 <= y < mask_roi.shape[0]:
-                    # クリック位置にモザイクを適用
-                    mask_roi = self.process_click_on_roi(mask_roi, x, y, mode, mosaic_size)
+        # マスク範囲のビューに対して、マスク原点基準のグリッドで処理
+        mask_view = img[mask_y1:mask_y2, mask_x1:mask_x2]
+        rel_rect = (x1 - mask_x1, y1 - mask_y1, x2 - mask_x1, y2 - mask_y1)
+        _, dirty = self.process_region(mask_view, rel_rect, mosaic_size)
+        if dirty is None:
+            return img, None
         
-        # 処理済みのマスク範囲を元の画像に合成
-        img[mask_y1:mask_y2, mask_x1:mask_x2] = mask_roi
-        
-        return img
+        # 変更範囲を画像座標に変換
+        dx1, dy1, dx2, dy2 = dirty
+        return img, (dx1 + mask_x1, dy1 + mask_y1, dx2 + mask_x1, dy2 + mask_y1)
 
     def process_click_on_roi(self, roi, click_x, click_y, mode, mosaic_size):
         """ROI（Region of Interest）内のクリック位置にモザイクを適用"""
@@ -229,11 +646,38 @@ Contact: alexia.douglas789@vellod-ec.com"""
         img = self.apply_mosaic(img, x1, y1, x2, y2, mosaic_size)
         return img
 
+    def ensure_reference_point(self, x, y, mosaic_size):
+        """基準点が未設定の場合はクリック位置を基準点として保存し、基準点を返す"""
+        if self.reference_point is None:
+            self.reference_point = (int(x), int(y))
+        self.current_mosaic_size = int(mosaic_size)
+        return self.reference_point
+
     def load_reference_point(self, image_path):
-        """PNGファイルから基準点を読み込む"""
-        if image_path and image_path.lower().endswith('.png'):
+        """PNG・JPEG・TIFFファイルから基準点を読み込む（処理済みブロックの記録も破棄）"""
+        self.coverage.clear()
+        if image_path and image_path.lower().endswith(('.jpg', '.jpeg', '.tif', '.tiff')):
+            try:
+                info = read_image_metadata(image_path)
+                if 'ReferencePoint' in info:
+                    x, y = json.loads(info['ReferencePoint'])
+                    self.reference_point = (int(x), int(y))
+                    mosaic_size = info.get('MosaicSize')
+                    self.current_mosaic_size = int(mosaic_size) if mosaic_size else None
+                    return True
+            except Exception as e:
+                print(f"メタデータの読み込みに失敗しました: {e}")
+        elif image_path and image_path.lower().endswith('.png'):
+            from PIL import Image
             try:
                 with Image.open(image_path) as img:
+                    if 'ReferencePoint' in img.info:
+                        # save_with_metadata で保存した形式
+                        x, y = json.loads(img.info['ReferencePoint'])
+                        self.reference_point = (int(x), int(y))
+                        mosaic_size = img.info.get('MosaicSize')
+                        self.current_mosaic_size = int(mosaic_size) if mosaic_size else None
+                        return True
                     if 'reference_point' in img.info:
                         ref_data = json.loads(img.info['reference_point'])
                         self.reference_point = (ref_data['x'], ref_data['y'])
@@ -245,8 +689,32 @@ Contact: alexia.douglas789@vellod-ec.com"""
         self.current_mosaic_size = None
         return False
 
-    def save_with_metadata(self, image, file_path):
-        """画像をメタデータ付きで保存"""
+    def metadata_texts(self):
+        """保存する画像に書き込むメタデータ（キーワードと値の辞書）"""
+        texts = {"Software": "Vellod Mosaic Tool", "ProcessingInfo": self.metadata_text}
+        if self.reference_point:
+            texts["ReferencePoint"] = json.dumps(self.reference_point)
+        if self.current_mosaic_size:
+            texts["MosaicSize"] = str(self.current_mosaic_size)
+        return texts
+
+    def retag_metadata(self, file_path):
+        """保存済みの画像のメタデータを書き換える（画素データは再エンコードしない）"""
+        try:
+            retag_image(file_path, self.metadata_texts())
+            return True
+        except Exception as e:
+            print(f"メタデータの書き換えに失敗: {str(e)}")
+            return False
+
+    def save_with_metadata(self, image, file_path, recipe=None, options=None):
+        """画像をメタデータ付きで保存（操作レシピがあれば併せて保存）
+
+        options には保存形式の設定（encode_options の戻り値）を指定する。
+        """
+        import cv2
+        from PIL import Image
+        from PIL.PngImagePlugin import PngInfo
         try:
             # ファイル拡張子を取得
             ext = os.path.splitext(file_path)[1].lower().lstrip('.')
@@ -254,20 +722,32 @@ Contact: alexia.douglas789@vellod-ec.com"""
             if ext in self.metadata_formats:
                 # メタデータを準備
                 metadata = PngInfo()
-                metadata.add_text("Software", "Vellod Mosaic Tool")
-                metadata.add_text("ProcessingInfo", self.metadata_text)
+                for key, value in self.metadata_texts().items():
+                    metadata.add_text(key, value)
+                if recipe is not None:
+                    if ext == 'png':
+                        self.recipe_pnginfo(recipe, metadata)
+                    else:
+                        self.save_recipe(recipe, file_path)
                 
-                if self.reference_point:
-                    metadata.add_text("ReferencePoint", json.dumps(self.reference_point))
-                if self.current_mosaic_size:
-                    metadata.add_text("MosaicSize", str(self.current_mosaic_size))
+                if isinstance(image, np.ndarray) and ext in ('png', 'jpg', 'jpeg'):
+                    # BGRのままエンコードし、PNGにはメタデータのチャンクを挿入
+                    encode_image(image, file_path, ext, metadata if ext == 'png' else None, **(options or {}))
+                    if ext != 'png':
+                        # JPEGはエンコード後にメタデータ用のコメントを書き込む
+                        retag_image(file_path, self.metadata_texts())
+                    return True
                 
                 # PILイメージに変換
                 if isinstance(image, np.ndarray):
                     image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
                 
-                # メタデータ付きで保存
-                image.save(file_path, pnginfo=metadata)
+                # メタデータ付きで保存（JPEG・TIFFは PngInfo が使われないため保存後に書き込む）
+                if ext == 'png':
+                    image.save(file_path, pnginfo=metadata)
+                else:
+                    image.save(file_path)
+                    retag_image(file_path, self.metadata_texts())
                 return True
             else:
                 # メタデータ非対応フォーマットの場合
@@ -275,6 +755,8 @@ Contact: alexia.douglas789@vellod-ec.com"""
                     cv2.imwrite(file_path, image)
                 else:
                     image.save(file_path)
+                if recipe is not None:
+                    self.save_recipe(recipe, file_path)
                 return False
                 
         except Exception as e:
@@ -0,0 +1,166 @@
+"""
+クイック保存・モザイク不要の保存キュー（Tk非依存）
+
+保存の要求は、要求した時点の画像（share_image で共有した読み取り専用の配列）と
+パスをまとめた SaveJob としてキューに入れ、1つのワーカースレッドが要求順に処理する。
+保存中も次の画像の編集を続けられ、後から画面側の状態が変わっても保存内容は変わらない。
+未完了の要求数には上限があり、上限に達している間は新しい要求を受け付けない。
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+from mosaic_core import encode_image, link_or_copy, share_image
+
+# 未完了の保存要求の上限
+DEFAULT_MAX_PENDING = 4
+
+# 保存要求の状態
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class SaveJob:
+    """1枚分の保存要求
+
+    kind は "encode"（image を target_path にエンコード）または "copy"
+    （source_path のファイルを target_path に複製。可能であればデータはコピーしない）。保存後、source_path の
+    元画像を original_folder に移動する。内容は作成後に変更しない
+    （status・error・elapsed・encode_time・method・moved のみワーカーが更新する）。
+    encode_time はエンコードと書き込みの時間、method は複製の方法（link_or_copy の戻り値）、
+    moved は元画像を移動したかどうか（移動先に同名のファイルがある場合は移動しない）。
+    """
+
+    __slots__ = (
+        "kind", "source_path", "target_path", "ext", "original_folder",
+        "image", "pnginfo", "options", "recipe", "save_recipe",
+        "status", "error", "elapsed", "encode_time", "method", "moved",
+    )
+
+    def __init__(self, kind, source_path, target_path, ext, original_folder,
+                 image=None, pnginfo=None, options=None, recipe=None, save_recipe=None):
+        self.kind = kind
+        self.source_path = source_path
+        self.target_path = target_path
+        self.ext = ext
+        self.original_folder = original_folder
+        self.image = share_image(image) if image is not None else None
+        self.pnginfo = pnginfo
+        self.options = dict(options or {})  # 保存形式の設定（圧縮レベル・品質）
+        self.recipe = recipe
+        self.save_recipe = save_recipe  # PNG以外で操作レシピをサイドカーに保存する関数
+        self.status = PENDING
+        self.error = None
+        self.elapsed = None
+        self.encode_time = None
+        self.method = None
+        self.moved = False
+
+    @property
+    def name(self):
+        return os.path.basename(self.target_path)
+
+    def run(self):
+        """保存して元画像を移動"""
+        if self.kind == "encode":
+            # モザイク処理済み画像の保存（操作レシピはPNGならチャンク、それ以外はサイドカー）
+            start = time.perf_counter()
+            encode_image(self.image, self.target_path, self.ext, self.pnginfo, **self.options)
+            self.encode_time = time.perf_counter() - start
+            if self.recipe is not None and self.ext != "png":
+                self.save_recipe(self.recipe, self.target_path)
+        else:
+            # 元画像をそのまま複製（リフリンク・ハードリンクを優先し、できない場合はコピー）
+            self.method = link_or_copy(self.source_path, self.target_path)
+
+        # オリジナル画像の移動
+        if self.source_path:
+            original_dest = os.path.join(self.original_folder, os.path.basename(self.source_path))
+            if not os.path.exists(original_dest):
+                os.rename(self.source_path, original_dest)
+                self.moved = True
+
+
+class SaveQueue:
+    """保存要求を1つのワーカースレッドで要求順に処理するキュー
+
+    on_finished(job) は保存が終わるたびにワーカースレッドから呼ばれる。
+    """
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING, on_finished=None):
+        self.max_pending = max_pending
+        self.on_finished = on_finished
+        self.waiting = deque()  # 処理待ちの要求
+        self.running = None  # 処理中の要求
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @property
+    def pending(self):
+        """未完了の要求数（処理中を含む）"""
+        with self.condition:
+            return len(self.waiting) + (self.running is not None)
+
+    def full(self):
+        return self.pending >= self.max_pending
+
+    def submit(self, job):
+        """要求を追加（上限に達している場合や終了後は追加せず False を返す）"""
+        with self.condition:
+            if self.closed or len(self.waiting) + (self.running is not None) >= self.max_pending:
+                return False
+            self.waiting.append(job)
+            self.condition.notify_all()
+        return True
+
+    def outstanding(self):
+        """未完了の要求の一覧（要求順）"""
+        with self.condition:
+            jobs = list(self.waiting)
+            if self.running is not None:
+                jobs.insert(0, self.running)
+            return jobs
+
+    def drain(self, timeout=None):
+        """未完了の要求がすべて終わるまで待つ（タイムアウト時は False）"""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.waiting and self.running is None, timeout
+            )
+
+    def shutdown(self, timeout=None):
+        """未完了の要求を処理し終えてからワーカーを停止"""
+        self.drain(timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.waiting and not self.closed:
+                    self.condition.wait()
+                if not self.waiting:
+                    return
+                job = self.running = self.waiting.popleft()
+                job.status = RUNNING
+            start = time.perf_counter()
+            try:
+                job.run()
+                job.status = DONE
+            except Exception as e:
+                job.status = FAILED
+                job.error = str(e)
+            job.elapsed = time.perf_counter() - start
+            with self.condition:
+                self.running = None
+                self.condition.notify_all()
+            if self.on_finished is not None:
+                self.on_finished(job)
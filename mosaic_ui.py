@@ -1,13 +1,26 @@
 import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
-import cv2
-import numpy as np
+from mosaic_core import DEFAULT_SAVE_PROFILE, SAVE_PROFILES, save_profile
+from mosaic_display import DisplayPyramid
+from mosaic_viewport import Viewport
+
+# 操作が止まってから高画質で描き直すまでの時間（ミリ秒）
+QUALITY_DELAY_MS = 150
+# マウスホイール1段あたりの拡大率
+ZOOM_STEP = 1.25
 
 class MosaicUI:
     def __init__(self, root, app):
         self.root = root
         self.app = app
+        self.display_cache = DisplayPyramid()  # 表示用の縮小画像のキャッシュ
+        self.viewport = Viewport()  # 表示範囲（拡大率・表示位置）とキャンバス座標の変換
+        self._pan_start = None  # 表示位置の移動を開始したキャンバス座標
+        self.photo = None  # 表示中のPhotoImage（キャンバスの表示サイズが同じ間は使い回す）
+        self._quality_job = None  # 高画質での描き直しの予約
+        self._live_base = None  # ドラッグ中のプレビューの基にする表示用の画像
+        self._live_shown = False  # プレビューを描画したか
         self.setup_ui()
         
     def setup_ui(self):
@@ -51,12 +64,14 @@ class MosaicUI:
         self.mosaic_button = ttk.Button(button_frame, text="モザイク処理", command=self.app.toggle_mosaic_mode)
         self.mosaic_button.grid(row=0, column=9, padx=4, sticky=tk.EW)
         
-        # --- クイック保存用ラジオボタンとボタン ---
-        self.save_format_var = tk.StringVar(value="png")
+        # --- クイック保存用ラジオボタン（保存形式）とボタン ---
+        self.save_format_var = tk.StringVar(value=DEFAULT_SAVE_PROFILE)
+        self.jpeg_quality_var = tk.StringVar(value=str(SAVE_PROFILES["jpg"]["quality"]))
         radio_frame = ttk.Frame(button_frame)
         radio_frame.grid(row=0, column=10, padx=4, sticky=tk.EW)
-        ttk.Radiobutton(radio_frame, text="PNG", variable=self.save_format_var, value="png").pack(side=tk.LEFT)
-        ttk.Radiobutton(radio_frame, text="JPEG", variable=self.save_format_var, value="jpg").pack(side=tk.LEFT)
+        for name, profile in SAVE_PROFILES.items():
+            ttk.Radiobutton(radio_frame, text=profile["label"], variable=self.save_format_var, value=name).pack(side=tk.LEFT)
+        ttk.Spinbox(radio_frame, from_=50, to=100, width=3, textvariable=self.jpeg_quality_var).pack(side=tk.LEFT)
         self.quick_save_button = ttk.Button(button_frame, text="クイック保存", command=self.app.file_handler.quick_save_image)
         self.quick_save_button.grid(row=0, column=11, padx=4, sticky=tk.EW)
         # ---
@@ -121,9 +136,16 @@ class MosaicUI:
                 multiplier_frame,
                 text=text,
                 value=value,
-                variable=self.mosaic_multiplier_var
+                variable=self.mosaic_multiplier_var,
+                command=self.app.rerender_strokes
             ).grid(row=0, column=i, padx=5)
         
+        # ドラッグ中に表示用の縮小画像でモザイクの仕上がりを表示するか
+        self.live_preview_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(
+            size_frame, text="ドラッグ中にプレビュー", variable=self.live_preview_var
+        ).grid(row=0, column=3, padx=10)
+        
         # 数値入力の検証関数
         def validate_mosaic_size(P):
             if P == "": return True
@@ -137,6 +159,10 @@ class MosaicUI:
         vcmd = (self.root.register(validate_mosaic_size), '%P')
         self.mosaic_size_entry.config(validate='key', validatecommand=vcmd)
         
+        # サイズ確定時にこれまでのストロークを再描画
+        self.mosaic_size_entry.bind('<Return>', self.app.rerender_strokes)
+        self.mosaic_size_entry.bind('<FocusOut>', self.app.rerender_strokes)
+        
         # 画像表示用のフレーム
         display_frame = ttk.Frame(main_frame)
         display_frame.grid(row=2, column=0, columnspan=4, pady=10)
@@ -159,6 +185,8 @@ class MosaicUI:
             'max_dimension': ttk.Label(param_frame, text="長辺: -", width=25),
             'mask_status': ttk.Label(param_frame, text="処理範囲: なし", width=25),
             'mosaic_status': ttk.Label(param_frame, text="モザイク処理: 有効", width=25),
+            'history': ttk.Label(param_frame, text="履歴: -", width=25),
+            'save_status': ttk.Label(param_frame, text="保存: -", width=25, wraplength=200),
             'description': ttk.Label(param_frame, text="説明: 最小4ピクセル平方モザイクかつ画像全体の長辺が400ピクセル以上の場合、\n必要部位に「画像全体長辺×1/100」程度を算出したピクセル平方モザイク(FANZA仕様)\n※自己責任でご利用ください", wraplength=200)
         }
         
@@ -179,6 +207,17 @@ class MosaicUI:
         self.canvas.bind("<B1-Motion>", self.app.on_canvas_drag)
         self.canvas.bind("<ButtonRelease-1>", self.app.on_canvas_release)
         
+        # 拡大・縮小（マウスホイール）と表示位置の移動（中ボタン・右ボタンのドラッグ）
+        self.canvas.bind("<MouseWheel>", self.on_zoom)
+        self.canvas.bind("<Button-4>", self.on_zoom)
+        self.canvas.bind("<Button-5>", self.on_zoom)
+        for button in (2, 3):
+            self.canvas.bind(f"<Button-{button}>", self.on_pan_start)
+            self.canvas.bind(f"<B{button}-Motion>", self.on_pan)
+        # Ctrl+0 で全体表示、Ctrl+1 で等倍表示
+        self.root.bind("<Control-Key-0>", self.fit_view)
+        self.root.bind("<Control-Key-1>", self.actual_size_view)
+        
         # グリッドの重みを設定して、ウィンドウリサイズ時に適切に拡大/縮小されるようにする
         main_frame.columnconfigure(0, weight=1)
         main_frame.rowconfigure(2, weight=1)
@@ -214,47 +253,137 @@ class MosaicUI:
         
         widget.bind('<Enter>', show_tooltip)
 
-    def display_image(self, img):
+    def display_image(self, img, dirty=None, interactive=False):
+        """画像をキャンバスに表示
+
+        dirty（変更範囲）を指定すると、前回表示した画像からの変更範囲だけを
+        縮小し直す。編集で画像を直接書き換えた場合は必ず指定する。
+        interactive=True（ドラッグ・画像送りなどの操作中）は軽いリサンプリングで
+        すぐに表示し、操作が止まった後に高画質で描き直す。
+        """
         if img is None:
             return
+        self._cancel_quality_job()
             
-        # OpenCVのBGRからRGBに変換
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        
-        # PILイメージに変換
-        pil_img = Image.fromarray(img_rgb)
+        # キャンバスと画像の大きさから表示範囲を更新
+        self.viewport.set_canvas(self.canvas.winfo_width(), self.canvas.winfo_height())
+        self.viewport.set_image(img.shape[1], img.shape[0])
+        rect, size, (canvas_x, canvas_y) = self.viewport.view()
         
-        # キャンバスサイズに合わせてリサイズ
-        canvas_width = self.canvas.winfo_width()
-        canvas_height = self.canvas.winfo_height()
+        # 表示範囲の縮小画像（キャッシュから作成し、RGBに変換済み）
+        display_rgb = self.display_cache.render(img, size, dirty, fast=interactive, rect=rect)
         
-        # アスペクト比を保持してリサイズ
-        img_ratio = pil_img.width / pil_img.height
-        canvas_ratio = canvas_width / canvas_height
-        
-        if img_ratio > canvas_ratio:
-            new_width = canvas_width
-            new_height = int(canvas_width / img_ratio)
-        else:
-            new_height = canvas_height
-            new_width = int(canvas_height * img_ratio)
-            
-        pil_img = pil_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # PhotoImageに変換
-        self.photo = ImageTk.PhotoImage(pil_img)
+        # PhotoImageに変換（同じ大きさであれば既存のPhotoImageに貼り付ける）
+        self._show_photo(Image.fromarray(display_rgb))
         
         # キャンバスに表示
         self.canvas.delete("all")
         self.canvas.create_image(
-            canvas_width//2, canvas_height//2,
+            canvas_x, canvas_y,
             image=self.photo,
-            anchor=tk.CENTER
+            anchor=tk.NW
         )
         
         # 処理範囲表示を更新
         if self.app.mask_coords is not None:
             self.app.update_mask_display()
+        
+        if interactive:
+            self._schedule_quality_redraw()
+
+    def _show_photo(self, pil_img):
+        """表示用の画像をPhotoImageに反映"""
+        if self.photo is not None and (self.photo.width(), self.photo.height()) == pil_img.size:
+            self.photo.paste(pil_img)
+        else:
+            self.photo = ImageTk.PhotoImage(pil_img)
+
+    def _cancel_quality_job(self):
+        if self._quality_job is not None:
+            self.root.after_cancel(self._quality_job)
+            self._quality_job = None
+
+    def _schedule_quality_redraw(self):
+        """操作が止まった後に、高画質で描き直す"""
+        self._cancel_quality_job()
+        self._quality_job = self.root.after(QUALITY_DELAY_MS, self._quality_redraw)
+
+    def _quality_redraw(self):
+        """表示中の画像を高画質のリサンプリングで描き直す（キャンバス上の他の表示はそのまま）"""
+        self._quality_job = None
+        cache = self.display_cache
+        if cache.source is None or cache.display_size is None:
+            return
+        display_rgb = cache.render(cache.source, cache.display_size, rect=cache.display_rect)
+        if self.photo is not None and (self.photo.width(), self.photo.height()) == cache.display_size:
+            self.photo.paste(Image.fromarray(display_rgb))
+
+    def begin_live_preview(self):
+        """ドラッグ中のプレビューを開始（表示中の縮小画像を基にする）"""
+        self._cancel_quality_job()
+        self._live_base = self.display_cache.display
+        self._live_shown = False
+
+    def show_live_preview(self, image_shape, rect, mosaic_size, origin, limit=None):
+        """表示中の縮小画像のコピーにモザイクを描画して表示（rect が None なら元の表示に戻す）
+
+        元の解像度の画像は書き換えず、処理はドラッグ終了時に1回だけ行う。
+        """
+        base = self._live_base
+        if base is None or self.photo is None or (self.photo.width(), self.photo.height()) != base.shape[1::-1]:
+            return
+        frame = base.copy()
+        if rect is not None:
+            self.app.processor.preview_region(
+                frame, image_shape, rect, mosaic_size, origin, limit, self.display_cache.display_rect
+            )
+        self.photo.paste(Image.fromarray(frame))
+        self._live_shown = True
+
+    def end_live_preview(self):
+        """ドラッグ中のプレビューを終了し、プレビューを描画していたかどうかを返す"""
+        shown = self._live_shown
+        self._live_base = None
+        self._live_shown = False
+        return shown
+
+    def on_zoom(self, event):
+        """マウスホイールでカーソル位置を中心に拡大・縮小"""
+        if self.app.current_image is None or self.app.is_dragging:
+            return
+        if event.num == 4 or event.delta > 0:
+            factor = ZOOM_STEP
+        else:
+            factor = 1 / ZOOM_STEP
+        self.viewport.zoom_at(factor, event.x, event.y)
+        self.display_image(self.app.current_image, interactive=True)
+
+    def on_pan_start(self, event):
+        self._pan_start = (event.x, event.y)
+
+    def on_pan(self, event):
+        """ドラッグで表示位置を移動"""
+        if self.app.current_image is None or self._pan_start is None:
+            return
+        self.viewport.pan(event.x - self._pan_start[0], event.y - self._pan_start[1])
+        self._pan_start = (event.x, event.y)
+        self.display_image(self.app.current_image, interactive=True)
+
+    def fit_view(self, event=None):
+        """画像全体を表示"""
+        self.viewport.fit()
+        if self.app.current_image is not None:
+            self.display_image(self.app.current_image)
+
+    def actual_size_view(self, event=None):
+        """元の解像度の等倍で表示（プレビュー用の縮小画像は元の解像度に換算）"""
+        if self.app.current_image is None:
+            return
+        scale = 1.0
+        if self.app.image_shape is not None:
+            scale = self.app.image_shape[1] / self.app.current_image.shape[1]
+        self.viewport.zoom_to(scale)
+        self.display_image(self.app.current_image)
 
     def display_preview_image(self):
         """プレビュー用の画像を表示"""
@@ -284,7 +413,7 @@ class MosaicUI:
         # モザイクサイズ表示の更新
         if self.app.mode == "manual_fanza":
             # FANZA仕様のモザイクサイズを計算
-            base_mosaic_size = self.app.processor.calculate_fanza_mosaic_size(self.app.current_image.shape)
+            base_mosaic_size = self.app.processor.calculate_fanza_mosaic_size(self.app.image_shape)
             multiplier = int(self.mosaic_multiplier_var.get())
             mosaic_size = base_mosaic_size * multiplier
             self.param_labels['mosaic_size'].config(
@@ -300,7 +429,7 @@ class MosaicUI:
             )
         
         # 画像サイズ表示の更新
-        h, w = self.app.current_image.shape[:2]
+        h, w = self.app.image_shape[:2]
         self.param_labels['image_size'].config(
             text=f"画像サイズ: {w}x{h}"
         )
@@ -365,13 +494,38 @@ class MosaicUI:
     def update_history_buttons(self):
         """履歴操作ボタンの状態を更新"""
         # 戻るボタン
-        if self.app.history_index > 0:
+        if self.app.history.can_undo():
             self.undo_button.config(state='normal')
         else:
             self.undo_button.config(state='disabled')
             
         # 進むボタン
-        if self.app.history_index < len(self.app.history) - 1:
+        if self.app.history.can_redo():
             self.redo_button.config(state='normal')
         else:
-            self.redo_button.config(state='disabled') 
\ No newline at end of file
+            self.redo_button.config(state='disabled')
+        
+        # 履歴の使用量表示の更新
+        usage = self.app.history.footprint()
+        mb = 1024 * 1024
+        text = f"履歴: {usage['entries']}件 {(usage['memory'] + usage['compressed']) / mb:.1f}MB"
+        if usage['file']:
+            text += f" (退避 {usage['file'] / mb:.1f}MB)"
+        self.param_labels['history'].config(text=text) 
+
+    def save_profile(self):
+        """選択中の保存形式の設定（JPEGの品質は入力欄の値）"""
+        profile = dict(save_profile(self.save_format_var.get()))
+        if "quality" in profile:
+            try:
+                profile["quality"] = min(100, max(1, int(self.jpeg_quality_var.get())))
+            except ValueError:
+                pass
+        return profile
+
+    def update_save_status(self, text=None):
+        """保存キューの状態表示を更新（text の省略時は保存待ちの件数を表示）"""
+        if text is None:
+            pending = self.app.file_handler.save_queue.pending
+            text = f"保存: 保存待ち {pending}件" if pending else "保存: -"
+        self.param_labels['save_status'].config(text=text)
@@ -0,0 +1,158 @@
+"""
+キャンバスの表示範囲（拡大率とスクロール位置）と座標変換（Tk非依存）
+
+キャンバス座標と画像座標の変換はすべて Viewport を通して行う。
+初期状態はキャンバスに画像全体を収める表示（フィット表示）で、拡大すると
+画像の一部だけを表示し、ドラッグなどで表示位置を移動できる。
+"""
+
+import math
+
+# 拡大率の上限（表示上の画素 / 画像の画素）
+MAX_ZOOM = 8.0
+
+
+class Viewport:
+    """画像のどの範囲をキャンバスのどこに表示するかを管理する
+
+    scale は画像1画素あたりのキャンバス上の画素数、offset は画像の原点の
+    キャンバス上の位置。フィット表示中はキャンバスや画像の大きさが変わると
+    自動で全体を収め直す。
+    """
+
+    def __init__(self):
+        self.image_size = None  # (幅, 高さ)
+        self.canvas_size = (1, 1)
+        self.scale = 1.0
+        self.offset = (0.0, 0.0)
+        self.fitted = True
+
+    def set_canvas(self, width, height):
+        """キャンバスの大きさを設定"""
+        size = (max(1, int(width)), max(1, int(height)))
+        if size != self.canvas_size:
+            self.canvas_size = size
+            self._refresh()
+
+    def set_image(self, width, height):
+        """表示する画像の大きさを設定
+
+        拡大表示中に大きさが変わった場合（縮小画像から元の解像度への切り替えなど）は、
+        同じ範囲が表示されるよう拡大率を合わせる。
+        """
+        size = (int(width), int(height))
+        if size == self.image_size:
+            return
+        if self.image_size is not None and not self.fitted:
+            self.scale *= self.image_size[0] / size[0]
+        self.image_size = size
+        self._refresh()
+
+    def fit(self):
+        """画像全体をキャンバスに収める表示に戻す"""
+        self.fitted = True
+        self._refresh()
+
+    def fit_size(self):
+        """画像全体をキャンバスに収めた場合の表示サイズ（縦横比を保持）"""
+        (width, height), (canvas_width, canvas_height) = self.image_size, self.canvas_size
+        img_ratio = width / height
+        if img_ratio > canvas_width / canvas_height:
+            return canvas_width, max(1, int(canvas_width / img_ratio))
+        return max(1, int(canvas_height * img_ratio)), canvas_height
+
+    @property
+    def fit_scale(self):
+        """画像全体をキャンバスに収める拡大率"""
+        return self.fit_size()[0] / self.image_size[0]
+
+    def zoom_at(self, factor, canvas_x, canvas_y):
+        """キャンバス上の位置 (canvas_x, canvas_y) を中心に拡大率を factor 倍にする"""
+        if self.image_size is None:
+            return
+        self.zoom_to(self.scale * factor, canvas_x, canvas_y)
+
+    def zoom_to(self, scale, canvas_x=None, canvas_y=None):
+        """拡大率を scale にする（位置の省略時はキャンバスの中央を中心にする）
+
+        フィット表示より小さくはしない。
+        """
+        if self.image_size is None:
+            return
+        if canvas_x is None:
+            canvas_x, canvas_y = self.canvas_size[0] / 2, self.canvas_size[1] / 2
+        scale = min(scale, max(MAX_ZOOM, self.fit_scale))
+        if scale <= self.fit_scale:
+            self.fit()
+            return
+        # 指定位置の下にある画像上の点が動かないように表示位置を調整
+        image_x, image_y = self.to_image_float(canvas_x, canvas_y)
+        self.scale = scale
+        self.offset = (canvas_x - image_x * scale, canvas_y - image_y * scale)
+        self.fitted = False
+        self._clamp()
+
+    def pan(self, dx, dy):
+        """表示位置をキャンバス上の画素数で移動"""
+        if self.image_size is None or self.fitted:
+            return
+        self.offset = (self.offset[0] + dx, self.offset[1] + dy)
+        self._clamp()
+
+    def _refresh(self):
+        if self.image_size is None:
+            return
+        if self.fitted:
+            # 表示サイズを整数に切り捨てて中央に配置
+            display_width, display_height = self.fit_size()
+            self.scale = display_width / self.image_size[0]
+            self.offset = ((self.canvas_size[0] - display_width) // 2,
+                           (self.canvas_size[1] - display_height) // 2)
+        else:
+            self._clamp()
+
+    def _clamp(self):
+        """画像がキャンバスより小さい軸は中央に、大きい軸は端に隙間ができないように配置"""
+        offset = []
+        for length, canvas_length, current in zip(self.image_size, self.canvas_size, self.offset):
+            shown = length * self.scale
+            if shown <= canvas_length:
+                offset.append((canvas_length - shown) // 2)
+            else:
+                offset.append(min(0.0, max(canvas_length - shown, current)))
+        self.offset = tuple(offset)
+
+    def to_image_float(self, canvas_x, canvas_y):
+        """キャンバス座標を画像座標（小数）に変換"""
+        return (canvas_x - self.offset[0]) / self.scale, (canvas_y - self.offset[1]) / self.scale
+
+    def to_image(self, canvas_x, canvas_y):
+        """キャンバス座標を画像の画素位置に変換（画像の範囲外の場合もそのまま返す）"""
+        image_x, image_y = self.to_image_float(canvas_x, canvas_y)
+        return math.floor(image_x), math.floor(image_y)
+
+    def to_canvas(self, image_x, image_y):
+        """画像座標をキャンバス座標に変換"""
+        return image_x * self.scale + self.offset[0], image_y * self.scale + self.offset[1]
+
+    def visible_rect(self):
+        """キャンバスに表示される画像の範囲 (x1, y1, x2, y2)（画素単位に広げる）"""
+        width, height = self.image_size
+        x1, y1 = self.to_image_float(0, 0)
+        x2, y2 = self.to_image_float(*self.canvas_size)
+        return (max(0, math.floor(x1)), max(0, math.floor(y1)),
+                min(width, math.ceil(x2)), min(height, math.ceil(y2)))
+
+    def view(self):
+        """表示する画像の範囲と、その表示サイズ・キャンバス上の位置
+
+        ((x1, y1, x2, y2), (幅, 高さ), (キャンバスx, キャンバスy)) を返す。
+        """
+        rect = self.visible_rect()
+        x1, y1, x2, y2 = rect
+        if self.fitted:
+            size = self.fit_size()
+        else:
+            size = (round((x2 - x1) * self.scale), round((y2 - y1) * self.scale))
+        canvas_x, canvas_y = self.to_canvas(x1, y1)
+        return rect, (max(1, size[0]), max(1, size[1])), (round(canvas_x), round(canvas_y))
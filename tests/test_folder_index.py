@@ -0,0 +1,88 @@
+"""フォルダの画像一覧（FolderIndex）と保存要求の元画像の移動・複製のテスト"""
+
+import errno
+import os
+
+import numpy as np
+import pytest
+
+import mosaic_core
+from mosaic_core import FolderIndex, link_or_copy
+from mosaic_save_queue import SaveJob
+
+
+def _touch(folder, name):
+    path = os.path.join(folder, name)
+    with open(path, "wb") as f:
+        f.write(b"")
+    return path
+
+
+def test_remove_updates_positions(tmp_path):
+    paths = [_touch(tmp_path, f"{i}.png") for i in range(1, 4)]
+    index = FolderIndex(tmp_path)
+    os.remove(paths[1])
+
+    assert index.remove(paths[1]) == 1
+    assert index.images == [paths[0], paths[2]]
+    assert index.index(paths[2]) == 1
+    assert not index.refresh()
+
+
+def test_remove_ignores_other_folders(tmp_path):
+    folder = tmp_path / "a"
+    other = tmp_path / "b"
+    folder.mkdir()
+    other.mkdir()
+    _touch(folder, "1.png")
+    index = FolderIndex(folder)
+    stamp = index.stamp
+
+    # 別のフォルダの画像は一覧に無いため、更新時刻も記録し直さない
+    _touch(folder, "2.png")
+    os.utime(folder, ns=(stamp + 10 ** 9, stamp + 10 ** 9))
+    assert index.remove(os.path.join(other, "1.png")) is None
+    assert index.stamp == stamp
+    assert index.refresh()
+    assert len(index.images) == 2
+
+
+def test_save_job_reports_whether_original_moved(tmp_path):
+    original_folder = tmp_path / "_Original"
+    original_folder.mkdir()
+    source = _touch(tmp_path, "1.png")
+    image = np.zeros((4, 4, 3), dtype=np.uint8)
+
+    job = SaveJob("encode", source, str(tmp_path / "out_1.png"), "png", str(original_folder), image=image)
+    job.run()
+    assert job.moved and not os.path.exists(source)
+
+    # 移動先に同名のファイルがある場合は移動しない
+    source = _touch(tmp_path, "1.png")
+    job = SaveJob("encode", source, str(tmp_path / "out_2.png"), "png", str(original_folder), image=image)
+    job.run()
+    assert not job.moved and os.path.exists(source)
+
+
+def _cross_device(src, dst):
+    raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+
+@pytest.mark.parametrize("no_link", [False, True])
+def test_link_or_copy_never_overwrites(tmp_path, monkeypatch, no_link):
+    if no_link:
+        # ハードリンクできない場合（別のファイルシステム）もコピーで上書きしない
+        monkeypatch.setattr(mosaic_core.os, "link", _cross_device)
+    src = tmp_path / "src.png"
+    dst = tmp_path / "dst.png"
+    src.write_bytes(b"new")
+    dst.write_bytes(b"old")
+
+    with pytest.raises(FileExistsError):
+        link_or_copy(str(src), str(dst))
+    assert dst.read_bytes() == b"old"
+
+    dst.unlink()
+    method = link_or_copy(str(src), str(dst))
+    assert dst.read_bytes() == b"new"
+    assert method in (("reflink", "copy") if no_link else ("reflink", "hardlink"))
@@ -0,0 +1,166 @@
+"""基準点グリッドでのモザイク処理と処理済みブロックの記録（BlockCoverage）のテスト"""
+
+import numpy as np
+import pytest
+
+from mosaic_processor import BlockCoverage, MosaicProcessor
+
+
+def _image(height=90, width=110, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def _reference_grid(image, rect, size, origin, limit=None):
+    """ドラッグ範囲を2倍間隔でクリックした場合の処理を、ブロックごとに素直に計算"""
+    out = image.copy()
+    height, width = image.shape[:2]
+    lx1, ly1, lx2, ly2 = limit if limit is not None else (0, 0, width, height)
+    lx1, ly1, lx2, ly2 = max(0, lx1), max(0, ly1), min(width, lx2), min(height, ly2)
+
+    def cells(lo, hi, limit_lo, limit_hi, base):
+        # クリック位置を含むブロックの前後2ブロック分
+        result = set()
+        for pos in range(lo, hi, size * 2):
+            if limit_lo <= pos < limit_hi:
+                k = (pos - base) // size
+                result.update(range(k - 2, k + 2))
+        return result
+
+    base_x = origin[0] % size - size if origin[0] % size else 0
+    base_y = origin[1] % size - size if origin[1] % size else 0
+    x1, y1, x2, y2 = rect
+    for ky in cells(y1, y2, ly1, ly2, base_y):
+        for kx in cells(x1, x2, lx1, lx2, base_x):
+            ya, yb = max(base_y + ky * size, ly1), min(base_y + (ky + 1) * size, ly2)
+            xa, xb = max(base_x + kx * size, lx1), min(base_x + (kx + 1) * size, lx2)
+            if ya >= yb or xa >= xb:
+                continue
+            # ブロック中央の画素（偶数長は中央2画素）の平均
+            y0 = ya + (yb - ya - 1) // 2
+            x0 = xa + (xb - xa - 1) // 2
+            ys = [y0, y0 + ((yb - ya) % 2 == 0)]
+            xs = [x0, x0 + ((xb - xa) % 2 == 0)]
+            acc = sum(image[y, x].astype(np.uint16) for y in ys for x in xs)
+            out[ya:yb, xa:xb] = (acc + 2) >> 2
+    return out
+
+
+STROKES = [
+    # (範囲, モザイクサイズ, 基準点, 処理可能範囲)
+    ((20, 20, 60, 50), 8, (0, 0), None),
+    ((20, 20, 60, 50), 8, (3, 5), None),
+    ((0, 0, 110, 90), 7, (13, 29), None),
+    ((-30, -30, 15, 12), 10, (4, 4), None),       # 左上の画像端
+    ((90, 70, 200, 150), 9, (1, 2), None),        # 右下の画像端（端数ブロック）
+    ((10, 10, 100, 80), 6, (5, 1), (25, 17, 70, 61)),
+]
+
+
+@pytest.mark.parametrize("rect, size, origin, limit", STROKES)
+def test_grid_matches_reference(rect, size, origin, limit):
+    image = _image()
+    expected = _reference_grid(image, rect, size, origin, limit)
+    result, dirty = MosaicProcessor().process_region(image.copy(), rect, size, origin=origin, limit=limit)
+
+    np.testing.assert_array_equal(result, expected)
+    changed = np.argwhere((result != image).any(axis=2))
+    if len(changed):
+        x1, y1, x2, y2 = dirty
+        assert changed[:, 0].min() >= y1 and changed[:, 0].max() < y2
+        assert changed[:, 1].min() >= x1 and changed[:, 1].max() < x2
+
+
+@pytest.mark.parametrize("rect, size, origin, limit", STROKES)
+def test_region_bounds_contains_changes(rect, size, origin, limit):
+    image = _image()
+    processor = MosaicProcessor()
+    bounds = processor.region_bounds(image.shape, rect, size, origin=origin, limit=limit)
+    result, _ = processor.process_region(image.copy(), rect, size, origin=origin, limit=limit)
+
+    x1, y1, x2, y2 = bounds
+    outside = np.ones(image.shape[:2], dtype=bool)
+    outside[y1:y2, x1:x2] = False
+    np.testing.assert_array_equal(result[outside], image[outside])
+
+
+@pytest.mark.parametrize("origin", [(0, 0), (3, 7), (11, 2)])
+def test_block_edges_follow_reference_point(origin):
+    size = 12
+    image = _image()
+    result, _ = MosaicProcessor().process_region(image.copy(), (0, 0, 110, 90), size, origin=origin)
+
+    # ブロックの境界は基準点から size 間隔に並び、各ブロック内は1色
+    for y in range(origin[1] % size, 90 - size, size):
+        for x in range(origin[0] % size, 110 - size, size):
+            block = result[y:y + size, x:x + size]
+            assert (block == block[0, 0]).all()
+
+
+def test_overlapping_strokes_with_coverage_match_without():
+    strokes = [
+        ((10, 10, 60, 50), 8, (3, 5), None),
+        ((30, 25, 100, 85), 8, (3, 5), None),        # 同じグリッドで重なる
+        ((0, 0, 110, 90), 8, (3, 5), (40, 30, 80, 70)),
+        ((20, 20, 70, 60), 10, (0, 0), None),        # 別のグリッドで上書き
+        ((25, 25, 90, 80), 8, (3, 5), None),         # 上書きされたブロックを再処理
+    ]
+    image = _image(seed=1)
+    processor = MosaicProcessor()
+    coverage = BlockCoverage()
+    with_coverage = image.copy()
+    without = image.copy()
+    for rect, size, origin, limit in strokes:
+        processor.process_region(with_coverage, rect, size, origin=origin, limit=limit, coverage=coverage)
+        processor.process_region(without, rect, size, origin=origin, limit=limit)
+        np.testing.assert_array_equal(with_coverage, without)
+
+
+def test_coverage_skips_processed_blocks():
+    image = _image()
+    processor = MosaicProcessor()
+    coverage = BlockCoverage()
+    _, dirty = processor.process_region(image, (10, 10, 60, 50), 8, origin=(3, 5), coverage=coverage)
+    assert dirty is not None
+
+    # 同じストロークをもう一度処理しても変更は無い
+    _, dirty = processor.process_region(image, (10, 10, 60, 50), 8, origin=(3, 5), coverage=coverage)
+    assert dirty is None
+
+
+def test_coverage_records_only_whole_blocks():
+    size, origin = 8, (3, 5)
+    image = _image()
+    coverage = BlockCoverage()
+    limit = (20, 20, 60, 60)
+    MosaicProcessor().process_region(image, (0, 0, 110, 90), size, origin=origin, limit=limit, coverage=coverage)
+
+    (key, bitmap), = coverage.maps.items()
+    assert key == (size, origin[0] - size, origin[1] - size)
+    for ky, kx in np.argwhere(bitmap):
+        x1, y1 = key[1] + kx * size, key[2] + ky * size
+        # 処理可能範囲で切り取られたブロックは記録しない
+        assert limit[0] <= x1 and x1 + size <= limit[2]
+        assert limit[1] <= y1 and y1 + size <= limit[3]
+    assert bitmap.any()
+
+
+def test_coverage_records_clipped_image_edge_blocks():
+    # 画像端で切れるブロックは、それ以上広がらないため処理済みとして記録する
+    image = _image()
+    coverage = BlockCoverage()
+    MosaicProcessor().process_region(image, (0, 0, 10, 10), 8, origin=(3, 5), coverage=coverage)
+
+    (key, bitmap), = coverage.maps.items()
+    assert bitmap[0, 0]
+
+
+def test_coverage_invalidate_other_grids():
+    coverage = BlockCoverage()
+    a = coverage.bitmap((8, 0, 0), (10, 10))
+    b = coverage.bitmap((6, -3, -1), (12, 12))
+    a[:] = True
+    b[:] = True
+    coverage.invalidate((16, 16, 24, 24), keep_key=(6, -3, -1))
+
+    assert b.all()
+    assert not a[2, 2] and a.sum() == 99
@@ -0,0 +1,59 @@
+"""編集履歴の一時ファイルへの退避と、破棄した領域の解放のテスト"""
+
+import numpy as np
+
+from mosaic_history import ImageHistory, take_snapshot
+
+
+def _stroke(history, image, rng, state):
+    """ランダムな範囲を塗りつぶす操作を1つ履歴に追加"""
+    x, y = rng.integers(0, 96, 2)
+    rect = (int(x), int(y), int(x) + 32, int(y) + 32)
+    snapshot = take_snapshot(image, rect)
+    image[rect[1]:rect[3], rect[0]:rect[2]] = rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)
+    history.push(image, rect, snapshot, state)
+
+
+def test_branching_history_keeps_spill_file_bounded():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (128, 128, 3), dtype=np.uint8)
+    history = ImageHistory(memory_budget=1, disk_budget=200_000, keep_recent=1, compress_level=0)
+    largest = 0
+    for step in range(300):
+        _stroke(history, image, rng, step)
+        # 何度か元に戻してから別の操作を行い、やり直しの履歴を破棄させる
+        if step % 3 == 2:
+            history.undo(image)
+            history.undo(image)
+        largest = max(largest, history.store.size)
+        assert history.store.size - history.store.dead == history.footprint()["disk"]
+
+    assert largest <= history.disk_budget
+    assert history.store.dead < max(history.footprint()["disk"], 16 * 1024 * 1024) + 1
+
+
+def test_undo_after_compaction_restores_pixels():
+    rng = np.random.default_rng(1)
+    image = rng.integers(0, 256, (128, 128, 3), dtype=np.uint8)
+    history = ImageHistory(memory_budget=1, disk_budget=10 ** 9, keep_recent=1, compress_level=0)
+    states = [image.copy()]
+    for step in range(12):
+        _stroke(history, image, rng, step)
+        states.append(image.copy())
+    # やり直しの履歴を破棄してから詰める
+    for _ in range(6):
+        history.undo(image)
+    del states[7:]
+    _stroke(history, image, rng, "branch")
+    states.append(image.copy())
+    dead = history.store.dead
+    assert dead > 0
+    history.store.compact([p for e in history.entries for p in e.pixels() if p.offset is not None])
+    assert history.store.dead == 0 and history.store.size == history.footprint()["disk"]
+
+    for expected in reversed(states[:-1]):
+        history.undo(image)
+        np.testing.assert_array_equal(image, expected)
+    for expected in states[1:]:
+        history.redo(image)
+        np.testing.assert_array_equal(image, expected)
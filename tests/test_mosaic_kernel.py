@@ -0,0 +1,63 @@
+"""apply_mosaic のブロック処理が従来の cv2.resize による処理と同一になることの確認"""
+
+import cv2
+import numpy as np
+import pytest
+
+from mosaic_processor import MosaicProcessor
+
+
+def _reference_mosaic(image, x1, y1, x2, y2, size):
+    """従来の apply_mosaic（INTER_LINEAR で縮小し INTER_NEAREST で拡大）"""
+    roi = image[y1:y2, x1:x2]
+    h, w = roi.shape[:2]
+    if w <= size or h <= size:
+        roi = cv2.resize(roi, (1, 1))
+        roi = cv2.resize(roi, (w, h), interpolation=cv2.INTER_NEAREST)
+    else:
+        new_w = (w // size) * size
+        new_h = (h // size) * size
+        roi = roi[:new_h, :new_w]
+        roi = cv2.resize(roi, (new_w // size, new_h // size))
+        roi = cv2.resize(roi, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
+        if roi.shape[:2] != (h, w):
+            roi = cv2.resize(roi, (w, h), interpolation=cv2.INTER_NEAREST)
+    out = image.copy()
+    out[y1:y2, x1:x2] = roi.reshape(out[y1:y2, x1:x2].shape)
+    return out
+
+
+CASES = [
+    # (画像の高さ, 幅, 範囲, モザイクサイズ)
+    ((120, 160), (0, 0, 160, 120), 8),
+    ((120, 160), (3, 5, 157, 118), 8),
+    ((120, 160), (10, 10, 97, 71), 7),
+    ((120, 160), (0, 0, 33, 160), 16),
+    ((100, 100), (20, 30, 29, 90), 10),
+    ((100, 100), (20, 30, 25, 34), 12),
+    ((257, 311), (1, 2, 300, 250), 43),
+    ((64, 64), (0, 0, 64, 64), 64),
+]
+
+
+@pytest.mark.parametrize("channels", [None, 3, 4])
+@pytest.mark.parametrize("shape, rect, size", CASES)
+def test_apply_mosaic_matches_resize(shape, rect, size, channels):
+    rng = np.random.default_rng(sum(shape) + size)
+    full_shape = shape if channels is None else shape + (channels,)
+    image = rng.integers(0, 256, full_shape, dtype=np.uint8)
+    expected = _reference_mosaic(image, *rect, size)
+
+    result = MosaicProcessor().apply_mosaic(image.copy(), *rect, size)
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_apply_mosaic_writes_in_place_and_keeps_outside():
+    image = np.random.default_rng(0).integers(0, 256, (80, 90, 3), dtype=np.uint8)
+    original = image.copy()
+    result = MosaicProcessor().apply_mosaic(image, 10, 20, 50, 60, 8)
+
+    assert result is image
+    outside = np.ones(image.shape[:2], dtype=bool)
+    outside[20:60, 10:50] = False
+    np.testing.assert_array_equal(image[outside], original[outside])
@@ -0,0 +1,47 @@
+"""画素データを再エンコードせずにメタデータを書き換える retag_image のテスト"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from mosaic_core import read_image_metadata, retag_image
+from mosaic_processor import MosaicProcessor
+
+
+@pytest.mark.parametrize("ext", ["png", "jpg", "tif"])
+def test_retag_keeps_pixels_and_round_trips_metadata(tmp_path, ext):
+    image = np.random.default_rng(0).integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    path = str(tmp_path / f"out.{ext}")
+    processor = MosaicProcessor()
+    processor.reference_point = (5, 7)
+    processor.current_mosaic_size = 12
+    assert processor.save_with_metadata(image, path)
+    with Image.open(path) as saved:
+        pixels = np.asarray(saved.convert("RGB"))
+
+    processor.metadata_text = "配布条件を更新しました"
+    assert processor.retag_metadata(path)
+
+    with Image.open(path) as retagged:
+        np.testing.assert_array_equal(np.asarray(retagged.convert("RGB")), pixels)
+        info = retagged.info if ext == "png" else read_image_metadata(path)
+    assert info["ProcessingInfo"] == "配布条件を更新しました"
+
+    loaded = MosaicProcessor()
+    assert loaded.load_reference_point(path)
+    assert loaded.reference_point == (5, 7) and loaded.current_mosaic_size == 12
+
+
+def test_retag_removes_keys_set_to_none(tmp_path):
+    path = str(tmp_path / "out.jpg")
+    Image.new("RGB", (8, 8)).save(path)
+    retag_image(path, {"A": "1", "B": "2"})
+    retag_image(path, {"A": None})
+    assert read_image_metadata(path) == {"B": "2"}
+
+
+def test_retag_rejects_other_formats(tmp_path):
+    path = str(tmp_path / "out.bmp")
+    Image.new("RGB", (8, 8)).save(path)
+    with pytest.raises(ValueError):
+        retag_image(path, {"A": "1"})
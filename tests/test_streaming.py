@@ -0,0 +1,103 @@
+"""ストリップごとのPNG書き出し（encode_png_streaming）とディスク上への展開（decoded_memmap）の確認"""
+
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from mosaic_core import decode_image, decoded_memmap, encode_png_streaming
+
+SHAPES = [
+    # (高さ, 幅[, チャンネル数])。幅は奇数でフィルタの境界を確認する
+    (7, 13, 3),
+    (5, 11, 4),
+    (9, 15),
+    (1, 1, 3),
+    (33, 3, 3),
+]
+
+
+def _expected_rgb(image):
+    """encode_png_streaming の書き出し結果に相当するRGB（アルファは捨て、グレーは3チャンネルに複製）"""
+    if image.ndim == 2:
+        return np.repeat(image[:, :, None], 3, axis=2)
+    return image[:, :, 2::-1]
+
+
+@pytest.mark.parametrize("strip_rows", [1, 2, 256])
+@pytest.mark.parametrize("shape", SHAPES)
+def test_encode_png_streaming_matches_pillow(tmp_path, shape, strip_rows):
+    rng = np.random.default_rng(sum(shape) + strip_rows)
+    image = rng.integers(0, 256, shape, dtype=np.uint8)
+    path = str(tmp_path / "out.png")
+
+    encode_png_streaming(image, path, strip_rows=strip_rows)
+
+    with Image.open(path) as pil_img:
+        assert pil_img.mode == "RGB"
+        np.testing.assert_array_equal(np.asarray(pil_img), _expected_rgb(image))
+
+
+def test_encode_png_streaming_writes_text_chunks(tmp_path):
+    image = np.random.default_rng(0).integers(0, 256, (6, 9, 3), dtype=np.uint8)
+    pnginfo = PngInfo()
+    pnginfo.add_text("Comment", "モザイク")
+    path = str(tmp_path / "out.png")
+
+    encode_png_streaming(image, path, pnginfo, strip_rows=2)
+
+    with Image.open(path) as pil_img:
+        assert pil_img.text["Comment"] == "モザイク"
+        np.testing.assert_array_equal(np.asarray(pil_img), _expected_rgb(image))
+
+
+def _rgb(rng, h, w):
+    return Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+
+
+CASES = [
+    # (ファイル名, 画像を作成する関数, 保存時の引数)
+    ("rgb.png", lambda rng: _rgb(rng, 21, 37), {}),
+    ("rgba.png", lambda rng: _rgb(rng, 21, 37).convert("RGBA"), {}),
+    ("gray.png", lambda rng: _rgb(rng, 21, 37).convert("L"), {}),
+    ("palette.png", lambda rng: _rgb(rng, 21, 37).convert("P"), {}),
+    ("rgb.jpg", lambda rng: _rgb(rng, 21, 37), {"quality": 90}),
+    ("progressive.jpg", lambda rng: _rgb(rng, 21, 37), {"quality": 90, "progressive": True}),
+    ("gray.jpg", lambda rng: _rgb(rng, 21, 37).convert("L"), {}),
+    ("rgb.bmp", lambda rng: _rgb(rng, 21, 37), {}),
+]
+
+
+@pytest.mark.parametrize("name, make, options", CASES)
+def test_decoded_memmap_matches_decode_image(tmp_path, name, make, options):
+    rng = np.random.default_rng(len(name))
+    path = str(tmp_path / name)
+    make(rng).save(path, **options)
+    expected = decode_image(path)
+    work = tmp_path / "work"
+    work.mkdir()
+
+    with decoded_memmap(path, str(work)) as image:
+        assert image.shape == expected.shape
+        np.testing.assert_array_equal(image, expected)
+        assert len(os.listdir(work)) == 1
+
+    # 終了時に一時ファイルを削除する
+    assert os.listdir(work) == []
+
+
+def test_decoded_memmap_writes_through_to_encoder(tmp_path):
+    image = np.random.default_rng(1).integers(0, 256, (19, 27, 3), dtype=np.uint8)
+    path = str(tmp_path / "in.png")
+    Image.fromarray(image[:, :, ::-1]).save(path)
+    out_path = str(tmp_path / "out.png")
+
+    with decoded_memmap(path, str(tmp_path)) as bgr:
+        bgr[3:9, 5:11] = 0
+        encode_png_streaming(bgr, out_path, strip_rows=4)
+
+    expected = image.copy()
+    expected[3:9, 5:11] = 0
+    np.testing.assert_array_equal(decode_image(out_path), expected)